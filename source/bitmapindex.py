@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`bitmapindex.py`
+================
+A bitmap index of the properties that the web map filters crashes on, so
+that any combination of filters can be counted, or its crashes found, over
+every year of crashes in milliseconds, instead of testing each feature.
+
+For each value of each of the FILTER_PROPERTIES (e.g. `al` = 1, `ij` = 'f'),
+a bitmap has a bit per crash, set if the crash has that value. A filter
+expression such as
+
+    al AND (sp OR dd) AND NOT ij=n
+
+is then evaluated with bitwise operations on whole bitmaps, 8 crashes to a
+byte (see evaluate(), count(), positions() and ids()). A bare property name
+means that it is 1, and `dy=null` matches crashes whose daylight is unknown.
+
+The index is built as the GeoJSON is written (it is a writer for
+nzta2geojson.main(), like tiles.TileWriter), a block of features at a time.
+positions() gives the matching crashes' positions in the output, and ids()
+their CRASH IDs (each feature's `id`), which the index keeps alongside.
+
+The bitmaps are plain packed bits, in memory and in the file: they are not
+run-length or otherwise compressed, so each takes an eighth of a byte per
+crash however few crashes it has. save() writes them with
+numpy.savez_compressed(), i.e. zlib'd, which shrinks the sparse ones well
+on disk; load() reads them back uncompressed.
+
+Import it: from bitmapindex import BitmapIndex
+Run it to benchmark filters over ten million synthetic crashes.
+
+Depends
+=======
+numpy
+'''
+
+import re
+import json
+
+import numpy as np
+
+# The properties of a feature that the web map filters on
+FILTER_PROPERTIES = ('al', 'dr', 'sp', 'cp', 'fg', 'dd', 'to', 'cy', 'pd', 'mc', 'tx',
+                     'tr', 'ca', 'ch', 'ij', 'dy')
+
+# Number of bits set in each byte, and in each pair of bytes
+POPCOUNT_8 = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.uint8)
+POPCOUNT_16 = (POPCOUNT_8[:, None] + POPCOUNT_8[None, :]).ravel()
+
+TOKENS = re.compile(r'\s*(?:(\()|(\))|(AND\b|&)|(OR\b|\|)|(NOT\b|!)|([A-Za-z_]\w*)(?:=([^\s()]+))?)')
+
+
+def parse_value(text):
+    '''Returns the value named in a filter term, e.g. 1, 'f' or None'''
+    if text is None:
+        return 1
+    if text == 'null':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        return text
+
+
+def value_bits(column, value):
+    '''Returns a boolean array of which of the array `column` are `value`'''
+    if value is None:
+        return np.array([v is None for v in column.tolist()], dtype=bool)
+    return column == value
+
+
+class BitmapIndex(object):
+    '''
+    I hold a bitmap of the crashes with each value of the `properties`, and
+    the CRASH ID of each crash. Features are added (see add()) `block` at a
+    time. Call close() once they are all added, which also saves me to
+    `path` if it is given.
+    '''
+    # nzta2geojson.add_features() gives me decoded features
+    decoded = True
+
+    def __init__(self, path=None, properties=FILTER_PROPERTIES, block=65536):
+        assert block % 8 == 0
+        self.path = path
+        self.properties = properties
+        self.block = block
+        self.pending = dict((name, []) for name in properties)
+        self.pending_ids = []
+        self.chunks = {} # (name, value): list of packed blocks
+        self.bitmaps = {} # (name, value): packed bits, once closed
+        self.id_chunks = [] # CRASH IDs of each block
+        self.crash_ids = None # CRASH ID of each crash, once closed
+        self.crashes = 0 # Number of crashes in the blocks so far
+        self.every = None # Bitmap of every crash, once asked for
+
+    def add(self, feature):
+        '''Adds a GeoJSON feature, as the next crash: encoded, as a
+        dictionary, or as an object with a __geo_interface__ (e.g. an
+        nztacrash). Only an encoded feature is decoded.'''
+        if isinstance(feature, basestring):
+            feature = json.loads(feature)
+        elif hasattr(feature, '__geo_interface__'):
+            geo_interface = feature.__geo_interface__
+            # nztacrash's is a method
+            feature = geo_interface() if callable(geo_interface) else geo_interface
+        values = feature['properties']
+        for name in self.properties:
+            self.pending[name].append(values.get(name))
+        self.pending_ids.append(feature.get('id'))
+        if len(self.pending_ids) >= self.block:
+            self.flush()
+
+    def add_block(self, columns, ids=None):
+        '''Adds a block of crashes, as a dictionary of the (equal length)
+        lists or arrays of the values of each of my properties, and the list
+        of their CRASH IDs (None if they are not known). Every block but the
+        last must be a multiple of 8 crashes long.'''
+        assert self.crashes % 8 == 0, 'only the last block may be a partial byte'
+        size = len(columns[self.properties[0]])
+        self.id_chunks.append(np.array([None] * size if ids is None else ids, dtype=object))
+        for name in self.properties:
+            column = columns[name]
+            if not isinstance(column, np.ndarray):
+                column = np.array(column, dtype=object)
+            present = set(column.tolist())
+            for value in present:
+                chunks = self.chunks.get((name, value))
+                if chunks is None:
+                    # None of the earlier crashes have it
+                    chunks = self.chunks[(name, value)] = [np.zeros(self.crashes // 8, dtype=np.uint8)]
+                chunks.append(np.packbits(value_bits(column, value)))
+            for (key, value), chunks in self.chunks.iteritems():
+                if key == name and value not in present:
+                    # Nor do any of this block's
+                    chunks.append(np.zeros((size + 7) // 8, dtype=np.uint8))
+        self.crashes += size
+
+    def flush(self):
+        '''Adds the features added since the last block as a block'''
+        if self.pending_ids:
+            self.add_block(self.pending, self.pending_ids)
+        self.pending = dict((name, []) for name in self.properties)
+        self.pending_ids = []
+
+    def close(self):
+        '''Adds the remaining features, joins each value's blocks into one
+        bitmap, and saves me to my path, if I have one'''
+        self.flush()
+        for key, chunks in self.chunks.iteritems():
+            self.bitmaps[key] = np.concatenate(chunks)
+        self.chunks = {}
+        self.crash_ids = np.concatenate(self.id_chunks or [np.array([], dtype=object)])
+        self.id_chunks = []
+        if self.path is not None:
+            self.save(self.path)
+
+    def __len__(self):
+        return self.crashes
+
+    def all(self):
+        '''Returns the bitmap of every crash'''
+        if self.every is None or len(self.every) * 8 < self.crashes:
+            self.every = np.packbits(np.ones(self.crashes, dtype=bool))
+        return self.every
+
+    def bitmap(self, name, value=1):
+        '''Returns the bitmap of the crashes whose `name` is `value`'''
+        if name not in self.properties:
+            raise ValueError('%s is not an indexed property (%s)' % (name, ', '.join(self.properties)))
+        bits = self.bitmaps.get((name, value))
+        if bits is None:
+            return np.zeros((self.crashes + 7) // 8, dtype=np.uint8)
+        return bits
+
+    def evaluate(self, expression):
+        '''Returns the bitmap of the crashes that match a filter
+        `expression`, e.g. "al AND (sp OR dd) AND NOT ij=n"'''
+        tokens = self.tokenise(expression)
+        bits = self.parse_or(tokens)
+        if tokens:
+            raise ValueError('Unexpected %r in %r' % (tokens[0][1], expression))
+        return bits
+
+    def count(self, expression):
+        '''Returns the number of crashes that match a filter `expression`'''
+        bits = self.evaluate(expression)
+        if len(bits) % 2:
+            bits = np.append(bits, np.uint8(0))
+        # Counted two bytes at a time, which halves the lookups
+        return int(np.take(POPCOUNT_16, bits.view(np.uint16)).sum(dtype=np.int64))
+
+    def positions(self, expression):
+        '''Returns the positions (in the order they were added, i.e. in
+        data.geojson) of the crashes that match a filter `expression`'''
+        return np.flatnonzero(np.unpackbits(self.evaluate(expression))[:self.crashes])
+
+    def ids(self, expression):
+        '''Returns the CRASH IDs of the crashes that match a filter
+        `expression` (None for those added without one), once I am
+        closed'''
+        if self.crash_ids is None:
+            raise ValueError('CRASH IDs are only known once the index is closed')
+        return self.crash_ids[self.positions(expression)].tolist()
+
+    def tokenise(self, expression):
+        '''Returns a list of the (kind, text) tokens of a filter
+        `expression`, where kind is one of ( ) AND OR NOT or a (name, value)'''
+        tokens, position = [], 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = TOKENS.match(expression, position)
+            if match is None:
+                raise ValueError('Cannot parse %r at %r' % (expression, expression[position:]))
+            opening, closing, and_, or_, not_, name, value = match.groups()
+            if name is not None:
+                tokens.append(((name, parse_value(value)), match.group(0).strip()))
+            else:
+                kind = ('(' if opening else ')' if closing else 'AND' if and_ else
+                        'OR' if or_ else 'NOT')
+                tokens.append((kind, match.group(0).strip()))
+            position = match.end()
+        return tokens
+
+    def parse_or(self, tokens):
+        bits = self.parse_and(tokens)
+        while tokens and tokens[0][0] == 'OR':
+            tokens.pop(0)
+            bits = bits | self.parse_and(tokens)
+        return bits
+
+    def parse_and(self, tokens):
+        bits = self.parse_not(tokens)
+        while tokens and tokens[0][0] == 'AND':
+            tokens.pop(0)
+            bits = bits & self.parse_not(tokens)
+        return bits
+
+    def parse_not(self, tokens):
+        if tokens and tokens[0][0] == 'NOT':
+            tokens.pop(0)
+            # Leaving the bits past the last crash clear
+            return ~self.parse_not(tokens) & self.all()
+        return self.parse_term(tokens)
+
+    def parse_term(self, tokens):
+        if not tokens:
+            raise ValueError('Unexpected end of filter expression')
+        kind, text = tokens.pop(0)
+        if kind == '(':
+            bits = self.parse_or(tokens)
+            if not tokens or tokens.pop(0)[0] != ')':
+                raise ValueError('Missing )')
+            return bits
+        if isinstance(kind, tuple):
+            return self.bitmap(*kind)
+        raise ValueError('Unexpected %r' % text)
+
+    def save(self, path):
+        '''Writes my bitmaps and CRASH IDs, zlib compressed, to the .npz file
+        at `path`'''
+        keys = sorted(self.bitmaps)
+        # The IDs are saved as a fixed-width string array, which (unlike an
+        # object array) needs no pickling; a missing one as ''
+        header = json.dumps({'crashes': self.crashes, 'properties': list(self.properties),
+                             'keys': keys})
+        arrays = dict(('bitmap%d' % i, self.bitmaps[key]) for i, key in enumerate(keys))
+        ids = np.array(['' if i is None else i for i in self.crash_ids.tolist()], dtype=str)
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, header=np.array(header), ids=ids, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        '''Returns the index saved at `path`'''
+        arrays = np.load(path)
+        header = json.loads(str(arrays['header']))
+        index = cls(properties=tuple(header['properties']))
+        index.crashes = header['crashes']
+        for i, (name, value) in enumerate(header['keys']):
+            index.bitmaps[(name, value)] = arrays['bitmap%d' % i]
+        # An index saved before its CRASH IDs were kept has none
+        ids = arrays['ids'].tolist() if 'ids' in arrays.files else [''] * index.crashes
+        index.crash_ids = np.array([i or None for i in ids], dtype=object)
+        return index
+
+    def stats(self):
+        '''Returns a dictionary of the number of crashes and bitmaps'''
+        return {'crashes': self.crashes, 'bitmaps': len(self.bitmaps)}
+
+
+if __name__ == '__main__':
+    # Benchmark filters over ten million synthetic crashes, each flag set at
+    # about the rate it is in the real ones, and check them against numpy
+    import time
+
+    rng = np.random.RandomState(2015)
+    count = 10 ** 7
+    rates = {'al': 0.1, 'dr': 0.01, 'sp': 0.08, 'cp': 0.005, 'fg': 0.03, 'dd': 0.05,
+             'to': 0.02, 'cy': 0.04, 'pd': 0.05, 'mc': 0.07, 'tx': 0.01, 'tr': 0.07,
+             'ca': 0.9, 'ch': 0.01}
+    columns = dict((name, (rng.random_sample(count) < rate).astype(np.int8))
+                   for name, rate in rates.items())
+    columns['ij'] = np.array(['f', 's', 'm', 'n'])[
+        np.searchsorted([0.01, 0.06, 0.25], rng.random_sample(count))]
+    columns['dy'] = (rng.random_sample(count) < 0.7).astype(np.int8)
+
+    start = time.time()
+    index = BitmapIndex()
+    block = index.block
+    for i in xrange(0, count, block):
+        index.add_block(dict((name, column[i:i + block]) for name, column in columns.items()))
+    index.close()
+    print '%d crashes indexed in %.1fs' % (len(index), time.time() - start)
+
+    expected = {
+        'al': columns['al'] == 1,
+        'al AND (sp OR dd) AND NOT ij=n': (columns['al'] == 1) & ((columns['sp'] == 1) | (columns['dd'] == 1)) & (columns['ij'] != 'n'),
+        'cy OR pd OR mc': (columns['cy'] == 1) | (columns['pd'] == 1) | (columns['mc'] == 1),
+        '(ij=f OR ij=s) AND NOT dy AND tr': np.in1d(columns['ij'], ['f', 's']) & (columns['dy'] == 0) & (columns['tr'] == 1),
+        'NOT ca AND NOT (cy OR pd)': (columns['ca'] == 0) & ~((columns['cy'] == 1) | (columns['pd'] == 1))
+    }
+    for expression, matches in sorted(expected.items()):
+        assert index.count(expression) == matches.sum()
+        assert np.array_equal(index.positions(expression), np.flatnonzero(matches))
+        times = []
+        for i in xrange(5):
+            start = time.time()
+            found = index.count(expression)
+            times.append(time.time() - start)
+        print '%-40s %8d crashes, counted in %.1fms' % (expression, found, min(times) * 1000)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`buildcache.py`
+===============
+A cache of the converted features of each crash CSV, so that rebuilding the
+GeoJSON after a data refresh only converts the CSVs that have changed.
+
+Each CSV's features are kept (serialised as JSON, one per line) in a file
+named for a hash of the CSV's contents and of everything else the
+conversion depends on: the decoders, the holidays, the date range, and the
+converter's own source code. Change any of those and the entry is simply
+not found, and the CSV is converted again.
+
+A CSV that NZTA refreshes by appending rows (like the current year's
+`-partial.csv`) can instead have only its new rows converted: its size, the
+hash of its contents and its last CRASH ID are remembered in a `.tail` file
+named for the CSV's path, and if it has since grown with those first bytes
+unchanged, the new rows' features are appended to the old ones. If the
+prefix has been rewritten, the whole CSV is converted as usual.
+
+Import it: from buildcache import BuildCache
+
+Depends
+=======
+hashlib, json
+'''
+
+import os
+import glob
+import json
+import hashlib
+from itertools import chain
+
+
+def file_hash(path, blocksize=1 << 20, size=None):
+    '''Returns the SHA-1 hex digest of the contents of the file at `path`,
+    or of only its first `size` bytes'''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        if size is None:
+            for block in iter(lambda: f.read(blocksize), ''):
+                sha.update(block)
+        else:
+            while size > 0:
+                block = f.read(min(blocksize, size))
+                if not block:
+                    break
+                sha.update(block)
+                size -= len(block)
+    return sha.hexdigest()
+
+def read_lines(f):
+    '''Yields each line of the open file `f` without its newline, and then
+    closes it'''
+    with f:
+        for line in f:
+            yield line[:-1]
+
+def source_file(path):
+    '''Returns the path of the source (.py) of a module's `path` (__file__),
+    which may be that of its compiled (.pyc) file'''
+    return os.path.splitext(path)[0] + '.py'
+
+
+class BuildCache(object):
+    '''
+    I keep the converted features of each CSV in `directory` (made if it
+    does not exist).
+
+    Call depend() with the files and values the conversion depends on before
+    using me. hits and misses count CSVs looked up since I was created, and
+    tails the misses that only had their appended rows converted (see
+    stats()). prune() removes the entries not used since then.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.context = hashlib.sha1()
+        self.used = set()
+        self.hits, self.misses, self.tails = 0, 0, 0
+
+    def depend(self, files=(), values=()):
+        '''Adds the contents of `files` and the repr() of `values` to the
+        key of every entry'''
+        for path in files:
+            self.context.update('file %s %s\n' % (os.path.basename(path), file_hash(path)))
+        for value in values:
+            self.context.update('value %r\n' % (value,))
+
+    def key(self, file, digest=None):
+        '''Returns the key of the features of the CSV `file` (whose
+        file_hash() is `digest`, if it is already known)'''
+        sha = self.context.copy()
+        sha.update('csv %s\n' % (digest or file_hash(file)))
+        return sha.hexdigest()
+
+    def tail_key(self, file):
+        '''Returns the key of the tail state of the CSV at `file`'s path'''
+        sha = self.context.copy()
+        sha.update('tail %s\n' % os.path.abspath(file))
+        return sha.hexdigest()
+
+    def path(self, key, kind='features'):
+        return os.path.join(self.directory, '%s.%s' % (key, kind))
+
+    def read(self, key):
+        '''Returns an iterator over the features kept under `key`, which
+        reads them a line at a time, or None if there are none'''
+        try:
+            f = open(self.path(key), 'rb')
+        except IOError:
+            return None
+        return read_lines(f)
+
+    def get(self, key):
+        '''Returns an iterator over the features (JSON strings) kept under
+        `key` (see read()), or None if there are none'''
+        self.used.add(key)
+        features = self.read(key)
+        if features is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return features
+
+    def put(self, key, features):
+        '''Keeps an iterable of `features` (JSON strings, which never contain
+        a newline) under `key`'''
+        for feature in self.keep(key, features):
+            pass
+
+    def keep(self, key, features):
+        '''Yields each of an iterable of `features` as it is written under
+        `key` (see put()). The entry is only replaced once they have all
+        been written, and not at all if they are not.'''
+        self.used.add(key)
+        temp = self.path(key) + '.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                for feature in features:
+                    f.write(feature + '\n')
+                    yield feature
+        except:
+            # Including GeneratorExit, if I am not read to the end
+            os.remove(temp)
+            raise
+        # Replace the entry only once it is complete
+        os.rename(temp, self.path(key))
+
+    def tail(self, file, convert_tail, last_id):
+        '''
+        Returns an iterator over the features of the CSV `file` if it has
+        only had rows appended to it since its tail state was saved: those
+        kept for it then (read a line at a time), followed by
+        convert_tail(file, offset), where offset is the byte at which the new
+        rows start. Returns None if it has been changed in any other way (or
+        has no tail state).
+
+        last_id(file, end) must return the CRASH ID of the row ending at byte
+        `end` of `file`.
+        '''
+        try:
+            with open(self.path(self.tail_key(file), 'tail'), 'rb') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        size = state['size']
+        if (os.path.getsize(file) <= size
+                or file_hash(file, size=size) != state['sha']
+                or last_id(file, size) != state['last_id']):
+            return None
+        features = self.read(state['key'])
+        if features is None:
+            return None
+        self.tails += 1
+        return chain(features, convert_tail(file, size))
+
+    def save_tail(self, file, key, digest, last_id):
+        '''Saves the tail state of the CSV `file`, whose features are kept
+        under `key`, so that its appended rows can be converted alone next
+        time. A file that does not end in a newline (i.e. with a whole row)
+        has none.'''
+        path = self.path(self.tail_key(file), 'tail')
+        size = os.path.getsize(file)
+        with open(file, 'rb') as f:
+            f.seek(max(size - 1, 0))
+            complete = f.read(1) == '\n'
+        if not complete:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        state = {'size': size, 'sha': digest, 'last_id': last_id(file, size), 'key': key}
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(state, f)
+        os.rename(path + '.tmp', path)
+
+    def features(self, data, convert, convert_tail=None, last_id=None):
+        '''
+        Yields the features of each of the CSVs listed in `data`, in order:
+        from the cache if the CSV is unchanged, otherwise by calling
+        convert([file]) (which must return an iterable of JSON strings) and
+        keeping the result for next time. Either way, they are streamed, a
+        feature at a time, rather than held in memory.
+
+        If convert_tail and last_id are given (see tail()), a CSV that has
+        only had rows appended to it has only those rows converted.
+        '''
+        for file in data:
+            digest = file_hash(file)
+            key = self.key(file, digest)
+            features = self.get(key)
+            if features is None:
+                if convert_tail is not None:
+                    features = self.tail(file, convert_tail, last_id)
+                if features is None:
+                    features = convert([file])
+                features = self.keep(key, features)
+            for feature in features:
+                yield feature
+            # Only once the entry is complete
+            if convert_tail is not None:
+                self.used.add(self.tail_key(file))
+                self.save_tail(file, key, digest, last_id)
+
+    def prune(self):
+        '''Removes the entries (and tail states) that have not been used
+        since I was created (e.g. those of a partial year's previous
+        download). Returns the number removed.'''
+        removed = 0
+        for path in (glob.glob(os.path.join(self.directory, '*.features')) +
+                     glob.glob(os.path.join(self.directory, '*.tail'))):
+            key = os.path.splitext(os.path.basename(path))[0]
+            if key not in self.used:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def stats(self):
+        '''Returns a dictionary of the number of CSVs found in the cache
+        (hits), converted (misses), and of those, the number that only had
+        their appended rows converted (tails)'''
+        return {'hits': self.hits, 'misses': self.misses, 'tails': self.tails}
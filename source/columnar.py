@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`columnar.py`
+=============
+A compact binary, columnar alternative to data.geojson.
+
+GeoJSON repeats every property key for every crash, writes its 0/1 flags as
+text, and its coordinates to 15 significant figures. Here the features are
+written in blocks of up to `block` features, and each block holds one column
+per property, chosen from what the column contains:
+
+* bits: 0/1 values (and nulls), packed 8 to a byte
+* int: integers (and nulls), in the narrowest of 1, 2, 4 or 8 bytes that
+  holds them all
+* dict: anything else (strings, lists, dictionaries), as a dictionary of the
+  distinct values and an index into it for each feature
+
+and the coordinates as integers of 1e-7 degrees (about a centimetre). The
+features' ids (CRASH IDs) are a column too, before the properties.
+
+Layout (integers are little-endian)::
+
+    b'NZCF', version (1 byte)
+    header length (4 bytes), header (JSON: {"properties": [names]})
+    blocks, each: feature count (4 bytes), then for the point, the id and
+        then each property: kind (1 byte), payload length (4 bytes), payload
+
+read() decodes it back to the same feature dictionaries as json.load() gives
+for data.geojson, except that coordinates are rounded to 7 decimal places.
+Run it to compare the size and parsing time of each.
+
+Import it: from columnar import ColumnarWriter, read
+
+Depends
+=======
+numpy
+'''
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = 'NZCF'
+VERSION = 2
+
+# Column kinds
+POINT, BITS, INT, DICT = range(4)
+
+# Degrees to the integers coordinates are stored as
+SCALE = 10 ** 7
+
+# Integer widths, narrowest first
+INT_TYPES = ('<i1', '<i2', '<i4', '<i8')
+
+# Dictionary index widths, narrowest first
+INDEX_TYPES = ('<u1', '<u2', '<u4')
+
+UINT32 = struct.Struct('<I')
+
+
+def column_kind(values):
+    '''Returns the kind of column that best holds a list of `values`'''
+    kind = BITS
+    for value in values:
+        if value is None:
+            continue
+        if type(value) not in (int, long):
+            return DICT
+        if value not in (0, 1):
+            kind = INT
+    return kind
+
+def pack_nulls(values):
+    '''Returns a has-nulls byte, followed by the packed bits of which
+    `values` are not None if there are any nulls'''
+    present = np.array([value is not None for value in values], dtype=bool)
+    if present.all():
+        return '\x00'
+    return '\x01' + np.packbits(present).tostring()
+
+def unpack_nulls(payload, count):
+    '''Returns (which values are present, or None if all are, and the offset
+    of the rest of the `payload`)'''
+    if payload[0] == '\x00':
+        return None, 1
+    size = (count + 7) // 8
+    present = np.unpackbits(np.frombuffer(payload, np.uint8, size, 1))[:count].astype(bool)
+    return present, 1 + size
+
+def with_nulls(values, present):
+    '''Returns the list of `values`, with None where they are not `present`'''
+    values = values.tolist()
+    if present is not None:
+        for i in np.flatnonzero(~present).tolist():
+            values[i] = None
+    return values
+
+def narrowest(low, high, types):
+    '''Returns the first of the numpy `types` that holds `low` to `high`'''
+    for dtype in types:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    raise OverflowError('%d to %d does not fit in %s' % (low, high, types[-1]))
+
+def encode_column(kind, values):
+    '''Returns the payload of a column of `kind` holding `values`'''
+    if kind == BITS:
+        bits = np.array([value == 1 for value in values], dtype=bool)
+        return pack_nulls(values) + np.packbits(bits).tostring()
+    if kind == INT:
+        ints = [0 if value is None else value for value in values]
+        dtype = narrowest(min(ints), max(ints), INT_TYPES)
+        return (pack_nulls(values) + chr(INT_TYPES.index(dtype)) +
+                np.array(ints, dtype=dtype).tostring())
+    # DICT: the distinct values, keyed on their JSON
+    encoder = json.JSONEncoder(separators=(',',':'), sort_keys=True)
+    index, distinct, indices = {}, [], []
+    for value in values:
+        key = encoder.encode(value)
+        i = index.get(key)
+        if i is None:
+            i = index[key] = len(distinct)
+            distinct.append(key)
+        indices.append(i)
+    dictionary = '[%s]' % ','.join(distinct)
+    dtype = narrowest(0, len(distinct), INDEX_TYPES)
+    return (UINT32.pack(len(dictionary)) + dictionary + chr(INDEX_TYPES.index(dtype)) +
+            np.array(indices, dtype=dtype).tostring())
+
+def decode_column(kind, payload, count):
+    '''Returns the list of `count` values of a column of `kind` from its
+    `payload`'''
+    if kind == BITS:
+        present, offset = unpack_nulls(payload, count)
+        bits = np.unpackbits(np.frombuffer(payload, np.uint8, offset=offset))[:count]
+        return with_nulls(bits.astype(np.int64), present)
+    if kind == INT:
+        present, offset = unpack_nulls(payload, count)
+        dtype = INT_TYPES[ord(payload[offset])]
+        return with_nulls(np.frombuffer(payload, dtype, count, offset + 1), present)
+    if kind == DICT:
+        size, = UINT32.unpack_from(payload)
+        distinct = json.loads(payload[4:4 + size])
+        dtype = INDEX_TYPES[ord(payload[4 + size])]
+        indices = np.frombuffer(payload, dtype, count, 5 + size)
+        return [distinct[i] for i in indices.tolist()]
+    raise ValueError('Unknown column kind %d' % kind)
+
+def encode_points(points):
+    '''Returns the payload of the coordinates of `points`, (lon, lat)s'''
+    quantised = np.round(np.array(points, dtype=np.float64) * SCALE)
+    return quantised.astype('<i4').T.tostring()
+
+def decode_points(payload, count):
+    '''Returns the list of [lon, lat]s of a payload of `count` points'''
+    quantised = np.frombuffer(payload, '<i4', 2 * count).reshape(2, count)
+    # Dividing (rather than multiplying by 1e-7) gives the nearest float
+    lonlat = quantised / float(SCALE)
+    return zip(lonlat[0].tolist(), lonlat[1].tolist())
+
+
+class ColumnarWriter(object):
+    '''
+    I write GeoJSON point features (see add()) to the file at `path` in
+    blocks of `block` features. Call close() when they are all added.
+    '''
+    # nzta2geojson.add_features() gives me decoded features
+    decoded = True
+
+    def __init__(self, path, block=65536):
+        self.path = path
+        self.block = block
+        self.file = None
+        self.names = None
+        self.features = []
+        self.added = 0
+
+    def add(self, feature):
+        '''Adds a GeoJSON point feature, as a dictionary (which I keep until
+        its block is written, so it must not be changed)'''
+        self.features.append(feature)
+        self.added += 1
+        if len(self.features) >= self.block:
+            self.flush()
+
+    def flush(self):
+        '''Writes the features added since the last block as a block'''
+        features = self.features
+        if self.file is None:
+            self.names = sorted(features[0]['properties']) if features else []
+            header = json.dumps({'properties': self.names})
+            self.file = open(self.path, 'wb')
+            self.file.write(MAGIC + chr(VERSION) + UINT32.pack(len(header)) + header)
+        if not features:
+            return
+        columns = [(POINT, encode_points([f['geometry']['coordinates'] for f in features]))]
+        ids = [f.get('id') for f in features]
+        for values in [ids] + [[f['properties'][name] for f in features] for name in self.names]:
+            kind = column_kind(values)
+            columns.append((kind, encode_column(kind, values)))
+        self.file.write(UINT32.pack(len(features)))
+        for kind, payload in columns:
+            self.file.write(chr(kind) + UINT32.pack(len(payload)) + payload)
+        self.features = []
+
+    def close(self):
+        '''Writes the remaining features, and closes the file'''
+        self.flush()
+        self.file.close()
+
+    def stats(self):
+        '''Returns a dictionary of the number of features written'''
+        return {'added': self.added}
+
+
+def read(path):
+    '''Generates the GeoJSON feature dictionaries of a file written by a
+    ColumnarWriter, decoding a block at a time'''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a columnar feature file' % path)
+        version = ord(f.read(1))
+        if version != VERSION:
+            raise ValueError('%s is version %d, not %d' % (path, version, VERSION))
+        size, = UINT32.unpack(f.read(4))
+        names = json.loads(f.read(size))['properties']
+        while True:
+            count = f.read(4)
+            if not count:
+                break
+            count, = UINT32.unpack(count)
+            columns = []
+            for i in xrange(len(names) + 2):
+                kind = ord(f.read(1))
+                size, = UINT32.unpack(f.read(4))
+                payload = f.read(size)
+                if kind == POINT:
+                    columns.append(decode_points(payload, count))
+                else:
+                    columns.append(decode_column(kind, payload, count))
+            for point, id, row in zip(columns[0], columns[1], zip(*columns[2:])):
+                feature = {
+                    'type': 'Feature',
+                    'properties': dict(zip(names, row)),
+                    'geometry': {'type': 'Point', 'coordinates': list(point)}
+                }
+                if id is not None:
+                    feature['id'] = id
+                yield feature
+
+
+if __name__ == '__main__':
+    # Compare the size and parsing time of data.geojson and its columnar form
+    import os
+    import gzip
+    import timeit
+    import tempfile
+
+    geojson = '../data/data.geojson'
+    with open(geojson, 'rb') as f:
+        text = f.read()
+    collection = json.loads(text)
+    path = os.path.join(tempfile.mkdtemp(), 'data.nzcf')
+    writer = ColumnarWriter(path)
+    for feature in collection['features']:
+        writer.add(feature)
+    writer.close()
+
+    decoded = list(read(path))
+    assert len(decoded) == len(collection['features'])
+    for before, after in zip(collection['features'], decoded):
+        before['geometry']['coordinates'] = [round(c, 7) for c in before['geometry']['coordinates']]
+        assert before == after, (before, after)
+
+    with open(path, 'rb') as f:
+        binary = f.read()
+    for name, data in (('GeoJSON', text), ('columnar', binary)):
+        compressed = len(gzip.zlib.compress(data, 9))
+        print '%-8s %9d bytes (%8d gzipped)' % (name, len(data), compressed)
+    json_time = min(timeit.repeat(lambda: json.load(open(geojson, 'rb')), number=1, repeat=5))
+    read_time = min(timeit.repeat(lambda: list(read(path)), number=1, repeat=5))
+    print '%d features: json.load %.3fs, read() %.3fs (%.1fx faster)' % (
+        len(decoded), json_time, read_time, json_time / read_time)
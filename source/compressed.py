@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`compressed.py`
+===============
+Writes a file and its precompressed variants (`.gz`, and `.br` if the
+brotli module is installed) from a single stream of writes, so that a static
+web server can send them as they are, without compressing on every request
+or reading the file back afterwards.
+
+The gzip variant has no file name or time in its header, so it only changes
+when the contents do.
+
+Each file is written under a temporary name and only renamed into place once
+all of them are finished, so a failed write leaves the previous ones intact.
+
+Import it: from compressed import CompressedWriter
+
+Depends
+=======
+zlib, brotli (optional)
+'''
+
+import os
+import time
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class GzipEncoder(object):
+    '''I gzip data written to me in pieces'''
+    extension = '.gz'
+
+    def __init__(self, level=9):
+        # 16 + the window bits asks zlib for a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliEncoder(object):
+    '''I brotli data written to me in pieces'''
+    extension = '.br'
+
+    def __init__(self, level=11):
+        self.compressor = brotli.Compressor(quality=level)
+        # Older versions of the brotli module call it compress()
+        self.process = getattr(self.compressor, 'process', None) or self.compressor.compress
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+EXTENSIONS = [GzipEncoder.extension, BrotliEncoder.extension]
+
+
+class CompressedWriter(object):
+    '''
+    I write everything written to me to the file at `path`, and compressed,
+    to `path`.gz (unless `gzip_level` is None) and `path`.br (unless
+    `brotli_level` is None, or brotli is not installed). Writes are buffered,
+    and compressed `buffer` bytes at a time, to temporary files. Call
+    close() to finish them and move them into place, removing any variant of
+    `path` I did not write, or discard() to throw them away. Used in a with
+    statement, I close, or discard if it raises.
+
+    stats() gives the size of each file, and the time spent compressing it.
+    '''
+    def __init__(self, path, gzip_level=9, brotli_level=11, buffer=1 << 16):
+        self.encoders = []
+        if gzip_level is not None:
+            self.encoders.append(GzipEncoder(gzip_level))
+        if brotli_level is not None and brotli is not None:
+            self.encoders.append(BrotliEncoder(brotli_level))
+        self.paths = [path] + [path + encoder.extension for encoder in self.encoders]
+        self.stale = [path + extension for extension in EXTENSIONS if path + extension not in self.paths]
+        self.temporary = ['%s.%d.tmp' % (name, os.getpid()) for name in self.paths]
+        self.files = []
+        try:
+            for name in self.temporary:
+                self.files.append(open(name, 'wb'))
+        except:
+            self.discard()
+            raise
+        self.names = ['identity'] + [encoder.extension[1:] for encoder in self.encoders]
+        self.seconds = [0.0] * len(self.files)
+        self.sizes = [0] * len(self.files)
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_size = buffer
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def output(self, i, data):
+        self.files[i].write(data)
+        self.sizes[i] += len(data)
+
+    def flush(self):
+        '''Writes (and compresses) what has been written to me so far'''
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        start = time.time()
+        self.output(0, data)
+        self.seconds[0] += time.time() - start
+        for i, encoder in enumerate(self.encoders, 1):
+            start = time.time()
+            self.output(i, encoder.process(data))
+            self.seconds[i] += time.time() - start
+
+    def close(self):
+        '''Finishes and closes each file, then renames it into place'''
+        try:
+            self.flush()
+            for i, encoder in enumerate(self.encoders, 1):
+                start = time.time()
+                self.output(i, encoder.finish())
+                self.seconds[i] += time.time() - start
+            for f in self.files:
+                f.close()
+        except:
+            self.discard()
+            raise
+        for temporary, name in zip(self.temporary, self.paths):
+            os.rename(temporary, name)
+        for name in self.stale:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def discard(self):
+        '''Closes and removes the files, leaving any earlier ones in place'''
+        for f in self.files:
+            f.close()
+        for name in self.temporary:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def stats(self):
+        '''Returns a dictionary of the bytes written to, and seconds spent
+        on, each encoding (identity is the plain file)'''
+        return dict((name, {'bytes': size, 'seconds': round(seconds, 3)})
+                    for name, size, seconds in zip(self.names, self.sizes, self.seconds))
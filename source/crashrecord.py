@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`crashrecord.py`
+================
+A compact record of a crash, for holding a whole national dataset in memory
+for analysis.
+
+An nztacrash keeps its source row, references to the decoders and holidays,
+and decoded as well as undecoded copies of most of its fields, all in an
+instance __dict__. A crashrecord has fixed __slots__ for the typed fields
+only: repeated strings are interned so that every record shares them, the
+boolean filters are packed into a single integer, and the decoded views are
+worked out on demand, with the same methods that nztacrash uses.
+
+Import it: from crashrecord import crashrecord
+Run it to compare the memory used per crash by each.
+'''
+
+import datetime
+
+import moon
+from decoders import FACTORS
+from nzta2geojson import nztacrash, NZTM
+
+# The boolean attributes of an nztacrash, packed into crashrecord.flags.
+# Those that nztacrash holds as 1/0 rather than True/False are listed in
+# INT_FLAGS, so that they come back (e.g. in the GeoJSON) exactly as they were.
+FACTOR_FLAGS = tuple(name for name, codes in FACTORS)
+FLAGS = ('fatal', 'injuries', 'injuries_severe', 'injuries_minor',
+         'injuries_none', 'worst_fatal', 'worst_severe', 'worst_minor',
+         'worst_none', 'holiday', 'pedestrian', 'cyclist', 'motorcyclist',
+         'taxi', 'truck', 'car') + FACTOR_FLAGS
+INT_FLAGS = ('pedestrian', 'cyclist', 'motorcyclist', 'taxi', 'truck',
+             'car') + FACTOR_FLAGS
+
+# nztacrash methods that only read the typed fields (or the views below), and
+# so work unchanged on a crashrecord
+SHARED_METHODS = ('get_crash_datetime', 'get_hasLocation', 'get_number_of_vehicles',
+                  'get_injured_child', 'get_injured_child_age',
+                  'get_worst_injury_text', 'get_injury_counts', 'speedingIcon',
+                  '__geo_interface__', 'get_unix_time', 'decodeMovement',
+                  'getKeyVehicle', 'getKeyVehicleMovement', 'getSecondaryVehicles',
+                  'getObjectsStruck', 'get_crashroad', 'decodeLight',
+                  'decodeWeather', 'decodeJunction', 'projectedpt', 'mapVehicles',
+                  'getCauses')
+
+# Typed fields, stored as they are. Strings are interned.
+FIELDS = ('tla_name', 'crash_road', 'crash_dist', 'crash_dirn', 'crash_intsn',
+          'side_road', 'crash_id', 'crash_date', 'crash_time', 'mvmt',
+          'vehicles', 'causes', 'objects_struck', 'road_curve', 'road_wet',
+          'light', 'wthr_a', 'junc_type', 'traf_ctrl', 'road_mark', 'spd_lim',
+          'crash_fatal_cnt', 'crash_sev_cnt', 'crash_min_cnt', 'pers_age1',
+          'pers_age2', 'easting', 'northing', 'lon', 'lat', 'chathams',
+          'daytime', 'moonphase', 'moontext', 'holiday_name')
+
+
+def compact(value):
+    '''Returns a string interned, a list of strings as an interned string (if
+    they are single characters, like nztacrash.light) or as a tuple of
+    interned strings (like nztacrash.causes), and anything else as it is.'''
+    if isinstance(value, str):
+        return intern(value)
+    if isinstance(value, list):
+        if all(isinstance(v, str) and len(v) == 1 for v in value):
+            return intern(''.join(value))
+        return tuple(compact(v) for v in value)
+    return value
+
+
+class crashrecord(object):
+    '''A compact, read-only view of an nztacrash (see from_crash())'''
+    __slots__ = FIELDS + ('flags',)
+
+    # Output of causeDecoderCSV(), shared by all records
+    causedecoder = None
+
+    # NZTM projection (see projectedpt())
+    proj = NZTM
+
+    @classmethod
+    def from_crash(cls, crash):
+        '''Returns a crashrecord holding the typed fields and flags of the
+        nztacrash `crash`. The first crash's cause decoder is kept (once) for
+        all records.'''
+        record = cls()
+        for field in FIELDS:
+            setattr(record, field, compact(getattr(crash, field)))
+        flags = 0
+        for i, flag in enumerate(FLAGS):
+            if getattr(crash, flag):
+                flags |= 1 << i
+        record.flags = flags
+        if cls.causedecoder is None:
+            cls.causedecoder = crash.causedecoder
+        return record
+
+    # Decoded and derived views, worked out on demand
+    crash_datetime = property(lambda self: self.get_crash_datetime())
+    hasLocation = property(lambda self: self.get_hasLocation())
+    keyvehicle = property(lambda self: self.getKeyVehicle(decode=False))
+    keyvehicle_decoded = property(lambda self: self.getKeyVehicle(decode=True))
+    keyvehiclemovement = property(lambda self: self.getKeyVehicleMovement(decode=False))
+    keyvehiclemovement_decoded = property(lambda self: self.getKeyVehicleMovement(decode=True))
+    secondaryvehicles = property(lambda self: self.getSecondaryVehicles(decode=False))
+    secondaryvehicles_decoded = property(lambda self: self.getSecondaryVehicles(decode=True))
+    causesdict = property(lambda self: self.getCauses(decode=False))
+    causesdict_decoded = property(lambda self: self.getCauses(decode=True))
+    party_vehicle_map = property(lambda self: self.mapVehicles())
+    objects_struck_decoded = property(lambda self: self.getObjectsStruck())
+    light_decoded = property(lambda self: self.decodeLight())
+    wthr_a_decoded = property(lambda self: self.decodeWeather())
+    junc_type_decoded = property(lambda self: self.decodeJunction())
+    moon = property(lambda self: moon.MoonPhase(self.crash_datetime)
+                    if self.crash_datetime is not None else None)
+
+    def __repr__(self):
+        return '<crashrecord %s>' % self.crash_id
+
+for _name in SHARED_METHODS:
+    setattr(crashrecord, _name, nztacrash.__dict__[_name])
+
+def _flag_property(bit, cast):
+    return property(lambda self: cast(self.flags & bit != 0))
+
+for _i, _flag in enumerate(FLAGS):
+    setattr(crashrecord, _flag,
+            _flag_property(1 << _i, int if _flag in INT_FLAGS else bool))
+
+
+def deep_size(objects, shared=()):
+    '''Returns the number of bytes used by the `objects` and everything they
+    refer to, counting each object once, and not counting the `shared`
+    objects (nor anything they refer to).'''
+    import sys
+    seen = set(id(s) for s in shared)
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
+
+
+if __name__ == '__main__':
+    # Compare the memory used per crash by nztacrash and crashrecord
+    import logging
+    logging.disable(logging.CRITICAL)
+    import nzta2geojson
+
+    holidays = nzta2geojson.get_official_holiday_periods()
+    causedecoder = nzta2geojson.causeDecoderCSV('../data/decoders/cause-decoder.csv')
+    streetdecoder = nzta2geojson.streetDecoderCSV('../data/decoders/NZ-post-street-types.csv')
+    crashes = list(nzta2geojson.read_crashes('../data/crash-data-2015-partial.csv',
+        causedecoder, streetdecoder, holidays,
+        datetime.date(2015,1,1), datetime.date(2015,12,31)))
+    for crash in crashes:
+        # As they would be without batch=True
+        crash.moon = crash.get_moon()
+    records = [crashrecord.from_crash(crash) for crash in crashes]
+
+    for crash, record in zip(crashes, records):
+        assert crash.__geo_interface__() == record.__geo_interface__()
+
+    shared = [causedecoder, streetdecoder, holidays, NZTM]
+    before = deep_size(crashes, shared) / float(len(crashes))
+    after = deep_size(records, shared) / float(len(records))
+    print ('%d crashes: nztacrash %.0f bytes/crash, crashrecord %.0f bytes/crash (%.1fx smaller)' %
+        (len(crashes), before, after, before / after))
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`crashtable.py`
+===============
+A columnar, in-memory table of crashes, as an alternative to making an
+nztacrash for every row of a CAS CSV.
+
+A CrashTable parses a CSV straight into typed NumPy columns (int16 counts,
+datetime64 times, float64 coordinates, and bitmasks of the modes of travel
+and contributing factors involved), and derives the filter properties of the
+GeoJSON from them with vectorised expressions. Free-text properties (the
+nicely formatted road name, the decoded causes) are not derived here; use
+nztacrash for those.
+
+Import it: from crashtable import CrashTable
+Run it to compare it with nztacrash on the shipped CSV.
+
+Depends
+=======
+numpy, pyproj, pytz
+'''
+
+import csv
+import datetime
+from itertools import chain
+
+import numpy as np
+import pytz
+
+import moon
+import sun
+from decoders import FACTORS, FACTOR_BITS, FACTOR_MASKS
+from nzta2geojson import NZTM, CHATHAMS_CORRECTION, is_chathams
+
+# Vehicle (mode) codes, as found in the VEHICLES column; bit i of a mode
+# mask is set if VEHICLE_CODES[i] was involved
+VEHICLE_CODES = 'CVXBL4TMPSKOUEQH'
+
+# Groups of vehicle codes for the mode filters, as in nztacrash
+MODES = (
+    ('pedestrian', 'EKH'), # Pedestrian, skater, wheeled pedestrian
+    ('cyclist', 'S'), # Cyclist
+    ('motorcyclist', 'MP'), # Motorcyclist, moped
+    ('taxi', 'X'), # Taxi/taxi van
+    ('truck', 'T'), # Truck
+    ('car', 'CV4') # Car, van/ute, SUV
+)
+
+# GeoJSON property names of the mode and factor filters
+SHORT_NAMES = {
+    'pedestrian': 'pd', 'cyclist': 'cy', 'motorcyclist': 'mc', 'taxi': 'tx',
+    'truck': 'tr', 'car': 'ca', 'tourist': 'to', 'alcohol': 'al',
+    'drugs': 'dr', 'cellphone': 'cp', 'fatigue': 'fg', 'dickhead': 'dd',
+    'speeding': 'sp'
+}
+
+MODE_BITS = dict((code, 1 << i) for i, code in enumerate(VEHICLE_CODES))
+
+NAT = np.datetime64('NaT')
+
+
+def mode_mask(vehicles):
+    '''Returns the mode bitmask of the key vehicle (the first character) and
+    the secondary vehicles (from the fourth character) of a VEHICLES code'''
+    mask = MODE_BITS.get(vehicles[:1], 0)
+    for v in vehicles[3:]:
+        mask |= MODE_BITS.get(v, 0)
+    return mask
+
+def known(times):
+    '''Returns a mask of the datetime64 `times` that are not NaT (NaT == NaT
+    in older versions of NumPy, and there is no numpy.isnat)'''
+    return times.view(np.int64) != np.iinfo(np.int64).min
+
+def parse_date(datestring):
+    '''Returns a numpy.datetime64 day given a date of the form DD/MM/YYYY,
+    or NaT if it is empty or malformed (as genFunc.formatDate).'''
+    try:
+        return np.datetime64(datetime.datetime.strptime(datestring, '%d/%m/%Y').date(), 'D')
+    except ValueError:
+        return NAT
+
+def char_matrix(column):
+    '''Returns a column of strings as a matrix of their bytes, one row per
+    string, padded with zeros'''
+    chars = np.array(column, dtype=str)
+    if chars.dtype.itemsize == 0:
+        # Every string is empty
+        return np.zeros((len(chars), 1), dtype=np.uint8)
+    return chars.view(np.uint8).reshape(len(chars), chars.dtype.itemsize)
+
+def digit_values(chars):
+    '''Returns the int64 values of the strings of a char_matrix() of
+    digits, and a mask of those that are only (and at least one) digits'''
+    digits = chars.astype(np.int64) - ord('0')
+    present = chars != 0
+    valid = present[:, 0] & (((digits >= 0) & (digits <= 9)) | ~present).all(axis=1)
+    values = np.zeros(len(chars), dtype=np.int64)
+    for j in xrange(chars.shape[1]):
+        values = np.where(present[:, j], values * 10 + digits[:, j], values)
+    return values, valid
+
+def parse_integers(column, missing=0, dtype=np.int16):
+    '''Returns an array of the integers in a column of strings, with `missing`
+    for those that are empty or not integers. Strings of digits are
+    converted all at once; only any others are passed to int().'''
+    chars = char_matrix(column)
+    values, valid = digit_values(chars)
+    values[~valid] = missing
+    for i in np.flatnonzero(~valid & (chars[:, 0] != 0)):
+        values[i] = to_integer(column[i], missing)
+    return values.astype(dtype)
+
+def to_integer(value, missing):
+    try:
+        return int(value)
+    except ValueError:
+        return missing
+
+def parse_dates(column):
+    '''Returns an array of datetime64[D] of a column of dates (as
+    parse_date()). Those of the form DD/MM/YYYY are converted all at once;
+    only any others are passed to parse_date().'''
+    chars = char_matrix(column)
+    dates = np.full(len(chars), NAT, dtype='datetime64[D]')
+    if chars.shape[1] < 10:
+        chars = np.hstack([chars, np.zeros((len(chars), 10 - chars.shape[1]), dtype=np.uint8)])
+    slash = ord('/')
+    canonical = (chars[:, 2] == slash) & (chars[:, 5] == slash) & (chars[:, 10:] == 0).all(axis=1)
+    day, day_valid = digit_values(chars[:, 0:2])
+    month, month_valid = digit_values(chars[:, 3:5])
+    year, year_valid = digit_values(chars[:, 6:10])
+    canonical &= day_valid & month_valid & year_valid & (month >= 1) & (month <= 12) & (day >= 1)
+    first = (year[canonical] - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (
+        month[canonical] - 1).astype('timedelta64[M]')
+    parsed = first.astype('datetime64[D]') + (day[canonical] - 1).astype('timedelta64[D]')
+    # e.g. 31/02 runs into the next month
+    in_month = parsed.astype('datetime64[M]') == first
+    dates[np.flatnonzero(canonical)[in_month]] = parsed[in_month]
+    canonical[np.flatnonzero(canonical)[~in_month]] = False
+    others = np.flatnonzero(~canonical)
+    if len(others):
+        dates[others] = parse_unique([column[i] for i in others], parse_date)
+    return dates
+
+def factor_masks(column, masks=np.array(FACTOR_MASKS, dtype=np.uint32)):
+    '''Returns the uint32 factor masks (see decoders.factor_mask()) of a
+    column of CAUSES, from the cause codes of every crash at once'''
+    codes = map(str.split, column)
+    counts = np.fromiter(map(len, codes), dtype=np.int64, count=len(codes))
+    chars = char_matrix(list(chain.from_iterable(codes)))
+    if chars.shape[1] < 5:
+        chars = np.hstack([chars, np.zeros((len(chars), 5 - chars.shape[1]), dtype=np.uint8)])
+    # As factor_mask(): a three digit number, perhaps with a letter after it
+    number, valid = digit_values(chars[:, :3])
+    valid &= (chars[:, 2] != 0) & ((chars[:, 3:] != 0).sum(axis=1) <= 1)
+    cited = np.where(valid, masks[np.where(valid, number, 0)], 0).astype(np.uint32)
+    # OR together the masks of each crash's codes (and of none, 0)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    cited = np.append(cited, np.uint32(0))
+    return np.where(counts > 0, np.bitwise_or.reduceat(cited, starts), 0).astype(np.uint32)
+
+def parse_unique(column, parse, *args):
+    '''Returns a list of parse(value, *args) for each value in a column,
+    calling parse() once per distinct value (the columns of a crash CSV
+    repeat a lot)'''
+    parsed = dict((v, parse(v, *args)) for v in set(column))
+    return [parsed[v] for v in column]
+
+def utc_offsets(local, tz=pytz.timezone('Pacific/Auckland')):
+    '''Returns the UTC offsets (timedelta64[s]) of an array of naive
+    `local` datetime64[s] times, as nztacrash.get_crash_datetime(as_utc=True)
+    would apply them. Clocks change at most twice a year, and never twice
+    within 60 days, so pytz is only called for the first and last days of
+    runs of distinct days, halving them until each run is under 60 days and
+    starts and ends on the same offset, and then once per crash only on the
+    days that clocks change.'''
+    offsets = np.zeros(len(local), dtype='timedelta64[s]')
+    valid = known(local)
+    days = local.astype('datetime64[D]')
+    distinct = np.unique(days[valid])
+    day_offsets = np.zeros(len(distinct), dtype='timedelta64[s]')
+    changes = [] # Positions in `distinct` of the days that clocks change
+
+    def offset(dt):
+        return np.timedelta64(int(tz.localize(dt, is_dst=True).utcoffset().total_seconds()), 's')
+
+    def first(i):
+        return offset(datetime.datetime.combine(distinct[i].astype(datetime.datetime), datetime.time(0)))
+
+    def last(i):
+        return offset(datetime.datetime.combine(distinct[i].astype(datetime.datetime), datetime.time(23, 59)))
+
+    runs = [(0, len(distinct) - 1)] if len(distinct) else []
+    while runs:
+        start, end = runs.pop()
+        start_offset = first(start)
+        if (start_offset == last(end) and
+                distinct[end] - distinct[start] < np.timedelta64(60, 'D')):
+            day_offsets[start:end + 1] = start_offset
+        elif start == end:
+            changes.append(start)
+        else:
+            middle = (start + end) // 2
+            runs.extend([(start, middle), (middle + 1, end)])
+
+    offsets[valid] = day_offsets[np.searchsorted(distinct, days[valid])]
+    for i in changes:
+        # Daylight saving begins or ends today
+        for row in np.flatnonzero(valid & (days == distinct[i])):
+            offsets[row] = offset(local[row].astype(datetime.datetime))
+    return offsets
+
+
+class CrashTable:
+    '''
+    Crashes as typed columns, each a NumPy array with one element per crash:
+
+        crash_id, tla_name - strings (object arrays)
+        fatal_cnt, sev_cnt, min_cnt - int16 numbers of people killed and
+                                      seriously and minorly injured
+        age1, age2 - int16 ages of an injured pedestrian and cyclist (-1: none)
+        crash_date - datetime64[D] date of the crash (NaT: unknown)
+        local_time - datetime64[s] local (NZ) time of the crash (NaT: unknown)
+        utc_time - datetime64[s] UTC time of the crash
+        easting, northing - float64 NZTM coordinates, with the Chatham
+                            Islands correction applied (NaN: no location)
+        lon, lat - float64 WGS84 coordinates
+        chathams - bool
+        modes - uint16 bitmask of the VEHICLE_CODES involved
+        factors - uint32 bitmask of the decoders.FACTORS cited
+
+    and the derived filters as methods or properties (see properties()).
+    '''
+    COLUMNS = ('crash_id', 'tla_name', 'fatal_cnt', 'sev_cnt', 'min_cnt',
+               'age1', 'age2', 'crash_date', 'local_time', 'utc_time', 'easting', 'northing',
+               'lon', 'lat', 'chathams', 'modes', 'factors')
+
+    def __init__(self, **columns):
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.crash_id)
+
+    @classmethod
+    def from_csv(cls, file):
+        '''Parses a crash CSV into a CrashTable'''
+        with open(file, 'rb') as crashcsv:
+            crashreader = csv.reader(crashcsv, delimiter=',')
+            header = crashreader.next()
+            rows = list(crashreader)
+        if not rows:
+            cols = [()] * len(header)
+        else:
+            cols = zip(*rows)
+        n = len(rows)
+
+        tla_name = np.array([v if v.strip() else None for v in cols[0]], dtype=object)
+
+        # Columns of integers parsed together, as fewer, bigger arrays
+        hhmm, age1, age2 = parse_integers(cols[9] + cols[25] + cols[26], missing=-1).reshape(3, n)
+        fatal_cnt, sev_cnt, min_cnt = parse_integers(cols[22] + cols[23] + cols[24]).reshape(3, n)
+        easting, northing = parse_integers(cols[27] + cols[28], dtype=np.int64).reshape(2, n)
+
+        # Times: date plus HMM time, if both are valid
+        dates = parse_dates(cols[7])
+        valid_time = (hhmm >= 0) & (hhmm // 100 < 24) & (hhmm % 100 < 60)
+        local_time = dates.astype('datetime64[s]') + (
+            (hhmm // 100).astype('timedelta64[h]') + (hhmm % 100).astype('timedelta64[m]'))
+        local_time[~valid_time] = NAT
+        utc_time = local_time - utc_offsets(local_time)
+
+        # Locations, with the Chatham Islands correction
+        easting, northing = easting.astype(np.float64), northing.astype(np.float64)
+        located = (easting != 0) & (northing != 0)
+        easting[~located] = np.nan
+        northing[~located] = np.nan
+        chathams = located & np.array(parse_unique(cols[0], is_chathams), dtype=bool)
+        easting[chathams] += CHATHAMS_CORRECTION[0]
+        northing[chathams] += CHATHAMS_CORRECTION[1]
+        lon = np.full(n, np.nan)
+        lat = np.full(n, np.nan)
+        if located.any():
+            lon[located], lat[located] = NZTM(easting[located], northing[located], inverse=True)
+
+        return cls(
+            crash_id=np.array(cols[6], dtype=object),
+            tla_name=tla_name,
+            fatal_cnt=fatal_cnt,
+            sev_cnt=sev_cnt,
+            min_cnt=min_cnt,
+            age1=age1,
+            age2=age2,
+            crash_date=dates,
+            local_time=local_time,
+            utc_time=utc_time,
+            easting=easting,
+            northing=northing,
+            lon=lon,
+            lat=lat,
+            chathams=chathams,
+            modes=np.array(parse_unique(cols[11], mode_mask), dtype=np.uint16),
+            factors=factor_masks(cols[12])
+        )
+
+    def select(self, mask):
+        '''Returns a new CrashTable of the crashes where `mask` is True (or
+        at the indices in `mask`)'''
+        return CrashTable(**dict((name, getattr(self, name)[mask]) for name in self.COLUMNS))
+
+    def records(self):
+        '''Returns the typed columns as one NumPy structured array'''
+        return np.rec.fromarrays([getattr(self, name) for name in self.COLUMNS],
+                                 names=self.COLUMNS)
+
+    def valid(self, global_start=None, global_end=None):
+        '''Returns a mask of the crashes that get_crashes() would yield: those
+        with a location and a date, within the dates given (datetime.date)'''
+        day = self.crash_date
+        mask = ~np.isnan(self.lon) & known(day)
+        if global_start is not None:
+            mask &= day >= np.datetime64(global_start, 'D')
+        if global_end is not None:
+            mask &= day <= np.datetime64(global_end, 'D')
+        return mask
+
+    # Injury filters, as nztacrash
+    fatal = property(lambda self: self.fatal_cnt > 0)
+    injuries = property(lambda self: (self.sev_cnt > 0) | (self.min_cnt > 0))
+    injuries_severe = property(lambda self: self.sev_cnt > 0)
+    injuries_minor = property(lambda self: self.min_cnt > 0)
+    injuries_none = property(lambda self: ~(self.fatal | self.injuries))
+    worst_fatal = property(lambda self: self.fatal)
+    worst_severe = property(lambda self: ~self.fatal & self.injuries_severe)
+    worst_minor = property(lambda self: ~self.fatal & ~self.injuries_severe & self.injuries_minor)
+    worst_none = property(lambda self: self.injuries_none)
+
+    def mode(self, name):
+        '''Returns a mask of the crashes involving the mode `name` (see MODES)'''
+        codes = dict(MODES)[name]
+        bits = sum(MODE_BITS[code] for code in codes)
+        return (self.modes & bits) != 0
+
+    def factor(self, name):
+        '''Returns a mask of the crashes citing the factor `name` (see
+        decoders.FACTORS)'''
+        return (self.factors & FACTOR_BITS[name]) != 0
+
+    def injured_child(self, childAge=15):
+        '''As nztacrash.get_injured_child()'''
+        return (((self.age1 >= 0) & (self.age1 <= childAge)) |
+                ((self.age2 >= 0) & (self.age2 <= childAge)))
+
+    def injured_child_age(self, childAge=15):
+        '''As nztacrash.get_injured_child_age(), with -1 for None'''
+        ages = np.where(self.age1 >= 0, self.age1, self.age2)
+        both = (self.age1 >= 0) & (self.age2 >= 0)
+        ages = np.where(both, np.minimum(self.age1, self.age2), ages)
+        return np.where(self.injured_child(childAge), ages, -1)
+
+    def worst_injury_text(self):
+        '''As nztacrash.get_worst_injury_text()'''
+        text = np.full(len(self), '', dtype='S1')
+        text[self.worst_none] = 'n'
+        text[self.worst_minor] = 'm'
+        text[self.worst_severe] = 's'
+        text[self.worst_fatal] = 'f'
+        return text
+
+    def unix_time(self):
+        '''As nztacrash.get_unix_time(): int64 milliseconds (-1 for None)'''
+        ms = self.utc_time.astype('datetime64[ms]').astype(np.int64)
+        return np.where(known(self.utc_time), ms, -1)
+
+    def daylight(self, twilight='civil'):
+        '''As nztacrash.get_daylight(): int8, with -1 for None'''
+        located = known(self.utc_time) & ~np.isnan(self.lon)
+        dy = np.full(len(self), -1, dtype=np.int8)
+        dy[located] = sun.daylight(self.utc_time[located], self.lat[located], self.lon[located], twilight=twilight)
+        return dy
+
+    def moonphase(self):
+        '''As the GeoJSON's moonphase: the moon's phase from 0 to 26, int8
+        with -1 for None'''
+        dated = known(self.local_time)
+        phases = np.full(len(self), -1, dtype=np.int8)
+        jdn = sun.julian_day(self.local_time[dated])
+        phases[dated] = (moon.phase_array(jdn)['phase'] * 26 + 0.5).astype(np.int8)
+        return phases
+
+    def properties(self):
+        '''Returns a dictionary of arrays of the GeoJSON filter properties (by
+        their GeoJSON names), where None is -1 (or '' for ij)'''
+        props = {
+            'ch': self.injured_child().astype(np.int8),
+            'ij': self.worst_injury_text(),
+            'dy': self.daylight(),
+            'unixt': self.unix_time(),
+            'chathams': self.chathams.astype(np.int8),
+            'childage': self.injured_child_age(),
+            'moonphase': self.moonphase()
+        }
+        for name, codes in MODES:
+            props[SHORT_NAMES[name]] = self.mode(name).astype(np.int8)
+        for name, codes in FACTORS:
+            props[SHORT_NAMES[name]] = self.factor(name).astype(np.int8)
+        return props
+
+
+if __name__ == '__main__':
+    # Compare CrashTable with an nztacrash per row, on the shipped CSV
+    import time
+    import logging
+    logging.disable(logging.CRITICAL)
+    import nzta2geojson
+
+    data = '../data/crash-data-2015-partial.csv'
+    global_start, global_end = datetime.date(2015,1,1), datetime.date(2015,12,31)
+
+    def per_row():
+        crashes = nzta2geojson.get_crashes(data,
+            '../data/decoders/cause-decoder.csv',
+            '../data/decoders/NZ-post-street-types.csv',
+            holidays, global_start, global_end)
+        return [crash.__geo_interface__()['properties'] for crash in crashes]
+
+    def columnar():
+        table = CrashTable.from_csv(data)
+        return table.select(table.valid(global_start, global_end)).properties()
+
+    def best_of(f, repeat=5):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            result = f()
+            times.append(time.time() - start)
+        return result, min(times)
+
+    holidays = nzta2geojson.get_official_holiday_periods()
+    features, per_row_time = best_of(per_row)
+    props, columnar_time = best_of(columnar)
+
+    none = {'dy': -1, 'unixt': -1, 'childage': -1, 'moonphase': -1}
+    mismatches = 0
+    for i, feature in enumerate(features):
+        for key, values in props.items():
+            expected = feature['moon']['moonphase'] if key == 'moonphase' else feature[key]
+            value = values[i].item()
+            if expected is None:
+                expected = none.get(key)
+            if value != expected:
+                mismatches += 1
+    print ('%d crashes, %d property mismatches; nztacrash %.3fs, CrashTable %.3fs (%.0fx faster)' %
+        (len(features), mismatches, per_row_time, columnar_time, per_row_time / columnar_time))
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`decoders.py`
+=============
+The decoders of the coded columns of the crash data, built once at import
+into a single registry, DECODERS, of CodeTables.
+
+A CodeTable is a flat tuple of decoded values indexed by the ordinal of the
+code (ord() of a single-character code, the number of a cause code), so
+decoding a code is one index operation, e.g.
+
+    LIGHT[ord('B')] >> 'Bright sun'
+
+and decode() decodes a whole column at once.
+
+The registry holds:
+    - the tables nztacrash decodes with (movement, vehicles, directions,
+      objects struck, light, weather, junctions),
+    - 'cause', from data/decoders/cause-decoder.csv (as causeDecoderCSV()),
+    - the web map's tables, from data/decoders/*.yaml, by file name (e.g.
+      'light-decoder'), if PyYAML is installed.
+
+Depends
+=======
+numpy, PyYAML (optional)
+'''
+
+import os
+import csv
+import glob
+
+import numpy as np
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+DECODERS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data', 'decoders')
+
+
+def letter_pair(code):
+    '''Ordinal of a two-letter code, e.g. a movement "DA"'''
+    first, second = ord(code[0]) - 65, ord(code[1]) - 65
+    if not (0 <= first < 26 and 0 <= second < 26):
+        raise ValueError(code)
+    return first * 26 + second
+
+def cause_number(code):
+    '''Ordinal of a three-digit cause code, e.g. "103"'''
+    number = int(code)
+    if not 0 <= number < 1000:
+        raise ValueError(code)
+    return number
+
+
+class CodeTable(tuple):
+    '''
+    I am a decoder for one coded column: a tuple of the decoded values,
+    indexed by ordinal(code), with None where there is no such code.
+
+    Index me by ordinal for speed, or use decode() (one code) or
+    decode_all() (many), which take codes and return None for unknown or
+    malformed ones.
+    '''
+    def __new__(cls, mapping, ordinal=ord, size=256):
+        values = [None] * size
+        for code, value in mapping.items():
+            values[ordinal(code)] = value
+        table = tuple.__new__(cls, values)
+        table.ordinal = ordinal
+        table.codes = tuple(sorted(mapping.keys()))
+        # For indexing by arrays of ordinals (see decode_all())
+        table.array = np.empty(size, dtype=object)
+        for i, value in enumerate(values):
+            table.array[i] = value
+        return table
+
+    def decode(self, code):
+        try:
+            return self[self.ordinal(code)]
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    def decode_all(self, codes):
+        '''Decodes a sequence of codes as a list, or a NumPy array of
+        single-character codes (dtype S1) or of ordinals as an object array'''
+        if isinstance(codes, np.ndarray):
+            if codes.dtype.kind == 'S':
+                codes = codes.astype('S1').view(np.uint8)
+            return self.array[codes]
+        return [self.decode(code) for code in codes]
+
+
+# Movement: the type of crash, by the first letter, and the variation of it,
+# by the second
+MOVEMENTS = {
+    'A': ('Overtaking and lane change', {'A': 'Pulling out or changing lane to right', 'B': 'Head on', 'C': 'Cutting in or changing lane to left', 'D': 'Lost control (overtaking vehicle)', 'E': 'Side road', 'F': 'Lost control (overtaken vehicle)', 'G': 'Weaving in heavy traffic', 'O': 'Other'}),
+    'B': ('Head on',{'A': 'On straight', 'B': 'Cutting corner', 'C': 'Swinging wide', 'D': 'Both cutting corner and swining wide, or unknown', 'E': 'Lost control on straight', 'F': 'Lost control on curve', 'O': 'Other'}),
+    'C': ('Lost control or off road (straight roads)',{'A': 'Out of control on roadway', 'B': 'Off roadway to left', 'C': 'Off roadway to right', 'O': 'Other'}),
+    'D': ('Cornering',{'A': 'Lost control turning right', 'B': 'Lost control turning left', 'C':'Missed intersection or end of road', 'O': 'Other'}),
+    'E': ('Collision with obstruction',{'A': 'Parked vehicle', 'B': 'Crash or broken down', 'C': 'Non-vehicular obstructions (including animals)', 'D': 'Workman\'s vehicle', 'E': 'Opening door', 'O': 'Other'}),
+    'F': ('Rear end',{'A': 'Slower vehicle', 'B': 'Cross traffic', 'C': 'Pedestrian', 'D': 'Queue', 'E': 'Signals', 'F': 'Other', 'O': 'Other'}),
+    'G': ('Turning versus same direction',{'A': 'Rear of left turning vehicle', 'B': 'Left turn side swipe', 'C': 'Stopped or turning from left side', 'D': 'Near centre line', 'E': 'Overtaking vehicle', 'F': 'Two turning', 'O': 'Other'}),
+    'H': ('Crossing (no turns)',{'A': 'Right angle (70 to 110 degress)', 'O': 'Other'}),
+    'J': ('Crossing (vehicle turning)',{'A': 'Right turn right side', 'B': 'Opposing right turns', 'C': 'Two turning', 'O': 'Other'}),
+    'K': ('Merging',{'A': 'Left turn in', 'B': 'Opposing right turns', 'C': 'Two turning', 'O': 'Other'}),
+    'L': ('Right turn against',{'A': 'Stopped waiting to turn', 'B': 'Making turn', 'O': 'Other'}),
+    'M': ('Manoeuvring',{'A': 'Parking or leaving', 'B': 'U turn', 'C': 'U turn', 'D': 'Driveway manoeuvre', 'E': 'Entering or leaving from opposite side', 'F': 'Enetering or leaving from same side', 'G': 'Reversing along road', 'O': 'Other'}),
+    'N': ('Pedestrians crossing road',{'A': 'Left side', 'B': 'Right side', 'C': 'Left turn left side', 'D': 'Right turn right side', 'E': 'Left turn right side', 'F': 'Right turn left side', 'G': 'Manoeuvring vehicle', 'O': 'Other'}),
+    'P': ('Pedestrians other',{'A': 'Walking with traffic', 'B': 'Walking facing traffic', 'C': 'Walking on footpath', 'D': 'Child playing (including tricycle)', 'E': 'Attending to vehicle', 'F': 'Entering or leaving vehicle', 'O': 'Other'}),
+    'Q': ('Miscellaneous',{'A': 'Fell while boarding or alighting', 'B': 'Fell from moving vehicle', 'C': 'Train', 'D': 'Parked vehicle ran away', 'E': 'Equestrian', 'F': 'Fell inside vehicle', 'G': 'Trailer or load', 'O': 'Other'})}
+
+# The key vehicle (vehicle A)
+KEY_VEHICLES = {
+    'C': 'car',
+    'V': 'van/ute',
+    'X': 'taxi/taxi van',
+    'B': 'bus',
+    'L': 'school bus',
+    '4': 'SUV/4X4',
+    'T': 'truck',
+    'M': 'motorcycle',
+    'P': 'moped',
+    'S': 'bicycle',
+    'K': 'skateboard/in-line skater/etc.',
+    'O': 'other/unknown',
+    'U': 'other/unknown',
+    'E': 'pedestrian'}
+
+# The other vehicles (vehicle B, C...)
+SECONDARY_VEHICLES = {
+    'C': 'car',
+    'V': 'van/ute',
+    'X': 'taxi/taxi van',
+    'B': 'bus',
+    'L': 'school bus',
+    '4': 'SUV/4X4',
+    'T': 'truck',
+    'M': 'motorcycle',
+    'P': 'moped',
+    'S': 'bicycle',
+    'E': 'pedestrian',
+    'K': 'skateboard/in-line skater/etc.',
+    'Q': 'equestrian',
+    'H': 'wheeled pedestrian (wheelchairs, etc.)',
+    'O': 'other/unknown'}
+
+# The parties to a crash (see nztacrash.mapVehicles())
+PARTY_VEHICLES = {
+    'C': 'car',
+    'V': 'van/ute',
+    'X': 'taxi/taxi van driver',
+    'B': 'bus',
+    'L': 'school bus',
+    '4': 'SUV/4X4',
+    'T': 'truck',
+    'M': 'motorcycle',
+    'P': 'moped',
+    'S': 'bicycle',
+    'O': 'vehicle of unknown type',
+    'U': 'vehicle of unknown type',
+    'E': 'pedestrian',
+    'K': 'skater',
+    'Q': 'equestrian',
+    'H': 'wheeled pedestrian'}
+
+# Direction of travel of the key vehicle, and the street it was on
+DIRECTIONS = {'N': 'North', 'S': 'South', 'E': 'East', 'W': 'West', '1': 'on the first street', '2': 'on the second street'}
+
+OBJECTS_STRUCK = {
+    'A': 'driven or accompanied animals, i.e. under control',
+    'B': 'bridge abutment, handrail or approach, includes tunnels',
+    'C': 'upright cliff or bank, retaining walls',
+    'D': 'debris, boulder or object dropped from vehicle',
+    'E': 'over edge of bank',
+    'F': 'fence, letterbox, hoarding etc.',
+    'G': 'guard or guide rail (including median barriers)',
+    'H': 'house or building',
+    'I': 'traffic island or median strip',
+    'J': 'public furniture, eg phone boxes, bus shelters, signal controllers, etc.',
+    'K': 'kerb, when directly contributing to incident',
+    'L': 'landslide, washout or floodwater',
+    'M': 'parked motor vehicle',
+    'N': 'train',
+    'P': 'utility pole, includes lighting columns',
+    'Q': 'broken down vehicle, workmen\'s vehicle, taxis picking up, etc.',
+    'R': 'roadwork signs or drums, holes and excavations, etc',
+    'S': 'traffic signs or signal bollards',
+    'T': 'trees, shrubbery of a substantial nature',
+    'V': 'ditch',
+    'W': 'wild animal, strays, or out of control animals',
+    'X': 'other',
+    'Y': 'objects thrown at or dropped onto vehicles',
+    'Z': 'into water, river or sea'}
+
+# Natural light (first character of LIGHT) and street lighting (second)
+LIGHT = {'B': 'Bright sun',
+         'O': 'Overcast',
+         'T': 'Twilight',
+         'D': 'Dark'}
+STREET_LIGHTS = {'O': 'street lights on',
+                 'F': 'street lights off',
+                 'N': 'No street lights present'}
+
+# Weather (first character of WTHRa) and other conditions (second)
+WEATHER = {'F': 'Fine',
+           'M': 'Mist/fog',
+           'L': 'Light rain',
+           'H': 'Heavy rain',
+           'S': 'Snow'}
+CONDITIONS = {'F': 'Frost',
+              'S': 'Strong wind'}
+
+# Junction type. When one of the vehicles involved is attempting to enter or
+# leave a driveway at an intersection location, the driveway code takes
+# precedence.
+JUNCTIONS = {'D': 'Driveway',
+             'R': 'Roundabout',
+             'X': 'Crossroads',
+             'T': 'T intersection',
+             'Y': 'Y intersection',
+             'M': 'Multi-leg intersection'}
+
+# Groups of 3-digit cause codes, by the name of the filter they set on an
+# nztacrash (and in the GeoJSON). Bit i of a crash's factor mask is set if
+# any of the codes in FACTORS[i] was cited. Add a group here to add a filter.
+FACTORS = (
+    ('tourist', ('404','731')),
+    ('alcohol', ('101','102','103','104','105')),
+    ('drugs', ('107','108','109')),
+    ('cellphone', ('359',)),
+    ('fatigue', ('410','411','412','413','414','415')),
+    ('dickhead', ('430','431','432','433','434','510','511','512','513','514','515','516','517')),
+    ('speeding', ('110','111','112','113','114','115','116','117'))
+)
+FACTOR_BITS = dict((name, 1 << i) for i, (name, codes) in enumerate(FACTORS))
+
+
+def movements(table):
+    '''Flattens MOVEMENTS to {'DA': ('Cornering', 'Lost control turning right'), ...}'''
+    flat = {}
+    for first, (category, variations) in table.items():
+        for second, variation in variations.items():
+            flat[first + second] = (category, variation)
+    return flat
+
+def factor_masks(factors=FACTORS):
+    '''Returns a tuple of the factor mask of each cause code, by number'''
+    masks = [0] * 1000
+    for i, (name, codes) in enumerate(factors):
+        for code in codes:
+            masks[cause_number(code)] |= 1 << i
+    return tuple(masks)
+
+def factor_mask(causes, masks=None):
+    '''Returns the factor mask of a crash given its `causes`, a list of cause
+    codes like ['103A', '129A', '801'] (or the string of them)'''
+    if masks is None:
+        masks = FACTOR_MASKS
+    if isinstance(causes, basestring):
+        causes = causes.split()
+    mask = 0
+    for c in causes or ():
+        if len(c) == 4:
+            c = c[:3]
+        if len(c) == 3 and c.isdigit():
+            mask |= masks[int(c)]
+    return mask
+
+def causes_csv(data):
+    '''
+    Reads a CSV, dervied from a PDF (!) of crash cause codes and their text
+    descriptions. Returns a dictionary of the codes (keys) and the values
+    (values), both as strings. Hard coded.
+    '''
+    with open(data, 'rb') as decodecsv:
+        decodereader = csv.reader(decodecsv, delimiter=',')
+        header = decodereader.next()
+        retdict = {}
+        for coderow in decodereader:
+            code = coderow[3]
+            subject = coderow[6]
+            pretty_explanation = coderow[7]
+            if subject == 'TRUE':
+                subject = True
+            elif subject == 'FALSE':
+                subject = False
+            else:
+                raise ValueError
+            if pretty_explanation in ['FALSE','',' ']:
+                pretty_explanation = None
+            retdict[code] = (subject, pretty_explanation)
+    return retdict
+
+def yaml_tables(directory=DECODERS_DIR):
+    '''Returns the YAML decoders in `directory` as CodeTables, by file name
+    (without the extension). Codes longer than one character are read as
+    cause codes.'''
+    tables = {}
+    if yaml is None:
+        return tables
+    for path in sorted(glob.glob(os.path.join(directory, '*.yaml'))):
+        with open(path) as f:
+            mapping = dict((str(code), value) for code, value in yaml.safe_load(f).items())
+        name = os.path.splitext(os.path.basename(path))[0]
+        if any(len(code) > 1 for code in mapping):
+            tables[name] = CodeTable(mapping, ordinal=cause_number, size=1000)
+        else:
+            tables[name] = CodeTable(mapping)
+    return tables
+
+
+FACTOR_MASKS = factor_masks()
+
+DECODERS = {
+    'movement': CodeTable(movements(MOVEMENTS), ordinal=letter_pair, size=26*26),
+    'key_vehicle': CodeTable(KEY_VEHICLES),
+    'secondary_vehicle': CodeTable(SECONDARY_VEHICLES),
+    'party_vehicle': CodeTable(PARTY_VEHICLES),
+    'direction': CodeTable(DIRECTIONS),
+    'objects_struck': CodeTable(OBJECTS_STRUCK),
+    'light': CodeTable(LIGHT),
+    'street_lights': CodeTable(STREET_LIGHTS),
+    'weather': CodeTable(WEATHER),
+    'conditions': CodeTable(CONDITIONS),
+    'junction': CodeTable(JUNCTIONS)
+}
+if os.path.exists(os.path.join(DECODERS_DIR, 'cause-decoder.csv')):
+    DECODERS['cause'] = CodeTable(causes_csv(os.path.join(DECODERS_DIR, 'cause-decoder.csv')),
+                                  ordinal=cause_number, size=1000)
+DECODERS.update(yaml_tables())
+
+
+def decode(column, codes):
+    '''
+    Decodes a whole column of `codes` with the decoder named `column` (a key
+    of DECODERS), e.g. decode('light', ['B', 'D', 'O']). `codes` is a
+    sequence of codes, or a NumPy array of single-character codes or of
+    ordinals, in which case this returns an object array. Unknown codes
+    decode to None.
+    '''
+    return DECODERS[column].decode_all(codes)
+
+
+if __name__ == '__main__':
+    for name in sorted(DECODERS.keys()):
+        print ('%s: %d codes' % (name, len(DECODERS[name].codes)))
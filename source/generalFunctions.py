@@ -11,7 +11,11 @@ Depends
 datetime
 '''
 
+import os
+import shutil
 import datetime
+from collections import OrderedDict
+from itertools import islice
 
 def empty(string):
     if string in ['', ' ', None]:
@@ -56,53 +60,121 @@ def formatCrashTime(crashtime, dateobj):
         # TODO log
         return None
 
-def check_offroad(crash_road):
-    '''Applies a check for 'Z': the flat for offroad indicator, and corrects
-    strings representing these places so that they're a bit nicer to read.'''
-    if 'Z' in crash_road.split(' '):
-        # The crash was off-road
-        # Apply some special formatting to make this read nicely
-        # 1. Remove the now-superfluous 'Z'
-        crash_road = crash_road.split(' ')
-        crash_road.remove('Z')
-        # 2. Special exception for the use of 'Beach' at the beginning of some locations
-        if crash_road[0] == 'Beach' and len(crash_road) > 1:
-            crash_road = crash_road[1:] + [crash_road[0]]
-        #. 3. Expand the off-road abbreviations
-        patterns = {'CPK': 'Carpark',
+# Off-road location abbreviations, as used with the 'Z' (off-road) flag
+OFFROAD_PATTERNS = {'CPK': 'Carpark',
                     'BCH': 'Beach',
                     'DWY': 'Driveway',
                     'DWAY': 'Driveway',
                     'FCT': 'Forecourt'}
-        for i, r in enumerate(crash_road):
-            if r.upper() in patterns.keys():
-                crash_road = crash_road[:i] + crash_road[i+1:] + [patterns[r.upper()], '(off-roadway)']
-                break
-        # Join it back up to a proper description
-        crash_road = ' '.join(crash_road)
+
+def check_offroad(crash_road):
+    '''Applies a check for 'Z': the flat for offroad indicator, and corrects
+    strings representing these places so that they're a bit nicer to read.'''
+    if 'Z' in crash_road.split(' '):
+        crash_road = ' '.join(offroadTokens(crash_road.split(' ')))
     return crash_road
 
-def streetExpander(road,streetdecoder):
+def offroadTokens(crash_road):
+    '''As check_offroad(), for a road split into a list of words that
+    includes 'Z'. Returns a new list.'''
+    # The crash was off-road
+    # Apply some special formatting to make this read nicely
+    # 1. Remove the now-superfluous 'Z'
+    crash_road = list(crash_road)
+    crash_road.remove('Z')
+    # 2. Special exception for the use of 'Beach' at the beginning of some locations
+    if crash_road[0] == 'Beach' and len(crash_road) > 1:
+        crash_road = crash_road[1:] + [crash_road[0]]
+    #. 3. Expand the off-road abbreviations
+    for i, r in enumerate(crash_road):
+        if r.upper() in OFFROAD_PATTERNS:
+            crash_road = crash_road[:i] + crash_road[i+1:] + [OFFROAD_PATTERNS[r.upper()], '(off-roadway)']
+            break
+    return crash_road
+
+def expanderFor(streetdecoder):
+    '''Returns a StreetExpander of `streetdecoder`: the same one as last
+    time if it is the same decoder (or an equal one), so that it is only
+    built once. A decoder changed in place since is not noticed.'''
+    decoder, expander = LAST_EXPANDER
+    if streetdecoder is not decoder:
+        if streetdecoder != decoder:
+            expander = StreetExpander(streetdecoder)
+        LAST_EXPANDER[:] = [streetdecoder, expander]
+    return expander
+
+def streetExpander(road, streetdecoder):
     '''Input: 'St John St' (for example)
-    Output: St John Street'''
-    # First, check St isn't the first element in a street name
-    check = road.replace('near ','').replace('at ','')
-    if check.split(' ')[0] == 'St' and 'St' not in check.split(' ')[1:]:
-        # Then don't repalce the St as it means Saint and there is not Street in title
-        return road
-    # Otherwise, there are two instances of "St" and we want to only replace the second one
-    road = road.split(' ')
-    processed = []
-    road.reverse() # Flip order
-    for i, elem in enumerate(road):
-        # Do it in reverse so only the last instance of a road shortning trope
-        # gets expanded. This prevents "St John St" becoming "Street John
-        # Street" rather than "St John Street"
-        if (elem in streetdecoder.keys()) and (elem not in processed):
-            processed.append(elem)
-            road[i] = streetdecoder[elem]
-    road.reverse() # Back to original order
-    return ' '.join(road)
+    Output: St John Street
+    (see StreetExpander.expand())'''
+    return expanderFor(streetdecoder).expand(road)
+
+def formatRoad(road, streetdecoder):
+    '''Returns a road name from the CSV in a readable form: in title case
+    (except State Highways and two-letter acronyms), with off-road locations
+    reworded (see check_offroad()) and street types expanded (see
+    streetExpander()). Returns None if the road is empty.
+    For many roads, use a RoadCache, which also keeps the results.'''
+    return expanderFor(streetdecoder).format(road)
+
+# Words in road names that formatNiceRoad() keeps as acronyms, or expands
+KNOWN_ACRONYMS = frozenset(['BP', 'VTNZ'])
+KNOWN_ABBREVIATIONS = {'Coun': 'Countdown',
+    'C/Down': 'Countdown',
+    'Reserv': 'Reserve',
+    'Stn': 'Station',
+    'Roa': 'Road',
+    'S': 'South',
+    'E': 'East',
+    'W': 'West',
+    'N': 'North',
+    'Riv': 'River',
+    'Br': 'Bridge',
+    'Wbd': 'Westbound',
+    'Ebd': 'Eastbound',
+    'Nbd': 'Northbound',
+    'Sbd': 'Southbound',
+    'Obr': 'Overbridge',
+    'Off': 'Off-ramp',
+    'On': 'On-ramp',
+    'Xing': 'Crossing',
+    'Mckays': 'McKays',
+    'Rly': 'Railway',
+    'Int': 'Interchange'}
+
+# The words that formatNiceRoad() changes (besides those with brackets): the
+# known acronyms and abbreviations, in lower case
+NICE_WORDS = frozenset([w.lower() for w in KNOWN_ACRONYMS] +
+                       [w.lower() for w in KNOWN_ABBREVIATIONS if w == w.title()])
+
+def stripLinearRef(linref):
+    '''Fixes references to State Highways, by removing the linear referencing information'''
+    if '/' not in linref:
+        # Not a SH
+        return linref
+    elif '/' in linref:
+        try:
+            int(linref[0])
+        except:
+            # Not a SH, just has a slash
+            return linref
+    # Remaining are State Highways
+    if len(linref.split(' ')) > 1 and ' at ' not in linref:
+        # There is other location information included
+        linref = linref.split(' ')[0] + ' (%s)' % ' '.join(linref.split(' ')[1:]).replace(' SH ',' State Highway ')
+    if ' at ' not in linref:
+        # SH without an intersection
+        SH = linref.split(' ')
+        SH = "State Highway %s " % SH[0].split('/')[0] + ' '.join(SH[1:])
+    else:
+        # SH with an intersection
+        linref = linref.split(' at ')
+        linref = [linref[0],'at',linref[1]]
+        for i, r in enumerate(linref):
+            if '/' in r:
+                linref[i] = "State Highway %s" % r.split('/')[0]
+        SH = ' '.join(linref)
+    return SH
 
 def formatNiceRoad(road):
     '''Takes a location expressed as a road, or a street or a highway... and
@@ -112,91 +184,157 @@ def formatNiceRoad(road):
     CPK = car park
     BCH = beach
     DWY = driveway
-    DWAY = driveway'''
+    DWAY = driveway
+    (see StreetExpander.nice())'''
+    return NICE_EXPANDER.nice(road)
 
-    def striplinearref(linref):
-        '''Fixes references to State Highways, by removing the linear referencing information'''
-        if '/' not in linref:
-            # Not a SH
-            return linref
-        elif '/' in linref:
-            try:
-                int(linref[0])
-            except:
-                # Not a SH, just has a slash
-                return linref
-        # Remaining are State Highways
-        if len(linref.split(' ')) > 1 and ' at ' not in linref:
-            # There is other location information included
-            linref = linref.split(' ')[0] + ' (%s)' % ' '.join(linref.split(' ')[1:]).replace(' SH ',' State Highway ')
-        if ' at ' not in linref:
-            # SH without an intersection
-            SH = linref.split(' ')
-            SH = "State Highway %s " % SH[0].split('/')[0] + ' '.join(SH[1:])
+class StreetExpander(object):
+    '''
+    I format road names (see formatRoad(), streetExpander() and
+    formatNiceRoad()), with everything I look words up in built once: the
+    `streetdecoder` (output of streetDecoderCSV()), NICE_WORDS, and a table
+    of the nice form of each word, filled in as words are first seen. Roads
+    are then expanded in one pass over their words.
+    '''
+    def __init__(self, streetdecoder):
+        self.streets = dict(streetdecoder)
+        self.words = {}
+
+    def expand(self, road):
+        '''Expands the abbreviated street types of `road`, but not a leading
+        St that means Saint'''
+        return self.expand_words(road.split(' '), road)
+
+    def expand_words(self, words, road):
+        '''Expands the `words` of `road` (' '.join(words)) in one pass'''
+        # Saint rule: a leading St is Saint, unless it is the only St
+        if words[0] == 'St' or 'at ' in road or 'near ' in road:
+            first, _, rest = road.replace('near ','').replace('at ','').partition(' ')
+            if first == 'St' and ' St ' not in ' %s ' % rest:
+                return road
+        # Otherwise, only the last of each abbreviation is expanded, so that
+        # "St John St" becomes "St John Street"
+        streets = self.streets
+        last = {}
+        for i, word in enumerate(words):
+            if word in streets:
+                last[word] = i
+        if not last:
+            return road
+        words = list(words)
+        for word, i in last.iteritems():
+            words[i] = streets[word]
+        return ' '.join(words)
+
+    def format(self, road):
+        '''Returns `road` from the CSV in a readable form, or None if it is
+        empty (see formatRoad())'''
+        road = formatString(road)
+        if road is None:
+            return None
+        if road[0:3] != 'SH ' and (len(road) != 2 or road == 'TE'):
+            road = road.title()
+        words = road.split(' ')
+        if 'Z' in words:
+            words = offroadTokens(words)
+            road = ' '.join(words)
+        return self.expand_words(words, road)
+
+    def word(self, word):
+        '''Returns the nice form of a word (see formatNiceRoad())'''
+        try:
+            return self.words[word]
+        except KeyError:
+            pass
+        rd = word.replace('(','').replace(')','')
+        if rd.upper() in KNOWN_ACRONYMS:
+            rd = rd.upper()
+        if rd.title() in KNOWN_ABBREVIATIONS:
+            rd = KNOWN_ABBREVIATIONS[rd.title()]
+        if '(' in word:
+            rd = '(%s' % rd
+        if ')' in word:
+            rd = '%s)' % rd
+        self.words[word] = rd
+        return rd
+
+    def nice(self, road):
+        '''Returns `road` with State Highway linear references made
+        readable, known acronyms kept and abbreviations expanded (see
+        formatNiceRoad())'''
+        if '/' in road:
+            # Perhaps a State Highway linear reference
+            road = stripLinearRef(road)
+        word = self.word
+        return ' '.join([word(w) if (w.lower() in NICE_WORDS or '(' in w or ')' in w) else w
+                         for w in road.split(' ')])
+
+# Formats nice roads for formatNiceRoad()
+NICE_EXPANDER = StreetExpander({})
+
+# The last streetdecoder given to expanderFor(), and its StreetExpander
+LAST_EXPANDER = [None, None]
+
+class RoadCache(object):
+    '''
+    Memoises formatRoad() and formatNiceRoad() (with a StreetExpander):
+    road names repeat a lot across crashes, so each distinct one is
+    formatted only once.
+
+    At most `maxsize` roads are kept for each, evicting the least recently
+    used; a `maxsize` of 0 keeps none, formatting every road. hits, misses and evictions count lookups since the cache was
+    created (see stats()).
+    '''
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.roads = OrderedDict()
+        self.nice_roads = OrderedDict()
+        self.streetdecoder = None
+        self.expander = StreetExpander({})
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def lookup(self, cache, key, function, *args):
+        '''Returns cache[key], or function(*args) if it is missing, which is
+        then kept as the most recently used entry of `cache`'''
+        value = cache.pop(key, self)
+        if value is self:
+            self.misses += 1
+            value = function(*args)
+            if self.maxsize < 1:
+                return value
+            while len(cache) >= self.maxsize:
+                cache.popitem(last=False)
+                self.evictions += 1
         else:
-            # SH with an intersection
-            linref = linref.split(' at ')
-            linref = [linref[0],'at',linref[1]]
-            for i, r in enumerate(linref):
-                if '/' in r:
-                    linref[i] = "State Highway %s" % r.split('/')[0]
-            SH = ' '.join(linref)
-        return SH
-
-    def expander(road):
-        '''Takes `road' (street of crash as ordered list of strings) and runs
-        them past checks for acronyms and abbreviations known to exist in the data.
-        Acronyms are kept as acronyms, and abbreviations are expanded. Returns a
-        string (not the list), joined with spaces.'''
-        knownAcronyms = ['BP', 'VTNZ'] # Ensure acronyms stay acronyms
-        knownAbbreviations = {'Coun': 'Countdown',
-            'C/Down': 'Countdown',
-            'Reserv': 'Reserve',
-            'Stn': 'Station',
-            'Roa': 'Road',
-            'S': 'South',
-            'E': 'East',
-            'W': 'West',
-            'N': 'North',
-            'Riv': 'River',
-            'Br': 'Bridge',
-            'Wbd': 'Westbound',
-            'Ebd': 'Eastbound',
-            'Nbd': 'Northbound',
-            'Sbd': 'Southbound',
-            'Obr': 'Overbridge',
-            'Off': 'Off-ramp',
-            'On': 'On-ramp',
-            'Xing': 'Crossing',
-            'Mckays': 'McKays',
-            'Rly': 'Railway',
-            'Int': 'Interchange'}
-        for i, r in enumerate(road):
-            # Check for "knownAbbreviations" requires no brackets around term
-            rd, left, right = r, False, False
-            if '(' in rd:
-                left = True
-                rd = rd.replace('(','')
-            if ')' in rd:
-                right = True
-                rd = rd.replace(')','')
-            # Check acronyms
-            if rd.upper() in knownAcronyms:
-                rd = rd.upper()
-            # Check abbreviations
-            if rd.title() in knownAbbreviations.keys():
-                rd = knownAbbreviations[rd.title()]
-            # Put brackets back, if neccessary
-            if left:
-                rd = '(%s' % rd
-            if right:
-                rd = '%s)' % rd
-            # Update the element in road with the changes
-            road[i] = rd
-        # Join road to a single string and return
-        return ' '.join(road)
+            self.hits += 1
+        cache[key] = value
+        return value
+
+    def road(self, road, streetdecoder):
+        '''Cached equivalent of formatRoad(). Changing `streetdecoder` clears
+        the cache, but the same decoder read again does not.'''
+        if streetdecoder is not self.streetdecoder:
+            if streetdecoder != self.streetdecoder:
+                self.roads.clear()
+                self.expander = StreetExpander(streetdecoder)
+            self.streetdecoder = streetdecoder
+        return self.lookup(self.roads, road, self.expander.format, road)
 
-    return expander(striplinearref(road).split(' '))
+    def nice(self, road):
+        '''Cached equivalent of formatNiceRoad()'''
+        return self.lookup(self.nice_roads, road, self.expander.nice, road)
+
+    def stats(self):
+        '''Returns a dictionary of the cache's size, hits, misses, evictions
+        and hit rate'''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.roads) + len(self.nice_roads),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else None
+        }
 
 def formatStringList(listofstrings, delim=None):
     '''Returns a list of strings given a string representation of a list data
@@ -231,3 +369,170 @@ def grammar(singular, plural, integer):
         return singular
     elif integer > 1:
         return plural
+
+def chunks(iterable, size):
+    '''Yields successive lists of (at most) `size` items from `iterable`,
+    without reading more than one list into memory at a time.
+    Example:
+    list(chunks('abcde', 2)) >>> [['a', 'b'], ['c', 'd'], ['e']]'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def check_replaceable(directory):
+    '''Raises ValueError unless `directory` is one that an output directory
+    may replace: one that does not exist yet, is empty, or holds the
+    manifest.json of an earlier run (see replace_directory())'''
+    if not os.path.exists(directory):
+        return
+    if not os.path.isdir(directory):
+        raise ValueError('%s is not a directory' % directory)
+    if os.listdir(directory) and not os.path.isfile(os.path.join(directory, 'manifest.json')):
+        raise ValueError('%s is not empty, and was not written by an earlier run '
+                         '(it has no manifest.json), so will not be replaced' % directory)
+
+def building_directory(directory):
+    '''Makes and returns a new, empty directory beside `directory`, in which
+    to build its replacement (see replace_directory())'''
+    building = '%s.%d.tmp' % (os.path.abspath(directory), os.getpid())
+    if os.path.isdir(building):
+        # Left by an earlier run that failed
+        shutil.rmtree(building)
+    os.makedirs(building)
+    return building
+
+def replace_directory(directory, building):
+    '''Replaces `directory` (if it exists) with the directory `building`,
+    so that nothing is left of what was in it before. `directory` must be
+    replaceable (see check_replaceable()).'''
+    check_replaceable(directory)
+    directory = os.path.abspath(directory)
+    if os.path.isdir(directory):
+        old = '%s.old' % building
+        os.rename(directory, old)
+        os.rename(building, directory)
+        shutil.rmtree(old)
+    else:
+        os.rename(building, directory)
+
+if __name__ == '__main__':
+    # Compare StreetExpander with the word-by-word formatting it replaced,
+    # on every distinct road (and road at/near side road) in the shipped CSV
+    import csv
+    import time
+
+    def baseline_check_offroad(crash_road):
+        '''check_offroad() as it was before StreetExpander'''
+        if 'Z' in crash_road.split(' '):
+            crash_road = crash_road.split(' ')
+            crash_road.remove('Z')
+            if crash_road[0] == 'Beach' and len(crash_road) > 1:
+                crash_road = crash_road[1:] + [crash_road[0]]
+            patterns = {'CPK': 'Carpark',
+                        'BCH': 'Beach',
+                        'DWY': 'Driveway',
+                        'DWAY': 'Driveway',
+                        'FCT': 'Forecourt'}
+            for i, r in enumerate(crash_road):
+                if r.upper() in patterns.keys():
+                    crash_road = crash_road[:i] + crash_road[i+1:] + [patterns[r.upper()], '(off-roadway)']
+                    break
+            crash_road = ' '.join(crash_road)
+        return crash_road
+
+    def baseline_street_expander(road, streetdecoder):
+        '''streetExpander() as it was before StreetExpander'''
+        check = road.replace('near ','').replace('at ','')
+        if check.split(' ')[0] == 'St' and 'St' not in check.split(' ')[1:]:
+            return road
+        road = road.split(' ')
+        processed = []
+        road.reverse()
+        for i, elem in enumerate(road):
+            if (elem in streetdecoder.keys()) and (elem not in processed):
+                processed.append(elem)
+                road[i] = streetdecoder[elem]
+        road.reverse()
+        return ' '.join(road)
+
+    def baseline_format_road(road, streetdecoder):
+        '''nztacrash.get_crash_road() as it was before formatRoad()'''
+        road = formatString(road)
+        if road is None:
+            # It then failed in check_offroad()
+            return None
+        if road[0:3] != 'SH ':
+            if len(road) == 2 and road != 'TE':
+                road = road # Acronym, don't apply title()
+            else:
+                road = road.title()
+        road = baseline_check_offroad(road)
+        return baseline_street_expander(road, streetdecoder)
+
+    def baseline_format_nice_road(road):
+        '''formatNiceRoad() as it was before StreetExpander, except that
+        its striplinearref() is stripLinearRef() (the same code), and its
+        abbreviations KNOWN_ABBREVIATIONS rather than built on every call'''
+        knownAcronyms = ['BP', 'VTNZ']
+        knownAbbreviations = KNOWN_ABBREVIATIONS
+        road = stripLinearRef(road).split(' ')
+        for i, r in enumerate(road):
+            rd, left, right = r, False, False
+            if '(' in rd:
+                left = True
+                rd = rd.replace('(','')
+            if ')' in rd:
+                right = True
+                rd = rd.replace(')','')
+            if rd.upper() in knownAcronyms:
+                rd = rd.upper()
+            if rd.title() in knownAbbreviations.keys():
+                rd = knownAbbreviations[rd.title()]
+            if left:
+                rd = '(%s' % rd
+            if right:
+                rd = '%s)' % rd
+            road[i] = rd
+        return ' '.join(road)
+
+    with open('../data/decoders/NZ-post-street-types.csv', 'rb') as decodecsv:
+        decodereader = csv.reader(decodecsv, delimiter=',')
+        header = decodereader.next()
+        streetdecoder = dict((row[1], row[0]) for row in decodereader)
+    with open('../data/crash-data-2015-partial.csv', 'rb') as crashcsv:
+        crashreader = csv.reader(crashcsv, delimiter=',')
+        header = crashreader.next()
+        rows = list(crashreader)
+    roads = sorted(set(row[1] for row in rows) | set(row[5] for row in rows))
+
+    formatted = [baseline_format_road(road, streetdecoder) for road in roads]
+    formatted = [road for road in formatted if road is not None]
+    expander = StreetExpander(streetdecoder)
+    assert formatted == [r for r in (expander.format(road) for road in roads) if r is not None]
+    assert formatted == [r for r in (formatRoad(road, streetdecoder) for road in roads) if r is not None]
+    nice = [baseline_format_nice_road(road) for road in formatted]
+    assert nice == [expander.nice(road) for road in formatted]
+    assert nice == [formatNiceRoad(road) for road in formatted]
+
+    def best_of(f, repeat=50):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            f()
+            times.append(time.time() - start)
+        return min(times) * 1000
+
+    print ('%d distinct roads:' % len(roads))
+    for name, baseline, function, method, inputs in (
+            ('formatRoad', lambda road: baseline_format_road(road, streetdecoder),
+             lambda road: formatRoad(road, streetdecoder), 'format', roads),
+            ('formatNiceRoad', baseline_format_nice_road, formatNiceRoad, 'nice', formatted)):
+        old = best_of(lambda: [baseline(road) for road in inputs])
+        new = best_of(lambda: [function(road) for road in inputs])
+        # Timed from scratch each time, including building the expander
+        method_time = best_of(lambda: map(getattr(StreetExpander(streetdecoder), method), inputs))
+        print ('  %s: baseline %.1fms, now %.1fms (%.1fx faster); StreetExpander.%s %.1fms (%.1fx faster)' %
+            (name, old, new, old / new, method, method_time, old / method_time))
@@ -21,15 +21,30 @@ http://www.fourmilab.ch/
 The functions of primary interest provided by this module are phase(),
 which gives you a variety of data on the status of the moon for a
 given date; and phase_hunt(), which given a date, finds the dates of
-the nearest full moon, new moon, etc.
+the nearest full moon, new moon, etc. phase_array() and
+phase_string_array() do the same as phase() and phase_string() for
+whole arrays of dates at once. Within the years covered by the
+LunationTable (2000-2030, the span of the crash data), phase_hunt()
+looks the phases up in a precomputed table instead of searching for
+them, and last_phase() and days_since() find, e.g., the most recent
+full moon before a date.
+
+Dates may be given as standard library datetime objects, as plain
+Julian Day Numbers, or as mx.DateTime objects. mx.DateTime is no
+longer needed, but is still understood where it is installed.
 """
 
 from math import sin, cos, floor, sqrt, pi, tan, atan # asin, atan2
 import bisect
+import datetime
+import numpy as np
 try:
     import DateTime
 except ImportError:
-    from mx import DateTime
+    try:
+        from mx import DateTime
+    except ImportError:
+        DateTime = None
 
 __TODO__ = [
     'Add command-line interface.',
@@ -50,7 +65,7 @@ class MoonPhase:
     """I describe the phase of the moon.
 
     I have the following properties:
-        date - a DateTime instance
+        date - a datetime (or mx.DateTime) instance
         phase - my phase, in the range 0.0 .. 1.0
         phase_text - a string describing my phase
         illuminated - the percentage of the face of the moon illuminated
@@ -64,18 +79,21 @@ class MoonPhase:
         nextnew_date - the date of the next new moon
     """
 
-    def __init__(self, date=DateTime.now()):
+    def __init__(self, date=None):
         """MoonPhase constructor.
 
-        Give me a date, as either a Julian Day Number or a DateTime
-        object."""
+        Give me a date, as either a Julian Day Number, a datetime or a
+        DateTime object. Defaults to now."""
 
-        if not isinstance(date, DateTime.DateTimeType):
-            self.date = DateTime.DateTimeFromJDN(date)
+        if date is None:
+            date = datetime.datetime.now()
+
+        if isinstance(date, (int, long, float)):
+            self.date = jdn_to_datetime(date)
         else:
             self.date = date
 
-        self.__dict__.update(phase(self.date))
+        self.__dict__.update(phase(date))
 
         self.phase_text = phase_string(self.phase)
 
@@ -90,20 +108,11 @@ class MoonPhase:
         raise AttributeError(a)
 
     def __repr__(self):
-        if type(self.date) is int:
-            jdn = self.date
-        else:
-            jdn = self.date.jdn
-
-        return "<%s(%d)>" % (self.__class__, jdn)
+        return "<%s(%d)>" % (self.__class__, to_jdn(self.date))
 
     def __str__(self):
-        if type(self.date) is int:
-            d = DateTime.DateTimeFromJDN(self.date)
-        else:
-            d = self.date
         s = "%s for %s, %s (%%%.2f illuminated)" %\
-            (self.__class__, d.strftime(), self.phase_text,
+            (self.__class__, self.date.strftime('%c'), self.phase_text,
              self.illuminated * 100)
 
         return s
@@ -169,6 +178,46 @@ class AstronomicalConstants:
 
 c = AstronomicalConstants()
 
+# Julian Day Number of 0001-01-01 00:00, day 1 of the proleptic Gregorian
+# calendar of datetime.date.toordinal()
+ORDINAL_EPOCH_JDN = 1721424.5
+
+def to_jdn(date):
+    """Returns the Julian Day Number of a date, given as a datetime,
+    date, mx.DateTime (or anything else with a jdn) or a number, which
+    is taken to be a Julian Day Number already. Pure arithmetic, so it
+    is much cheaper than going through mx.DateTime."""
+
+    if hasattr(date, 'jdn'):
+        return date.jdn
+    if isinstance(date, datetime.datetime):
+        return (date.toordinal() + ORDINAL_EPOCH_JDN +
+            (date.hour * 3600 + date.minute * 60 + date.second +
+             date.microsecond / 1e6) / 86400.0)
+    if isinstance(date, datetime.date):
+        return date.toordinal() + ORDINAL_EPOCH_JDN
+    return float(date)
+
+def jdn_to_datetime(jdn):
+    """Returns the datetime of a Julian Day Number, to the nearest
+    microsecond."""
+
+    days = jdn - ORDINAL_EPOCH_JDN
+    ordinal = int(floor(days))
+    microseconds = int(round((days - ordinal) * 86400e6))
+    return (datetime.datetime.fromordinal(ordinal) +
+        datetime.timedelta(microseconds=microseconds))
+
+def from_jdn(jdn, like):
+    """Returns a Julian Day Number as the same kind of date as `like`:
+    an mx.DateTime, a datetime, or a number."""
+
+    if hasattr(like, 'jdn') and DateTime is not None:
+        return DateTime.DateTimeFromJDN(jdn)
+    if isinstance(like, datetime.date):
+        return jdn_to_datetime(jdn)
+    return jdn
+
 # Little handy mathematical functions.
 
 fixangle = lambda a: a - 360.0 * floor(a/360.0)
@@ -176,29 +225,41 @@ torad = lambda d: d * pi / 180.0
 todeg = lambda r: r * 180.0 / pi
 dsin = lambda d: sin(torad(d))
 dcos = lambda d: cos(torad(d))
+fixangle_array = lambda a: a - 360.0 * np.floor(a/360.0)
+
+phase_strings = (
+    (NEW + PRECISION, "new"),
+    (FIRST - PRECISION, "waxing crescent"),
+    (FIRST + PRECISION, "first quarter"),
+    (FULL - PRECISION, "waxing gibbous"),
+    (FULL + PRECISION, "full"),
+    (LAST - PRECISION, "waning gibbous"),
+    (LAST + PRECISION, "last quarter"),
+    (NEXTNEW - PRECISION, "waning crescent"),
+    (NEXTNEW + PRECISION, "new"))
 
 def phase_string(p):
-    phase_strings = (
-        (NEW + PRECISION, "new"),
-        (FIRST - PRECISION, "waxing crescent"),
-        (FIRST + PRECISION, "first quarter"),
-        (FULL - PRECISION, "waxing gibbous"),
-        (FULL + PRECISION, "full"),
-        (LAST - PRECISION, "waning gibbous"),
-        (LAST + PRECISION, "last quarter"),
-        (NEXTNEW - PRECISION, "waning crescent"),
-        (NEXTNEW + PRECISION, "new"))
-
     i = bisect.bisect([a[0] for a in phase_strings], p)
 
     return phase_strings[i][1]
 
 
-def phase(phase_date=DateTime.now()):
+def phase_string_array(p):
+    """Vectorised phase_string(): returns an array of the strings
+    describing each of the phases in the array p."""
+
+    bounds = np.array([a[0] for a in phase_strings])
+    names = np.array([a[1] for a in phase_strings])
+
+    return names[np.searchsorted(bounds, p, side='right')]
+
+
+def phase(phase_date=None):
     """Calculate phase of moon as a fraction:
 
     The argument is the time for which the phase is requested,
-    expressed in either a DateTime or by Julian Day Number.
+    expressed in either a datetime, a DateTime or by Julian Day Number
+    (see to_jdn()). Defaults to now.
 
     Returns a dictionary containing the terminator phase angle as a
     percentage of a full circle (i.e., 0 to 1), the illuminated
@@ -209,11 +270,11 @@ def phase(phase_date=DateTime.now()):
 
     # Calculation of the Sun's position
 
+    if phase_date is None:
+        phase_date = datetime.datetime.now()
+
     # date within the epoch
-    if hasattr(phase_date, "jdn"):
-        day = phase_date.jdn - c.epoch
-    else:
-        day = phase_date - c.epoch
+    day = to_jdn(phase_date) - c.epoch
 
     # Mean anomaly of the Sun
     N = fixangle((360/365.2422) * day)
@@ -327,25 +388,125 @@ def phase(phase_date=DateTime.now()):
 # phase()
 
 
-def phase_hunt(sdate=DateTime.now()):
+def phase_array(jdn):
+    """Vectorised phase(): the argument is an array of times, expressed
+    as Julian Day Numbers. Returns a dictionary with the same keys as
+    phase(), each an array of values for the corresponding times."""
+
+    # Calculation of the Sun's position
+
+    # date within the epoch
+    day = np.asarray(jdn, dtype=np.float64) - c.epoch
+
+    # Mean anomaly of the Sun
+    N = fixangle_array((360/365.2422) * day)
+    # Convert from perigee coordinates to epoch 1980
+    M = fixangle_array(N + c.ecliptic_longitude_epoch - c.ecliptic_longitude_perigee)
+
+    # Solve Kepler's equation
+    Ec = kepler_array(M, c.eccentricity)
+    Ec = sqrt((1 + c.eccentricity) / (1 - c.eccentricity)) * np.tan(Ec/2.0)
+    # True anomaly
+    Ec = 2 * np.degrees(np.arctan(Ec))
+    # Suns's geometric ecliptic longuitude
+    lambda_sun = fixangle_array(Ec + c.ecliptic_longitude_perigee)
+
+    # Orbital distance factor
+    F = ((1 + c.eccentricity * np.cos(np.radians(Ec))) / (1 - c.eccentricity**2))
+
+    # Distance to Sun in km
+    sun_dist = c.sun_smaxis / F
+    sun_angular_diameter = F * c.sun_angular_size_smaxis
+
+    # Calculation of the Moon's position
+
+    # Moon's mean longitude
+    moon_longitude = fixangle_array(13.1763966 * day + c.moon_mean_longitude_epoch)
+
+    # Moon's mean anomaly
+    MM = fixangle_array(moon_longitude - 0.1114041 * day - c.moon_mean_perigee_epoch)
+
+    evection = 1.2739 * np.sin(np.radians(2*(moon_longitude - lambda_sun) - MM))
+
+    # Annual equation
+    annual_eq = 0.1858 * np.sin(np.radians(M))
+
+    # Correction term
+    A3 = 0.37 * np.sin(np.radians(M))
+
+    MmP = MM + evection - annual_eq - A3
+
+    # Correction for the equation of the centre
+    mEc = 6.2886 * np.sin(np.radians(MmP))
+
+    # Another correction term
+    A4 = 0.214 * np.sin(np.radians(2 * MmP))
+
+    # Corrected longitude
+    lP = moon_longitude + evection + mEc - annual_eq + A4
+
+    # Variation
+    variation = 0.6583 * np.sin(np.radians(2*(lP - lambda_sun)))
+
+    # True longitude
+    lPP = lP + variation
+
+    # Calculation of the phase of the Moon
+
+    # Age of the Moon, in degrees
+    moon_age = lPP - lambda_sun
+
+    # Phase of the Moon
+    moon_phase = (1 - np.cos(np.radians(moon_age))) / 2.0
+
+    # Calculate distance of Moon from the centre of the Earth
+    moon_dist = (c.moon_smaxis * (1 - c.moon_eccentricity**2))\
+                / (1 + c.moon_eccentricity * np.cos(np.radians(MmP + mEc)))
+
+    # Calculate Moon's angular diameter
+    moon_diam_frac = moon_dist / c.moon_smaxis
+    moon_angular_diameter = c.moon_angular_size / moon_diam_frac
+
+    res = {
+        'phase': fixangle_array(moon_age) / 360.0,
+        'illuminated': moon_phase,
+        'age': c.synodic_month * fixangle_array(moon_age) / 360.0 ,
+        'distance': moon_dist,
+        'angular_diameter': moon_angular_diameter,
+        'sun_distance': sun_dist,
+        'sun_angular_diameter': sun_angular_diameter
+        }
+
+    return res
+# phase_array()
+
+
+def phase_hunt(sdate=None):
     """Find time of phases of the moon which surround the current date.
 
     Five phases are found, starting and ending with the new moons
-    which bound the current lunation.
+    which bound the current lunation. They are returned as the same
+    kind of date as sdate (see from_jdn()), which defaults to now.
     """
 
-    if not hasattr(sdate,'jdn'):
-        sdate = DateTime.DateTimeFromJDN(sdate)
+    if sdate is None:
+        sdate = datetime.datetime.now()
+    like = sdate
+
+    sdate = to_jdn(sdate)
+
+    phases = lunation_table().hunt(sdate)
+    if phases is not None:
+        return [from_jdn(p, like) for p in phases]
 
-    adate = sdate + DateTime.RelativeDateTime(days=-45)
+    adate = sdate - 45
+    ayear = jdn_to_datetime(adate)
 
-    k1 = floor((adate.year + ((adate.month - 1) * (1.0/12.0)) - 1900) * 12.3685)
+    k1 = floor((ayear.year + ((ayear.month - 1) * (1.0/12.0)) - 1900) * 12.3685)
 
     nt1 = meanphase(adate, k1)
     adate = nt1
 
-    sdate = sdate.jdn
-
     while 1:
         adate = adate + c.synodic_month
         k2 = k1 + 1
@@ -355,14 +516,128 @@ def phase_hunt(sdate=DateTime.now()):
         nt1 = nt2
         k1 = k2
 
-    phases = list(map(truephase,
+    phases = [from_jdn(truephase(k, p), like) for k, p in zip(
                  [k1,    k1,    k1,    k1,    k2],
-                 [0/4.0, 1/4.0, 2/4.0, 3/4.0, 0/4.0]))
+                 [0/4.0, 1/4.0, 2/4.0, 3/4.0, 0/4.0])]
 
     return phases
 # phase_hunt()
 
 
+class LunationTable:
+    """I am a sorted table of the true times (as Julian Day Numbers) of
+    every new moon, first quarter, full moon and last quarter from the
+    start of the year first_year to the end of the year last_year, so
+    that finding the phases around a date is a binary search.
+
+    I have the following properties:
+        ks - the lunation numbers K (see meanphase()), in order
+        mean_new - the mean new moon of each lunation, which bounds the
+                   lunations in phase_hunt()
+        phases - a list of the five true phase times found by
+                 phase_hunt() for each lunation
+        times - all of the true phase times, in order
+        kinds - the phase (NEW, FIRST, FULL or LAST) of each of times
+    """
+
+    def __init__(self, first_year=2000, last_year=2030):
+        self.first_year = first_year
+        self.last_year = last_year
+
+        # Lunation numbers, with a spare one either side
+        k_first = int(floor((first_year - 1900) * 12.3685)) - 2
+        k_last = int(floor((last_year + 1 - 1900) * 12.3685)) + 2
+        self.ks = list(range(k_first, k_last + 1))
+
+        self.mean_new = [meanphase(2415020.75933 + c.synodic_month * k, k)
+                         for k in self.ks]
+        true = [[truephase(k, p) for p in (NEW, FIRST, FULL, LAST)]
+                for k in self.ks]
+        self.phases = [true[i] + [true[i + 1][0]]
+                       for i in range(len(self.ks) - 1)]
+
+        self.times = [t for lunation in true for t in lunation]
+        self.kinds = [p for lunation in true
+                      for p in (NEW, FIRST, FULL, LAST)]
+
+        self.start = self.mean_new[1]
+        self.end = self.mean_new[-2]
+
+    def covers(self, jdn):
+        return self.start <= jdn < self.end
+
+    def hunt(self, jdn):
+        """Returns the five true phase times that phase_hunt() would
+        find around the Julian Day Number jdn, or None if jdn is outside
+        the table."""
+
+        if not self.covers(jdn):
+            return None
+        i = bisect.bisect_right(self.mean_new, jdn) - 1
+        return list(self.phases[i])
+
+    def last(self, jdn, kind=FULL):
+        """Returns the time of the most recent phase of the given kind
+        (NEW, FIRST, FULL or LAST) at or before the Julian Day Number
+        jdn, or None if jdn is outside the table."""
+
+        if not self.covers(jdn):
+            return None
+        i = bisect.bisect_right(self.times, jdn) - 1
+        while self.kinds[i] != kind:
+            i -= 1
+        return self.times[i]
+
+    def since_array(self, jdn, kind=FULL):
+        """Vectorised last(): returns an array of the number of days
+        since the most recent phase of the given kind, for an array of
+        Julian Day Numbers. Elements outside the table are NaN."""
+
+        jdn = np.asarray(jdn, dtype=np.float64)
+        kind_times = np.array([t for t, k in zip(self.times, self.kinds)
+                               if k == kind])
+        i = np.searchsorted(kind_times, jdn, side='right') - 1
+        since = jdn - kind_times[np.clip(i, 0, len(kind_times) - 1)]
+        outside = (jdn < self.start) | (jdn >= self.end)
+        return np.where(outside, np.nan, since)
+
+
+_lunation_table = []
+
+def lunation_table():
+    """Returns the default LunationTable, building it the first time it
+    is needed."""
+
+    if not _lunation_table:
+        _lunation_table.append(LunationTable())
+    return _lunation_table[0]
+
+
+def last_phase(date, kind=FULL):
+    """Returns the date of the most recent phase of the given kind
+    (NEW, FIRST, FULL or LAST) at or before date, as the same kind of
+    date (see from_jdn()). Falls back to phase_hunt() outside the
+    LunationTable."""
+
+    jdn = to_jdn(date)
+    last = lunation_table().last(jdn, kind)
+    if last is None:
+        phases = phase_hunt(jdn)
+        index = int(kind * 4)
+        last = phases[index]
+        if last > jdn:
+            last = phase_hunt(phases[0] - 1)[index]
+    return from_jdn(last, date)
+
+
+def days_since(date, kind=FULL):
+    """Returns the number of days (a float) since the most recent phase
+    of the given kind, e.g. days_since(date, FULL) for the days since
+    the full moon."""
+
+    return to_jdn(date) - to_jdn(last_phase(date, kind))
+
+
 def meanphase(sdate, k):
     """Calculates time of the mean new Moon for a given base date.
 
@@ -375,12 +650,9 @@ def meanphase(sdate, k):
     """
 
     # Time in Julian centuries from 1900 January 0.5
-    if not hasattr(sdate,'jdn'):
-        delta_t = sdate - DateTime.DateTime(1900,1,1,12).jdn
-        t = delta_t / 36525
-    else:
-        delta_t = sdate - DateTime.DateTime(1900,1,1,12)
-        t = delta_t.days / 36525
+    # (measured, as it always has been, from DateTime(1900,1,1,12).jdn)
+    delta_t = to_jdn(sdate) - 2415021.0
+    t = delta_t / 36525
 
     # square for frequent use
     t2 = t * t
@@ -400,7 +672,7 @@ def meanphase(sdate, k):
 def truephase(k, tphase):
     """Given a K value used to determine the mean phase of the new
     moon, and a phase selector (0.0, 0.25, 0.5, 0.75), obtain the
-    true, corrected phase time."""
+    true, corrected phase time, as a Julian Day Number."""
 
     apcor = False
 
@@ -481,7 +753,7 @@ def truephase(k, tphase):
             "TRUEPHASE called with invalid phase selector",
             tphase)
 
-    return DateTime.DateTimeFromJDN(pt)
+    return pt
 
 def kepler(m, ecc):
     """Solve the equation of Kepler."""
@@ -499,8 +771,28 @@ def kepler(m, ecc):
 
     return e
 
+def kepler_array(m, ecc):
+    """Solve the equation of Kepler for an array of mean anomalies m.
+
+    Each element is iterated exactly as often as kepler() would, so
+    the results are the same as solving them one at a time."""
+
+    epsilon = 1e-6
+
+    m = np.radians(m)
+    e = m.copy()
+    todo = np.ones(e.shape, dtype=bool)
+    while todo.any():
+        delta = e[todo] - ecc * np.sin(e[todo]) - m[todo]
+        e[todo] = e[todo] - delta / (1.0 - ecc * np.cos(e[todo]))
+
+        done = np.flatnonzero(todo)[np.abs(delta) <= epsilon]
+        todo[done] = False
+
+    return e
+
 if __name__ == '__main__':
-    d = DateTime.now() - DateTime.TimeDelta(48)
+    d = datetime.datetime.now() - datetime.timedelta(hours=48)
     m = MoonPhase(d)
     s = """The moon is %s, %.1f%% illuminated, %.1f days old.""" %\
         (m.phase_text, m.illuminated * 100, m.age)
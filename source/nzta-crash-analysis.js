@@ -1,4 +1,4 @@
-var boolean_properties, cause_decoder, chevron_control, crashes, crashgeojson, curve_decoder, deca, do_feature_count, frontpage_control, getPointStyleOptions, getPopup, get_attribution, get_causes_text, get_child_injured_icon, get_decoders, get_foreground_layer, get_map, get_moon_icon, get_speed_limit_icon, get_straightforwad_multiple_icons, get_straightforward_icon, get_streetview, get_tileLayer, get_weather_icons, holidays, injuries_decoder, injuryColours, intersection_decoder, light_decoder, makeElem, make_img, map, mode_decoder, onEachFeature, readStringFromFileAtPath, sidebar_hide, special, streetview_key, stringify_number, traffic_control_decoder, utc_offset, weather_decoder_1, weather_decoder_2;
+var boolean_properties, cause_decoder, chevron_control, crashes, crashgeojson, curve_decoder, deca, do_feature_count, expandLookup, frontpage_control, getPointStyleOptions, getPopup, get_attribution, get_causes_text, get_child_injured_icon, get_decoders, get_foreground_layer, get_map, get_moon_icon, get_speed_limit_icon, get_straightforwad_multiple_icons, get_straightforward_icon, get_streetview, get_tileLayer, get_weather_icons, holidays, injuries_decoder, injuryColours, intersection_decoder, light_decoder, makeElem, make_img, map, mode_decoder, onEachFeature, readStringFromFileAtPath, sidebar_hide, special, streetview_key, stringify_number, traffic_control_decoder, utc_offset, weather_decoder_1, weather_decoder_2;
 
 crashes = './data/data.geojson';
 
@@ -351,6 +351,22 @@ get_foreground_layer = function(maxZoom, minZoom) {
   return mask;
 };
 
+expandLookup = function(data) {
+  var feature, j, key, len, ref, ref1, values;
+  if (data.lookup != null) {
+    ref = data.features;
+    for (j = 0, len = ref.length; j < len; j++) {
+      feature = ref[j];
+      ref1 = data.lookup;
+      for (key in ref1) {
+        values = ref1[key];
+        feature.properties[key] = values[feature.properties[key]];
+      }
+    }
+  }
+  return data;
+};
+
 onEachFeature = function(feature, layer) {
   layer.on('click', function(e) {
     layer.bindPopup(getPopup(feature), {
@@ -543,6 +559,7 @@ get_decoders();
 map = get_map(get_tileLayer(), get_foreground_layer());
 
 crashgeojson = new L.GeoJSON.AJAX(crashes, {
+  middleware: expandLookup,
   pointToLayer: function(feature, latlng) {
     var cm;
     return cm = new L.CircleMarker(latlng, getPointStyleOptions(feature));
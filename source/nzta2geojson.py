@@ -14,20 +14,41 @@ import generalFunctions as genFunc
 import re
 import logging
 import datetime
+import argparse
+import multiprocessing
+from itertools import islice
 from calendar import timegm
 
 import pytz
 import pyproj
 import geojson
-import ephem
-import mx.DateTime
 
 import moon
+import bitmapindex
+import buildcache
+import columnar
+import compressed
+import partitions
+import decoders
+from decoders import DECODERS
+import sun
+import tiles
+
+# NZTM projection, initialised once and shared by every crash: parsing the
+# PROJ definition costs far more than projecting a point
+NZTM = pyproj.Proj(init='epsg:2193')
+
+# Approximate correction for Chatham Islands, which NZTA has offset
+# In units of the projection system (NZTM): (easting, northing)
+CHATHAMS_CORRECTION = (355966, -96135)
+
+# Formatted road names, shared by every crash (road names repeat a lot)
+ROAD_CACHE = genFunc.RoadCache()
 
 
 class nztacrash:
     '''A crash recorded by NZTA'''
-    def __init__(self, row, causedecoder, streetdecoder, holidays):
+    def __init__(self, row, causedecoder, streetdecoder, holidays, lonlat=None, batch=False):
         '''
         A row from one of the crash .csv files gives us all the attrbiutes we
         have to define it as a Python object. When initialising, we typecast
@@ -38,6 +59,13 @@ class nztacrash:
         Also requires the parameter `causedecoder`, which is the output of
         the function causeDecoderCSV(). This should be the output of this function,
         to avoid running it each tim an nztacrash object is instantiated.
+
+        `lonlat` is an optional (lon, lat) tuple for the crash, already
+        projected from NZTM (see project_rows()), so that whole blocks of
+        crashes can be projected in a single call. If it is None, the crash
+        is projected on its own. Likewise, if `batch`, the daylight and moon
+        attributes are left as None, to be filled in for a whole block of
+        crashes at once by set_daylight() and set_moon().
         '''
         # Output of causeDecoderCSV()
         self.causedecoder = causedecoder
@@ -84,20 +112,17 @@ class nztacrash:
         self.hasLocation = self.get_hasLocation()
 
         # Approximate correction for Chatham Islands, which NZTA has offset
-        if self.tla_name == 'Chatham Islands County' and self.hasLocation:
-             # In units of the projection system (NZTM)
-            lat_correction = -96135
-            lon_correction = 355966
-            self.easting += lon_correction
-            self.northing += lat_correction
-            self.chathams = True
-        else:
-            self.chathams = False
+        self.chathams = is_chathams(self.tla_name) and self.hasLocation
+        if self.chathams:
+            self.easting += CHATHAMS_CORRECTION[0]
+            self.northing += CHATHAMS_CORRECTION[1]
 
-        self.proj = pyproj.Proj(init='epsg:2193') # NZTM projection
+        self.proj = NZTM # NZTM projection
 
         if self.hasLocation == True:
-            self.lon, self.lat = self.proj(self.easting, self.northing, inverse=True) # Lon/lat
+            if lonlat is None:
+                lonlat = self.proj(self.easting, self.northing, inverse=True)
+            self.lon, self.lat = lonlat # Lon/lat
             if self.chathams == True:
                 self.lon * -1
         else:
@@ -118,8 +143,12 @@ class nztacrash:
         self.light_decoded = self.decodeLight()
         self.wthr_a_decoded = self.decodeWeather()
         self.junc_type_decoded = self.decodeJunction()
-        self.daytime = self.get_daylight()
-        self.moon = self.get_moon()
+        if not batch:
+            self.daytime = self.get_daylight()
+            self.moon = self.get_moon()
+            self.moonphase, self.moontext = self.get_moon_phase()
+        else:
+            self.daytime, self.moon, self.moonphase, self.moontext = None, None, None, None
 
         # Some booleans (good for filters)
         if self.crash_fatal_cnt > 0:
@@ -172,13 +201,9 @@ class nztacrash:
         self.car = self.get_mode_involvement(['C','V','4']) # Car, van/ute, SUV
 
         # Roles and factors
-        self.tourist = self.get_factor_involvement(['404','731'])
-        self.alcohol = self.get_factor_involvement(['101','102','103','104','105'])
-        self.drugs = self.get_factor_involvement(['107','108','109'])
-        self.cellphone = self.get_factor_involvement(['359'])
-        self.fatigue = self.get_factor_involvement(['410','411','412','413','414','415'])
-        self.dickhead = self.get_factor_involvement(['430','431','432','433','434','510','511','512','513','514','515','516','517'])
-        self.speeding = self.get_factor_involvement(['110','111','112','113','114','115','116','117'])
+        self.factors = decoders.factor_mask(self.causes) # See decoders.FACTORS
+        for factor, bit in decoders.FACTOR_BITS.items():
+            setattr(self, factor, 1 if self.factors & bit else 0)
 
     def get_hasLocation(self):
         if self.easting in [0,None] or self.northing in [0,None]:
@@ -189,15 +214,7 @@ class nztacrash:
             return True
 
     def get_crash_road(self):
-        crash_road = genFunc.formatString(self.row[1])
-        if crash_road != None and crash_road[0:3] != 'SH ':
-            if len(crash_road) == 2 and crash_road != 'TE':
-                crash_road = crash_road # Acronym, don't apply title()
-            else:
-                crash_road = crash_road.title()
-        crash_road = genFunc.check_offroad(crash_road)
-        crash_road = genFunc.streetExpander(crash_road,self.streetdecoder)
-        return crash_road
+        return ROAD_CACHE.road(self.row[1], self.streetdecoder) # See genFunc.formatRoad()
 
     def get_crash_datetime(self, as_utc=False):
         '''Returns a datetime.datetime object expressing the date and time of the
@@ -217,43 +234,29 @@ class nztacrash:
         else:
             return pytz.timezone('Pacific/Auckland').localize(local_dt, is_dst=True).astimezone(pytz.utc)
 
-    def get_daylight(self, twilight='civil', elev=0, temp=15.0, pressure=1010):
+    def get_daylight(self, twilight='civil'):
         '''Returns boolean indicating whether the accident occurred at a time
-        when there was sunlight.'''
-        assert twilight in ['civil', 'nautical', 'astronomical']
+        when there was sunlight (see sun.daylight()). For many crashes at
+        once, use set_daylight().'''
         if self.hasLocation is False or self.crash_datetime is None:
             return
-        twilights = {
-            'civil': -6,
-            'nautical': -12,
-            'astronomical': -18
-        }
-        observer = ephem.Observer()
-        observer.date = self.get_crash_datetime(as_utc=True).strftime(
-            '%Y-%m-%d %H:%M:%S'
-        )
-        observer.lon = str(self.lon)
-        observer.lat = str(self.lat)
-        observer.elev = elev
-        observer.pressure = pressure
-        observer.temp = temp
-        observer.horizon = str(twilights[twilight])
-
-        next_sunrise = datetime.datetime.strptime(str(
-            observer.next_rising(ephem.Sun(), use_center=True)
-        ), '%Y/%m/%d %H:%M:%S').replace(tzinfo=pytz.UTC)
-        next_sunset = datetime.datetime.strptime(str(
-            observer.next_setting(ephem.Sun(), use_center=True)
-        ), '%Y/%m/%d %H:%M:%S').replace(tzinfo=pytz.UTC)
-
-        return int(next_sunset < next_sunrise)
+        utc = self.get_crash_datetime(as_utc=True).replace(tzinfo=None)
+        return int(sun.daylight(utc, self.lat, self.lon, twilight=twilight))
 
     def get_moon(self):
         '''Returns a Moon when the accident occurred (see moon.py for
         properties and methods)'''
         if self.crash_datetime is None:
             return
-        return moon.MoonPhase(mx.DateTime.DateTimeFrom(self.crash_datetime))
+        return moon.MoonPhase(self.crash_datetime)
+
+    def get_moon_phase(self):
+        '''Returns the phase of self.moon as an integer from 0 to 26 (one for
+        each moon icon, where 0 and 26 are new), and as text. Both are None if
+        there is no moon. For many crashes at once, use set_moon().'''
+        if self.moon is None:
+            return None, None
+        return int(self.moon.phase * 26 + 0.5), self.moon.phase_text
 
     def get_holiday(self):
         '''Returns a Boolean indicating whether the accident involved a severe
@@ -288,15 +291,7 @@ class nztacrash:
         return spd_lim
 
     def get_side_road(self):
-        side_road = genFunc.formatString(self.row[5])
-        if side_road != None and side_road[0:3] != 'SH ':
-            if len(side_road) == 2 and side_road != 'TE':
-                side_road = side_road # Acronym, don't apply title()
-            else:
-                side_road = side_road.title()
-        side_road = genFunc.check_offroad(side_road)
-        side_road = genFunc.streetExpander(side_road,self.streetdecoder)
-        return side_road
+        return ROAD_CACHE.road(self.row[5], self.streetdecoder) # See genFunc.formatRoad()
 
     def get_mode_involvement(self, mode_list):
         '''Returns a boolean indicating whether the key vehicle or any of the
@@ -437,9 +432,10 @@ class nztacrash:
 
         return {
             'type': 'Feature',
+            'id': self.crash_id, # CRASH ID
             'properties': {
                 't': self.tla_name, # Name of Territorial Local Authority
-                'r': genFunc.formatNiceRoad(self.get_crashroad()), # The road, nicely formatted
+                'r': ROAD_CACHE.nice(self.get_crashroad()), # The road, nicely formatted
                 'h': self.holiday_name, # Name of holiday period, if the crash was injurious and occured during one
                 'cy': self.cyclist, # Cyclist Boolean
                 'pd': self.pedestrian, # Pedestrian Boolean
@@ -470,8 +466,8 @@ class nztacrash:
                 'curve': self.road_curve,
                 'childage': self.get_injured_child_age(),
                 'moon': {
-                    'moonphase': int(self.moon.phase * 26 + 0.5) if self.moon is not None else None,
-                    'moontext': self.moon.phase_text if self.moon is not None else None
+                    'moonphase': self.moonphase,
+                    'moontext': self.moontext
                 },
                 'injuries': self.get_injury_counts()
             },
@@ -494,25 +490,7 @@ class nztacrash:
     def decodeMovement(self):
         '''Decodes self.mvmt into a human-readable form.
         Movement applies to left and right hand bends, curves, or turns.'''
-        decoder = {'A': ('Overtaking and lane change', {'A': 'Pulling out or changing lane to right', 'B': 'Head on', 'C': 'Cutting in or changing lane to left', 'D': 'Lost control (overtaking vehicle)', 'E': 'Side road', 'F': 'Lost control (overtaken vehicle)', 'G': 'Weaving in heavy traffic', 'O': 'Other'}),
-                 'B': ('Head on',{'A': 'On straight', 'B': 'Cutting corner', 'C': 'Swinging wide', 'D': 'Both cutting corner and swining wide, or unknown', 'E': 'Lost control on straight', 'F': 'Lost control on curve', 'O': 'Other'}),
-                 'C': ('Lost control or off road (straight roads)',{'A': 'Out of control on roadway', 'B': 'Off roadway to left', 'C': 'Off roadway to right', 'O': 'Other'}),
-                 'D': ('Cornering',{'A': 'Lost control turning right', 'B': 'Lost control turning left', 'C':'Missed intersection or end of road', 'O': 'Other'}),
-                 'E': ('Collision with obstruction',{'A': 'Parked vehicle', 'B': 'Crash or broken down', 'C': 'Non-vehicular obstructions (including animals)', 'D': 'Workman\'s vehicle', 'E': 'Opening door', 'O': 'Other'}),
-                 'F': ('Rear end',{'A': 'Slower vehicle', 'B': 'Cross traffic', 'C': 'Pedestrian', 'D': 'Queue', 'E': 'Signals', 'F': 'Other', 'O': 'Other'}),
-                 'G': ('Turning versus same direction',{'A': 'Rear of left turning vehicle', 'B': 'Left turn side swipe', 'C': 'Stopped or turning from left side', 'D': 'Near centre line', 'E': 'Overtaking vehicle', 'F': 'Two turning', 'O': 'Other'}),
-                 'H': ('Crossing (no turns)',{'A': 'Right angle (70 to 110 degress)', 'O': 'Other'}),
-                 'J': ('Crossing (vehicle turning)',{'A': 'Right turn right side', 'B': 'Opposing right turns', 'C': 'Two turning', 'O': 'Other'}),
-                 'K': ('Merging',{'A': 'Left turn in', 'B': 'Opposing right turns', 'C': 'Two turning', 'O': 'Other'}),
-                 'L': ('Right turn against',{'A': 'Stopped waiting to turn', 'B': 'Making turn', 'O': 'Other'}),
-                 'M': ('Manoeuvring',{'A': 'Parking or leaving', 'B': 'U turn', 'C': 'U turn', 'D': 'Driveway manoeuvre', 'E': 'Entering or leaving from opposite side', 'F': 'Enetering or leaving from same side', 'G': 'Reversing along road', 'O': 'Other'}),
-                 'N': ('Pedestrians crossing road',{'A': 'Left side', 'B': 'Right side', 'C': 'Left turn left side', 'D': 'Right turn right side', 'E': 'Left turn right side', 'F': 'Right turn left side', 'G': 'Manoeuvring vehicle', 'O': 'Other'}),
-                 'P': ('Pedestrians other',{'A': 'Walking with traffic', 'B': 'Walking facing traffic', 'C': 'Walking on footpath', 'D': 'Child playing (including tricycle)', 'E': 'Attending to vehicle', 'F': 'Entering or leaving vehicle', 'O': 'Other'}),
-                 'Q': ('Miscellaneous',{'A': 'Fell while boarding or alighting', 'B': 'Fell from moving vehicle', 'C': 'Train', 'D': 'Parked vehicle ran away', 'E': 'Equestrian', 'F': 'Fell inside vehicle', 'G': 'Trailer or load', 'O': 'Other'})}
-        try:
-            return (decoder[self.mvmt[0]][0], decoder[self.mvmt[0]][1][self.mvmt[1]])
-        except KeyError:
-            return None
+        return DECODERS['movement'].decode(self.mvmt[:2])
 
     def getKeyVehicle(self, decode=False):
         '''Returns the key vehicle code (or the decoded value), which is one part
@@ -522,24 +500,7 @@ class nztacrash:
             if not decode:
                 return code
             else:
-                try:
-                    decoder = {'C': 'car',
-                               'V': 'van/ute',
-                               'X': 'taxi/taxi van',
-                               'B': 'bus',
-                               'L': 'school bus',
-                               '4': 'SUV/4X4',
-                               'T': 'truck',
-                               'M': 'motorcycle',
-                               'P': 'moped',
-                               'S': 'bicycle',
-                               'K': 'skateboard/in-line skater/etc.',
-                               'O': 'other/unknown',
-                               'U': 'other/unknown',
-                               'E': 'pedestrian'}
-                except KeyError:
-                    return None
-                return decoder[code]
+                return DECODERS['key_vehicle'][ord(code)]
         else:
             return None
 
@@ -551,14 +512,14 @@ class nztacrash:
             if not decode:
                 return code
             else:
+                directions = DECODERS['direction']
                 try:
-                    decoder = {'N': 'North', 'S': 'South', 'E': 'East', 'W': 'West', '1': 'on the first street', '2': 'on the second street'}
-                    try:
-                        return '%s %s' % (decoder[code[0]], decoder[code[1]])
-                    except IndexError:
-                        return None
-                except KeyError:
+                    first, second = directions[ord(code[0])], directions[ord(code[1])]
+                except IndexError:
+                    return None
+                if first is None or second is None:
                     return None
+                return '%s %s' % (first, second)
 
     def getSecondaryVehicles(self, decode=False):
         '''Returns the secondary vehicle type codes (or the decoded values)
@@ -570,25 +531,11 @@ class nztacrash:
             if not decode:
                 return [v for v in vehicles]
             else:
-                try:
-                    decoder = {'C': 'car',
-                           'V': 'van/ute',
-                           'X': 'taxi/taxi van',
-                           'B': 'bus',
-                           'L': 'school bus',
-                           '4': 'SUV/4X4',
-                           'T': 'truck',
-                           'M': 'motorcycle',
-                           'P': 'moped',
-                           'S': 'bicycle',
-                           'E': 'pedestrian',
-                           'K': 'skateboard/in-line skater/etc.',
-                           'Q': 'equestrian',
-                           'H': 'wheeled pedestrian (wheelchairs, etc.)',
-                           'O': 'other/unknown'}
-                    return [decoder[v] for v in vehicles]
-                except KeyError:
+                decoder = DECODERS['secondary_vehicle']
+                decoded = [decoder[ord(v)] for v in vehicles]
+                if None in decoded:
                     return None
+                return decoded
         else:
             # There were no other vehicles
             return None
@@ -612,34 +559,11 @@ class nztacrash:
         '''
         if self.objects_struck == None:
             return None
-        decoder = {'A': 'driven or accompanied animals, i.e. under control',
-                       'B': 'bridge abutment, handrail or approach, includes tunnels',
-                       'C': 'upright cliff or bank, retaining walls',
-                       'D': 'debris, boulder or object dropped from vehicle',
-                       'E': 'over edge of bank',
-                       'F': 'fence, letterbox, hoarding etc.',
-                       'G': 'guard or guide rail (including median barriers)',
-                       'H': 'house or building',
-                       'I': 'traffic island or median strip',
-                       'J': 'public furniture, eg phone boxes, bus shelters, signal controllers, etc.',
-                       'K': 'kerb, when directly contributing to incident',
-                       'L': 'landslide, washout or floodwater',
-                       'M': 'parked motor vehicle',
-                       'N': 'train',
-                       'P': 'utility pole, includes lighting columns',
-                       'Q': 'broken down vehicle, workmen\'s vehicle, taxis picking up, etc.',
-                       'R': 'roadwork signs or drums, holes and excavations, etc',
-                       'S': 'traffic signs or signal bollards',
-                       'T': 'trees, shrubbery of a substantial nature',
-                       'V': 'ditch',
-                       'W': 'wild animal, strays, or out of control animals',
-                       'X': 'other',
-                       'Y': 'objects thrown at or dropped onto vehicles',
-                       'Z': 'into water, river or sea'}
-        try:
-            return [decoder[o] for o in self.objects_struck]
-        except KeyError:
+        decoder = DECODERS['objects_struck']
+        decoded = [decoder[ord(o)] for o in self.objects_struck]
+        if None in decoded:
             return None
+        return decoded
 
     def get_crashroad(self):
         if self.crash_intsn == 'I':
@@ -657,33 +581,18 @@ class nztacrash:
     def decodeLight(self):
         '''Takes self.light (a list of strings) and applies a decoder to it,
         returning a list of strings that are human-readable.'''
-        decoder1 = {'B': 'Bright sun',
-                    'O': 'Overcast',
-                    'T': 'Twilight',
-                    'D': 'Dark',
-                    ' ': None}
-        decoder2 = {'O': 'street lights on',
-                    'F': 'street lights off',
-                    'N': 'No street lights present',
-                    ' ': None}
-        return [decoder1[self.light[0]], decoder2[self.light[1]]]
+        return [DECODERS['light'][ord(self.light[0])],
+                DECODERS['street_lights'][ord(self.light[1])]]
 
     def decodeWeather(self):
         '''Takes self.wthr_a (a list of strings) and applies a decoder to it,
         returning a list of strings that are human-readable.'''
-        decoder1 = {'F': 'Fine',
-                    'M': 'Mist/fog',
-                    'L': 'Light rain',
-                    'H': 'Heavy rain',
-                    'S': 'Snow',
-                    ' ': None}
-        decoder2 = {'F': 'Frost',
-                    'S': 'Strong wind',
-                    ' ': None}
-        try:
-            return [decoder1[self.wthr_a[0]], decoder2[self.wthr_a[1]]]
-        except KeyError:
+        weather = DECODERS['weather'][ord(self.wthr_a[0])]
+        conditions = DECODERS['conditions'][ord(self.wthr_a[1])]
+        if (weather is None and self.wthr_a[0] != ' ') or \
+           (conditions is None and self.wthr_a[1] != ' '):
             return None
+        return [weather, conditions]
 
     def decodeJunction(self):
         '''Takes self.junc_type (a single-character string) and applies a decoder to
@@ -695,16 +604,7 @@ class nztacrash:
         precedence.'''
         if self.junc_type == None:
             return None
-        decoder = {'D': 'Driveway',
-                   'R': 'Roundabout',
-                   'X': 'Crossroads',
-                   'T': 'T intersection',
-                   'Y': 'Y intersection',
-                   'M': 'Multi-leg intersection'}
-        try:
-            return decoder[self.junc_type]
-        except KeyError:
-            return None
+        return DECODERS['junction'].decode(self.junc_type)
 
     def projectedpt(self, target=pyproj.Proj(init='epsg:3728')):
         '''Takes the original NZTM point coordinates, and transforms them into
@@ -733,31 +633,14 @@ class nztacrash:
 
         NOTE: A is the primary vehicle
         '''
-        # Map letters to index positions
-        decoder = {'C': 'car',
-            'V': 'van/ute',
-            'X': 'taxi/taxi van driver',
-            'B': 'bus',
-            'L': 'school bus',
-            '4': 'SUV/4X4',
-            'T': 'truck',
-            'M': 'motorcycle',
-            'P': 'moped',
-            'S': 'bicycle',
-            'O': 'vehicle of unknown type',
-            'U': 'vehicle of unknown type',
-            'E': 'pedestrian',
-            'K': 'skater',
-            'Q': 'equestrian',
-            'H': 'wheeled pedestrian'
-        }
+        decoder = DECODERS['party_vehicle']
         modes = {'A': self.keyvehicle}
         if self.secondaryvehicles is not None:
             for i, v in enumerate(self.secondaryvehicles):
                 modes[string.ascii_uppercase[i+1]] = v
         if decode:
             for k in modes.keys():
-                modes[k] = decoder[modes[k]]
+                modes[k] = decoder[ord(modes[k])]
         return modes
 
     def getCauses(self, decode=False):
@@ -858,30 +741,106 @@ class nztacrash:
             retdict = decodedretdict
         return retdict
 
+def is_chathams(tla_name):
+    '''Returns a boolean indicating whether the Territorial Local Authority
+    `tla_name` is the Chatham Islands, whose coordinates NZTA has offset'''
+    return tla_name == 'Chatham Islands County'
+
+def nztm2lonlat(eastings, northings):
+    '''Inverse projects sequences of NZTM `eastings` and `northings` into
+    WGS84 longitudes and latitudes in a single call to the shared NZTM
+    projection, returning a list of (lon, lat) tuples.'''
+    if len(eastings) == 0:
+        return []
+    lons, lats = NZTM(list(eastings), list(northings), inverse=True)
+    return zip(lons, lats)
+
+def nztm2projected(eastings, northings, target=pyproj.Proj(init='epsg:3728')):
+    '''Batch version of nztacrash.projectedpt(): transforms sequences of NZTM
+    `eastings` and `northings` into the `target` pyproj.Proj() projected
+    coordinate system in a single call, returning a list of (X,Y) tuples.'''
+    if len(eastings) == 0:
+        return []
+    xt, yt = pyproj.transform(NZTM, target, list(eastings), list(northings))
+    return zip(xt, yt)
+
+def project_rows(rows):
+    '''
+    Takes a block of rows from a crash CSV and projects all of their locations
+    at once. Returns a list parallel to `rows`, of (lon, lat) tuples, or None
+    where the row has no valid location. The Chatham Islands correction is
+    applied as in nztacrash.
+    '''
+    located, eastings, northings = [], [], []
+    for i, row in enumerate(rows):
+        try:
+            easting = genFunc.formatInteger(row[27])
+            northing = genFunc.formatInteger(row[28])
+        except (IndexError, ValueError):
+            # Let nztacrash deal with the malformed row
+            continue
+        if easting in [0,None] or northing in [0,None]:
+            continue
+        if is_chathams(genFunc.formatString(row[0])):
+            easting += CHATHAMS_CORRECTION[0]
+            northing += CHATHAMS_CORRECTION[1]
+        located.append(i)
+        eastings.append(easting)
+        northings.append(northing)
+    lonlats = [None] * len(rows)
+    for i, lonlat in zip(located, nztm2lonlat(eastings, northings)):
+        lonlats[i] = lonlat
+    return lonlats
+
+def set_daylight(crashes, twilight='civil', cache=None):
+    '''
+    Batch version of nztacrash.get_daylight(): sets the `daytime` attribute of
+    every crash in the list `crashes` with a single vectorised call to
+    sun.daylight(). Crashes without a location or a time get None.
+
+    If a sun.SolarEventCache is given as `cache`, it is used instead, and its
+    twilight overrides `twilight`.
+    '''
+    dated = [c for c in crashes if c.hasLocation and c.crash_datetime is not None]
+    for c in crashes:
+        c.daytime = None
+    if not dated:
+        return
+    timestamps = [c.get_crash_datetime(as_utc=True).replace(tzinfo=None) for c in dated]
+    lats, lons = [c.lat for c in dated], [c.lon for c in dated]
+    if cache is not None:
+        flags = cache.daylight(timestamps, lats, lons)
+    else:
+        flags = sun.daylight(timestamps, lats, lons, twilight=twilight)
+    for c, flag in zip(dated, flags):
+        c.daytime = int(flag)
+
+def set_moon(crashes):
+    '''
+    Batch version of nztacrash.get_moon_phase(): sets the `moonphase` and
+    `moontext` attributes of every crash in the list `crashes` with a single
+    vectorised call to moon.phase_array(), without building a
+    moon.MoonPhase for each (so `moon` is left as None). Crashes without a
+    time get None.
+    '''
+    dated = [c for c in crashes if c.crash_datetime is not None]
+    for c in crashes:
+        c.moonphase, c.moontext = None, None
+    if not dated:
+        return
+    # Julian Day Numbers of the (local) crash times, as for get_moon()
+    phases = moon.phase_array(sun.julian_day([c.crash_datetime for c in dated]))['phase']
+    texts = moon.phase_string_array(phases)
+    for c, p, text in zip(dated, (phases * 26 + 0.5).astype(int), texts):
+        c.moonphase, c.moontext = int(p), str(text)
+
 def causeDecoderCSV(data):
     '''
     Reads a CSV, dervied from a PDF (!) of crash cause codes and their text
     descriptions. Returns a dictionary of the codes (keys) and the values
     (values), both as strings. Hard coded.
     '''
-    with open(data, 'rb') as decodecsv:
-        decodereader = csv.reader(decodecsv, delimiter=',')
-        header = decodereader.next()
-        retdict = {}
-        for coderow in decodereader:
-            code = coderow[3]
-            subject = coderow[6]
-            pretty_explanation = coderow[7]
-            if subject == 'TRUE':
-                subject = True
-            elif subject == 'FALSE':
-                subject = False
-            else:
-                raise ValueError
-            if pretty_explanation in ['FALSE','',' ']:
-                pretty_explanation = None
-            retdict[code] = (subject, pretty_explanation)
-    return retdict
+    return decoders.causes_csv(data)
 
 def streetDecoderCSV(data):
     '''
@@ -911,36 +870,424 @@ def get_official_holiday_periods():
     return hols
 
 
-def get_crashes(file, causes, streets, holidays, global_start, global_end):
+def get_crashes(file, causes, streets, holidays, global_start, global_end, blocksize=1000, daylight_cache=None, offset=0):
     '''
     Generates 'valid' crash records from a crash CSV
+
+    Rows are read `blocksize` at a time, so that their locations can be
+    projected, and their daylight and moon phase found, in a single call each
+    (see project_rows(), set_daylight() and set_moon()). Daylight is looked up in
+    `daylight_cache`, a sun.SolarEventCache, if one is given.
+
+    If `offset` is given, only the rows from that byte offset of the CSV
+    (which must be the start of a row) are read, e.g. the rows appended to
+    it since it was last read (see last_crash_id()).
     '''
     causedecoder = causeDecoderCSV(causes) # Decode the coded values
     streetdecoder = streetDecoderCSV(streets)
+    return read_crashes(file, causedecoder, streetdecoder, holidays,
+        global_start, global_end, blocksize=blocksize, daylight_cache=daylight_cache,
+        offset=offset)
+
+def read_crashes(file, causedecoder, streetdecoder, holidays, global_start, global_end, start=0, stop=None, blocksize=1000, daylight_cache=None, offset=0):
+    '''
+    As get_crashes(), but takes the already-loaded outputs of
+    causeDecoderCSV() and streetDecoderCSV(), and only reads the data rows
+    numbered `start` (inclusive) to `stop` (exclusive) of the CSV, counting
+    from 0 after the header (or from `offset`). A `stop` of None reads to the
+    end of the file.
+    '''
+    with open(file, 'rb') as crashcsv:
+        if offset:
+            crashcsv.seek(offset)
+            crashreader = csv.reader(crashcsv, delimiter=',')
+        else:
+            crashreader = csv.reader(crashcsv, delimiter=',')
+            header = crashreader.next()
+        crashreader = islice(crashreader, start, stop)
+        for block in genFunc.chunks(crashreader, blocksize):
+            crashes = [nztacrash(crash, causedecoder, streetdecoder, holidays, lonlat=lonlat, batch=True)
+                for crash, lonlat in zip(block, project_rows(block))]
+            set_daylight(crashes, cache=daylight_cache)
+            set_moon(crashes)
+            for Crash in crashes:
+                # Only add features with a location
+                # And that are within the acceptable date range
+                if Crash.crash_date == None or Crash.hasLocation == False:
+                    continue
+                if not (global_start <= Crash.crash_date <= global_end):
+                    continue
+                yield Crash
+
+def last_crash_id(file, end=None):
+    '''
+    Returns the CRASH ID of the last row of a crash CSV, or of the last row
+    before byte offset `end` (if it is given, it must be the end of a row),
+    without reading the rest of the file. Returns None if there are no data
+    rows.
+    '''
     with open(file, 'rb') as crashcsv:
-        crashreader = csv.reader(crashcsv, delimiter=',')
-        header = crashreader.next()
-        for crash in crashreader:
-            Crash = nztacrash(crash, causedecoder, streetdecoder, holidays)
-            # Only add features with a location
-            # And that are within the acceptable date range
-            if Crash.crash_date == None or Crash.hasLocation == False:
-                continue
-            if not (global_start <= Crash.crash_date <= global_end):
-                continue
-            yield Crash
-
-def main(data, causes, streets, holidays, global_start, global_end):
-    feature_collection = {"type": "FeatureCollection","features": []}
-    with open('../data/data.geojson', 'w') as outfile:
+        if end is None:
+            crashcsv.seek(0, 2)
+            end = crashcsv.tell()
+        start = max(end - 65536, 0)
+        crashcsv.seek(start)
+        lines = [line for line in crashcsv.read(end - start).splitlines() if line.strip()]
+    if not lines or (start == 0 and len(lines) == 1):
+        # Only the header
+        return None
+    return csv.reader(lines[-1:], delimiter=',').next()[6]
+
+def row_ends(crashcsv):
+    '''
+    Generates the byte offset of the end of each row (the header first) of
+    an open CSV, read from its current position. Rows are found by the csv
+    module, so quoted fields may span lines.
+    '''
+    read = [crashcsv.tell()]
+    def lines():
+        for line in iter(crashcsv.readline, ''):
+            read[0] += len(line)
+            yield line
+    for row in csv.reader(lines(), delimiter=','):
+        yield read[0]
+
+def partition(data, chunksize):
+    '''
+    Splits the CSVs listed in `data` into (file, offset, nrows) units of work
+    for convert_chunk(), in input order: `nrows` (at most `chunksize`) data
+    rows starting at byte `offset`. Each CSV is read once, and a worker seeks
+    straight to its rows rather than reading those before them.
+    '''
+    tasks = []
+    for d in data:
+        with open(d, 'rb') as crashcsv:
+            ends = row_ends(crashcsv)
+            offset = next(ends, None) # After the header
+            nrows = 0
+            for end in ends:
+                nrows += 1
+                if nrows == chunksize:
+                    tasks.append((d, offset, nrows))
+                    offset, nrows = end, 0
+            if nrows:
+                tasks.append((d, offset, nrows))
+    return tasks
+
+# State of each worker process in a conversion pool, set by init_worker()
+_worker = {}
+
+# Counters of the road and daylight caches, which a worker's caches add to
+# the parent's (see convert_chunk())
+CACHE_COUNTERS = ('hits', 'misses', 'evictions')
+
+def cache_counts(cache):
+    '''Returns the CACHE_COUNTERS of a cache, or None if there is no cache'''
+    if cache is None:
+        return None
+    return [getattr(cache, name) for name in CACHE_COUNTERS]
+
+def add_cache_counts(cache, counts):
+    '''Adds the CACHE_COUNTERS `counts` of another process's cache to a cache'''
+    if cache is None or counts is None:
+        return
+    for name, count in zip(CACHE_COUNTERS, counts):
+        setattr(cache, name, getattr(cache, name) + count)
+
+def init_worker(causes, streets, holidays, global_start, global_end, daylight_cache=None):
+    '''Initialises a worker process, so that the decoders are read only once
+    per process rather than once per unit of work. Each worker gets its own
+    copy of `daylight_cache`.'''
+    _worker['causedecoder'] = causeDecoderCSV(causes)
+    _worker['streetdecoder'] = streetDecoderCSV(streets)
+    _worker['holidays'] = holidays
+    _worker['global_start'] = global_start
+    _worker['global_end'] = global_end
+    _worker['daylight_cache'] = daylight_cache
+    _worker['encoder'] = json.JSONEncoder(separators=(',',':'))
+
+def convert_chunk(task):
+    '''
+    Converts one (file, offset, nrows) unit of work (see partition()) in a
+    worker process, returning the list of its features already serialised
+    as JSON strings, which are much cheaper to send back to the parent than
+    the feature dictionaries, and how much the CACHE_COUNTERS of the road
+    and daylight caches went up while converting them.
+    '''
+    file, offset, nrows = task
+    caches = (ROAD_CACHE, _worker['daylight_cache'])
+    before = [cache_counts(cache) for cache in caches]
+    crashes = read_crashes(file, _worker['causedecoder'],
+        _worker['streetdecoder'], _worker['holidays'], _worker['global_start'],
+        _worker['global_end'], stop=nrows, offset=offset,
+        daylight_cache=_worker['daylight_cache'])
+    features = [_worker['encoder'].encode(crash.__geo_interface__()) for crash in crashes]
+    counts = [None if start is None else [end - begin for end, begin in zip(cache_counts(cache), start)]
+              for cache, start in zip(caches, before)]
+    return features, counts
+
+def write_feature_collection(features, outfile, separators=(',',':'), encoded=False):
+    '''
+    Writes an iterable of GeoJSON feature dictionaries to the open file
+    `outfile` as a single FeatureCollection. Each feature is serialised and
+    written as soon as it is consumed, so memory use does not grow with the
+    number of features. The bytes written are identical to
+    json.dumps({"type": "FeatureCollection", "features": list(features)})
+    with the same `separators`.
+
+    If `encoded`, the features have already been serialised to JSON strings
+    (see convert_chunk()), and are written as they are.
+    '''
+    encoder = json.JSONEncoder(separators=separators)
+    # Let the encoder decide the key order of the collection itself, then
+    # split it around the (empty) features array
+    header, footer = encoder.encode({"type": "FeatureCollection","features": []}).split('[]')
+    outfile.write(header + '[')
+    for i, feature in enumerate(features):
+        if i > 0:
+            outfile.write(separators[0])
+        outfile.write(feature if encoded else encoder.encode(feature))
+    outfile.write(']' + footer)
+
+# Properties whose values repeat across many crashes, written once in the
+# lookup of a dictionary-encoded collection (see write_dictionary_collection())
+DICTIONARY_PROPERTIES = ('t', 'r', 'h', 'causes', 'modes', 'vehicles', 'moon', 'injuries',
+                         'light', 'weather')
+
+def write_dictionary_collection(features, outfile, properties=DICTIONARY_PROPERTIES, precision=6, separators=(',',':'), decoded=False):
+    '''
+    As write_feature_collection() of encoded features (or if `decoded`, of
+    feature dictionaries, which are left unchanged), but each of the
+    `properties` of a feature is written as its index into a table of their
+    distinct values. The tables are written once, after the features, as the
+    collection's "lookup": {"t": ["Ashburton District", ...], ...}, so that a
+    client expands them with properties[key] = lookup[key][properties[key]].
+    Coordinates are rounded to `precision` decimal places (6 is about 10 cm),
+    unless it is None.
+    '''
+    encoder = json.JSONEncoder(separators=separators)
+    canonical = json.JSONEncoder(separators=separators, sort_keys=True)
+    indices = dict((name, {}) for name in properties)
+    lookup = dict((name, []) for name in properties)
+    header, footer = encoder.encode({"type": "FeatureCollection","features": []}).split('[]')
+    outfile.write(header + '[')
+    for i, feature in enumerate(features):
+        if decoded:
+            # Copied, as a writer may hold on to it
+            feature = dict(feature, properties=dict(feature['properties']),
+                           geometry=dict(feature['geometry']))
+        else:
+            feature = json.loads(feature)
+        values = feature['properties']
+        for name in properties:
+            value = values[name]
+            key = canonical.encode(value)
+            index = indices[name].get(key)
+            if index is None:
+                index = indices[name][key] = len(lookup[name])
+                lookup[name].append(value)
+            values[name] = index
+        if precision is not None:
+            geometry = feature['geometry']
+            geometry['coordinates'] = [round(c, precision) for c in geometry['coordinates']]
+        if i > 0:
+            outfile.write(separators[0])
+        outfile.write(encoder.encode(feature))
+    outfile.write(']' + separators[0] + '"lookup"' + separators[1] + encoder.encode(lookup) + footer)
+
+def convert(data, causes, streets, holidays, global_start, global_end, workers=1, chunksize=5000, daylight_cache=None):
+    '''
+    Yields the features of the crash CSVs listed in `data`, in input order,
+    serialised as JSON strings.
+
+    With more than one of `workers`, the CSVs are split into row ranges of
+    `chunksize` rows (see partition()) that are converted by a pool of
+    processes. Results are merged back in input order, so the output is
+    identical to that of a single process.
+
+    Daylight is looked up in `daylight_cache`, a sun.SolarEventCache, if one
+    is given; entries added by worker processes are not kept, but the hits,
+    misses and evictions of the workers' daylight and road caches are added
+    to those of `daylight_cache` and ROAD_CACHE.
+    '''
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker,
+            (causes, streets, holidays, global_start, global_end, daylight_cache))
+        try:
+            for chunk, (road_counts, daylight_counts) in pool.imap(convert_chunk,
+                    partition(data, chunksize)):
+                add_cache_counts(ROAD_CACHE, road_counts)
+                add_cache_counts(daylight_cache, daylight_counts)
+                for feature in chunk:
+                    yield feature
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        encoder = json.JSONEncoder(separators=(',',':'))
+        # Read once for every CSV, so that ROAD_CACHE is kept between them
+        causedecoder = causeDecoderCSV(causes)
+        streetdecoder = streetDecoderCSV(streets)
         for d in data: # For each CSV of source data
-            for crash in get_crashes(d, causes, streets, holidays, global_start, global_end):
-                feature_collection["features"].append(crash.__geo_interface__())
-        # Write the geojson output
-        outfile.write(json.dumps(feature_collection, separators=(',',':')))
-        outfile.close()
+            for crash in read_crashes(d, causedecoder, streetdecoder, holidays,
+                    global_start, global_end, daylight_cache=daylight_cache):
+                yield encoder.encode(crash.__geo_interface__())
+
+def add_features(features, writers, decode=False):
+    '''
+    Yields each of the encoded `features` and its dictionary, after adding
+    it to each of the `writers` (see main()). Writers with `decoded` set
+    are given the dictionary, the others the encoded feature. It is decoded
+    only once, and only if such a writer or `decode` needs it; otherwise
+    the dictionary is None.
+    '''
+    encoded = [writer for writer in writers if not getattr(writer, 'decoded', False)]
+    decoded = [writer for writer in writers if getattr(writer, 'decoded', False)]
+    decode = decode or bool(decoded)
+    for feature in features:
+        for writer in encoded:
+            writer.add(feature)
+        if decode:
+            dictionary = json.loads(feature)
+            for writer in decoded:
+                writer.add(dictionary)
+        else:
+            dictionary = None
+        yield feature, dictionary
+
+def write_outputs(features, geojson, dictionary, precision, gzip_level, brotli_level):
+    '''Writes `features`, (encoded, dictionary) pairs from add_features(), to
+    ../data/data.geojson if `geojson` (see main()), or otherwise just reads
+    them, for the writers they are added to'''
+    if geojson:
+        outpath = '../data/data.geojson'
+        if brotli_level is not None and compressed.brotli is None:
+            logging.warning('brotli is not installed, so %s.br is not written' % outpath)
+        # Written to temporary files and renamed into place once complete,
+        # removing any .gz or .br left by an earlier run that this one does
+        # not write
+        with compressed.CompressedWriter(outpath, gzip_level=gzip_level,
+                brotli_level=brotli_level) as outfile:
+            # Write the geojson output, one feature at a time
+            if dictionary:
+                write_dictionary_collection((decoded for encoded, decoded in features),
+                    outfile, precision=precision, decoded=True)
+            else:
+                write_feature_collection((encoded for encoded, decoded in features),
+                    outfile, encoded=True)
+        if gzip_level is not None or brotli_level is not None:
+            logging.info('Output: %s' % outfile.stats())
+    else:
+        for feature in features:
+            pass
+
+def main(data, causes, streets, holidays, global_start, global_end, workers=1, chunksize=5000, daylight_cache=None, build_cache=None, tail=False, tile_writer=None, partition_writer=None, columnar_writer=None, dictionary=False, precision=6,
+         gzip_level=None, brotli_level=None, bitmap_index=None):
+    '''
+    Converts the crash CSVs listed in `data` to ../data/data.geojson (see
+    convert()), or if a tiles.TileWriter is given as `tile_writer`, to its pyramid
+    of tiles instead, and/or if a partitions.PartitionWriter is given as
+    `partition_writer`, to its files of each month. A columnar.ColumnarWriter
+    given as `columnar_writer` is written as well as any of them, and so is a
+    bitmapindex.BitmapIndex given as `bitmap_index` built from them.
+
+    If `dictionary`, data.geojson is dictionary-encoded, with its coordinates
+    rounded to `precision` decimal places (see write_dictionary_collection()).
+
+    If `gzip_level` or `brotli_level` is given, data.geojson.gz or
+    data.geojson.br (if brotli is installed) is compressed at that level
+    while data.geojson is written (see compressed.CompressedWriter), and the
+    size and time of each is logged. A variant this run does not write is
+    removed, rather than left stale beside the new data.geojson.
+
+    If a buildcache.BuildCache is given as `build_cache`, the features of
+    each CSV that has not changed since a previous run are spliced in from
+    it, and only the others are converted (and then kept in it). If `tail`,
+    a CSV that has only had rows appended to it since then has only the new
+    rows converted (in this process), and appended to its features.
+    '''
+    def convert_files(files):
+        return convert(files, causes, streets, holidays, global_start, global_end,
+            workers=workers, chunksize=chunksize, daylight_cache=daylight_cache)
+
+    def convert_tail(file, offset):
+        encoder = json.JSONEncoder(separators=(',',':'))
+        return (encoder.encode(crash.__geo_interface__()) for crash in get_crashes(file,
+            causes, streets, holidays, global_start, global_end,
+            daylight_cache=daylight_cache, offset=offset))
+
+    if build_cache is None:
+        features = convert_files(data)
+    else:
+        build_cache.depend(
+            # The converter itself, and the decoders
+            files=[buildcache.source_file(f) for f in (__file__, genFunc.__file__,
+                decoders.__file__, moon.__file__, sun.__file__)] + [causes, streets],
+            values=[sorted(holidays.items()), global_start, global_end,
+                None if daylight_cache is None else (daylight_cache.grid, daylight_cache.twilight)])
+        if tail:
+            features = build_cache.features(data, convert_files, convert_tail, last_crash_id)
+        else:
+            features = build_cache.features(data, convert_files)
+
+    writers = [writer for writer in (tile_writer, partition_writer, columnar_writer,
+               bitmap_index) if writer is not None]
+    try:
+        write_outputs(add_features(features, writers, decode=dictionary), tile_writer is None and
+            partition_writer is None, dictionary, precision, gzip_level, brotli_level)
+        for writer in writers:
+            writer.close()
+    except:
+        # Don't leave half-written directories of tiles or months behind
+        for writer in writers:
+            discard = getattr(writer, 'discard', None)
+            if discard is not None:
+                discard()
+        raise
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts NZTA crash CSVs to GeoJSON')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of processes to convert with (default: 1)')
+    parser.add_argument('--chunksize', type=int, default=5000,
+        help='number of CSV rows in each unit of work, if --workers > 1 (default: 5000)')
+    parser.add_argument('--daylight-cache', metavar='FILE',
+        help='look up sunrise and sunset in a cache, kept in FILE between runs')
+    parser.add_argument('--daylight-grid', type=float, default=0.05,
+        help='grid cell size of the daylight cache, in degrees (default: 0.05)')
+    parser.add_argument('--road-cache-size', type=int, default=100000,
+        help='number of formatted road names to keep in memory, 0 for none (default: 100000)')
+    parser.add_argument('--build-cache', metavar='DIR',
+        help='keep the features of each CSV in DIR, and only convert the CSVs that have changed since')
+    parser.add_argument('--tail', action='store_true',
+        help='with --build-cache, only convert the rows appended to a CSV since, if the rest is unchanged')
+    parser.add_argument('--tiles', metavar='DIR',
+        help='write a pyramid of z/x/y GeoJSON tiles to DIR, instead of ../data/data.geojson')
+    parser.add_argument('--min-zoom', type=int, default=5,
+        help='shallowest zoom of --tiles (default: 5)')
+    parser.add_argument('--max-zoom', type=int, default=12,
+        help='deepest zoom of --tiles, the only one not thinned (default: 12)')
+    parser.add_argument('--partitions', metavar='DIR',
+        help='write a GeoJSON file per month to DIR, instead of ../data/data.geojson')
+    parser.add_argument('--columnar', metavar='FILE',
+        help='also write the features to FILE in a compact binary columnar format')
+    parser.add_argument('--dictionary', action='store_true',
+        help='write the repeated properties of data.geojson once, in a lookup table that features index')
+    parser.add_argument('--precision', type=int, default=6,
+        help='decimal places of the coordinates, with --dictionary (default: 6)')
+    parser.add_argument('--gzip', type=int, metavar='LEVEL',
+        help='also write data.geojson.gz, compressed at LEVEL (1-9)')
+    parser.add_argument('--brotli', type=int, metavar='LEVEL',
+        help='also write data.geojson.br, compressed at LEVEL (0-11), if brotli is installed')
+    parser.add_argument('--bitmap-index', metavar='FILE',
+        help='also write a bitmap index of the properties the map filters on to FILE (.npz)')
+    args = parser.parse_args()
+    if args.road_cache_size < 0:
+        parser.error('--road-cache-size must not be negative')
+
     # TODO specify paths with os.path
     global_start = datetime.date(2015,1,1)
     global_end = datetime.date(2015,3,31)
@@ -957,5 +1304,63 @@ if __name__ == '__main__':
 
     logging.basicConfig(filename=logger, level=logging.DEBUG)
 
+    ROAD_CACHE.maxsize = args.road_cache_size
+
+    if args.daylight_cache is not None:
+        daylight_cache = sun.SolarEventCache(grid=args.daylight_grid, path=args.daylight_cache)
+    else:
+        daylight_cache = None
+
+    if args.build_cache is not None:
+        build_cache = buildcache.BuildCache(args.build_cache)
+    else:
+        build_cache = None
+
+    if args.tiles is not None:
+        try:
+            tile_writer = tiles.TileWriter(args.tiles, min_zoom=args.min_zoom, max_zoom=args.max_zoom)
+        except ValueError as e:
+            parser.error('--tiles: %s' % e)
+    else:
+        tile_writer = None
+
+    if args.partitions is not None:
+        try:
+            partition_writer = partitions.PartitionWriter(args.partitions)
+        except ValueError as e:
+            parser.error('--partitions: %s' % e)
+    else:
+        partition_writer = None
+
+    if args.columnar is not None:
+        columnar_writer = columnar.ColumnarWriter(args.columnar)
+    else:
+        columnar_writer = None
+
+    if args.bitmap_index is not None:
+        bitmap_index = bitmapindex.BitmapIndex(args.bitmap_index)
+    else:
+        bitmap_index = None
+
     # Run main function
-    main(data, causes, streets, holidays, global_start, global_end)
+    main(data, causes, streets, holidays, global_start, global_end,
+        workers=args.workers, chunksize=args.chunksize, daylight_cache=daylight_cache,
+        build_cache=build_cache, tail=args.tail, tile_writer=tile_writer,
+        partition_writer=partition_writer, columnar_writer=columnar_writer,
+        dictionary=args.dictionary, precision=args.precision,
+        gzip_level=args.gzip, brotli_level=args.brotli, bitmap_index=bitmap_index)
+
+    logging.info('Road cache: %s' % ROAD_CACHE.stats())
+    if build_cache is not None:
+        logging.info('Build cache: %s, %d unused entries removed' % (build_cache.stats(), build_cache.prune()))
+    if daylight_cache is not None:
+        logging.info('Daylight cache: %s' % daylight_cache.stats())
+        daylight_cache.save()
+    if tile_writer is not None:
+        logging.info('Tiles: %s' % tile_writer.stats())
+    if partition_writer is not None:
+        logging.info('Partitions: %s' % partition_writer.stats())
+    if columnar_writer is not None:
+        logging.info('Columnar: %s' % columnar_writer.stats())
+    if bitmap_index is not None:
+        logging.info('Bitmap index: %s' % bitmap_index.stats())
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`partitions.py`
+===============
+Writes crash features as one GeoJSON file per (New Zealand) month, instead
+of a single data.geojson, so that a client showing a range of time only
+downloads the months that overlap it.
+
+The features of each month are sorted by their time (`unixt`), and a
+manifest.json lists each month's file, the first and last `unixt` in it,
+its number of features and its size in bytes. Features without a time go
+in `unknown.geojson`.
+
+Partitioning is done in a single pass over the features, which are spooled
+to disk `flush` at a time; only one month is held in memory at once, to sort
+it, when the files are finished. They are written to a new directory, which
+then replaces the old one, so no months of an earlier run are left beside
+the new manifest.
+
+Import it: from partitions import PartitionWriter
+
+Depends
+=======
+pytz
+'''
+
+import os
+import re
+import json
+import shutil
+import datetime
+from calendar import timegm
+
+import pytz
+
+import generalFunctions as genFunc
+
+# The time of an encoded GeoJSON feature (see nzta2geojson.nztacrash.__geo_interface__())
+UNIXT = re.compile(r'"unixt":(-?\d+)')
+
+TIMEZONE = pytz.timezone('Pacific/Auckland')
+
+UNKNOWN = 'unknown'
+
+
+def feature_unixt(feature):
+    '''Returns the `unixt` (POSIX milliseconds) of an encoded GeoJSON
+    feature, or None if it has none'''
+    match = UNIXT.search(feature)
+    return int(match.group(1)) if match is not None else None
+
+def local_unixt(year, month):
+    '''Returns the POSIX milliseconds of the start of `month` of `year` in
+    New Zealand'''
+    start = TIMEZONE.localize(datetime.datetime(year, month, 1))
+    return timegm(start.utctimetuple()) * 1000
+
+
+class PartitionWriter(object):
+    '''
+    I write encoded GeoJSON features (see add()) to a file per month under
+    `directory`, named YYYY-MM.geojson. Call close() when they are all
+    added, to sort and finish the files and write the manifest, and only
+    then replace `directory` with them; it must be empty or hold an earlier
+    run's files (see generalFunctions.check_replaceable()). Call discard()
+    instead, if the features cannot all be added.
+
+    Features are buffered, and spooled to disk `flush` at a time.
+    '''
+    def __init__(self, directory, flush=50000):
+        genFunc.check_replaceable(directory)
+        self.directory = directory
+        self.building = None # Made when the first features are spooled
+        self.flush_size = flush
+        self.encoder = json.JSONEncoder(separators=(',',':'))
+        # Let the encoder decide the key order of a month's collection
+        self.header, self.footer = self.encoder.encode(
+            {"type": "FeatureCollection","features": []}).split('[]')
+        self.buffer = {}
+        self.buffered = 0
+        self.spooled = set()
+        # The last month looked up: (start, end, name), in POSIX milliseconds
+        self.month = (0, 0, None)
+        self.added = 0
+
+    def partition(self, unixt):
+        '''Returns the name of the month of the POSIX milliseconds `unixt`'''
+        if unixt is None:
+            return UNKNOWN
+        start, end, name = self.month
+        if start <= unixt < end:
+            return name
+        # Crashes mostly come in order, so each month is only worked out once
+        local = datetime.datetime.fromtimestamp(unixt // 1000, TIMEZONE)
+        year, month = local.year, local.month
+        following = (year + month // 12, month % 12 + 1)
+        self.month = (local_unixt(year, month), local_unixt(*following),
+                      '%04d-%02d' % (year, month))
+        return self.month[2]
+
+    def path(self, name, kind='geojson'):
+        return os.path.join(self.building, '%s.%s' % (name, kind))
+
+    def add(self, feature):
+        '''Adds an encoded GeoJSON feature to the file of its month'''
+        unixt = feature_unixt(feature)
+        self.buffer.setdefault(self.partition(unixt), []).append(
+            '%s\t%s\n' % ('' if unixt is None else unixt, feature))
+        self.buffered += 1
+        self.added += 1
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        '''Appends the buffered features to the spool of their months'''
+        if self.building is None:
+            self.building = genFunc.building_directory(self.directory)
+        for name, lines in self.buffer.iteritems():
+            with open(self.path(name, 'spool'), 'ab' if name in self.spooled else 'wb') as f:
+                f.writelines(lines)
+            self.spooled.add(name)
+        self.buffer = {}
+        self.buffered = 0
+
+    def finish(self, name):
+        '''Writes the sorted features of the month `name` from its spool, and
+        returns its manifest entry'''
+        spool = self.path(name, 'spool')
+        with open(spool, 'rb') as f:
+            rows = [line.rstrip('\n').split('\t', 1) for line in f]
+        os.remove(spool)
+        # Stable, so features of the same time keep their order
+        rows.sort(key=lambda row: int(row[0]) if row[0] else None)
+        with open(self.path(name), 'wb') as f:
+            f.write(self.header + '[')
+            f.write(','.join(feature for unixt, feature in rows))
+            f.write(']' + self.footer)
+        times = [int(unixt) for unixt, feature in rows if unixt]
+        return {
+            'name': name,
+            'file': os.path.basename(self.path(name)),
+            'start': times[0] if times else None,
+            'end': times[-1] if times else None,
+            'features': len(rows),
+            'bytes': os.path.getsize(self.path(name))
+        }
+
+    def close(self):
+        '''Sorts and writes every month's file, and manifest.json, and
+        replaces my directory with them'''
+        self.flush()
+        partitions = [self.finish(name) for name in sorted(self.spooled)]
+        with open(os.path.join(self.building, 'manifest.json'), 'wb') as f:
+            f.write(self.encoder.encode({
+                'format': 'geojson',
+                'partition': 'month',
+                'timezone': TIMEZONE.zone,
+                'features': self.added,
+                'partitions': partitions
+            }))
+        genFunc.replace_directory(self.directory, self.building)
+        self.building = None
+
+    def discard(self):
+        '''Removes the files I have written so far, leaving my directory as
+        it was'''
+        if self.building is not None:
+            shutil.rmtree(self.building, True)
+            self.building = None
+
+    def stats(self):
+        '''Returns a dictionary of the number of features and months written'''
+        return {'added': self.added, 'partitions': len(self.spooled)}
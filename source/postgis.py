@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`postgis.py`
+============
+Loads crashes straight into a PostGIS table with COPY, instead of writing
+data.geojson and loading that with ogr2ogr (sql/ogr_geojson2postgres.sh),
+then deriving the crash date with an UPDATE of every row (sql/utils.sql).
+
+Crashes are streamed from get_crashes() as rows of COPY's text format, with
+typed columns: the time of the crash as a timestamptz, the GeoJSON's 0/1
+flags as booleans, the coded lists as text[], the nested properties as json,
+and the location as a PostGIS point in NZTM (EPSG:2193), from the crash's
+projected coordinates. The spatial and time indexes are built once the rows
+are loaded, which is much faster than maintaining them row by row.
+
+Run it with a libpq connection string, e.g. against a throwaway server:
+
+    docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=crash postgis/postgis
+    python postgis.py 'host=localhost user=postgres password=crash'
+
+With --check, it instead loads the crashes into a temporary schema, checks
+them (see check()), and drops it.
+
+Import it: from postgis import load
+
+Depends
+=======
+psycopg2 (only to connect, in __main__), PostGIS (in the database)
+'''
+
+import os
+import json
+import time
+import logging
+import datetime
+import argparse
+
+import nzta2geojson
+from decoders import FACTORS
+
+# NZTM, the projection of the CSV's eastings and northings
+SRID = 2193
+
+# Boolean attributes of an nztacrash, loaded as they are named
+MODE_FLAGS = ('pedestrian', 'cyclist', 'motorcyclist', 'taxi', 'truck', 'car')
+FACTOR_FLAGS = tuple(name for name, codes in FACTORS)
+
+# (column, type) of the table, in the order of the values of crash_row()
+COLUMNS = (
+    ('crash_id', 'text'),
+    ('crash_date', 'timestamptz'),
+    ('unixt', 'bigint'),
+    ('tla_name', 'text'),
+    ('road', 'text'),
+    ('holiday', 'text'),
+    ('fatal_count', 'integer'),
+    ('severe_count', 'integer'),
+    ('minor_count', 'integer'),
+    ('worst_injury', 'text'),
+    ('child_injured', 'boolean'),
+    ('child_age', 'integer'),
+    ('daylight', 'boolean'),
+    ('speed_limit', 'integer'),
+    ('speed_zone', 'text'),
+    ('junction', 'text'),
+    ('traffic_control', 'text'),
+    ('curve', 'text'),
+    ('light', 'text[]'),
+    ('weather', 'text[]'),
+    ('moonphase', 'integer'),
+    ('moontext', 'text'),
+    ('chathams', 'boolean')
+) + tuple((flag, 'boolean') for flag in MODE_FLAGS + FACTOR_FLAGS) + (
+    ('causes', 'json'),
+    ('vehicles', 'json'),
+    ('modes', 'json'),
+    ('injuries', 'json'),
+    ('geom', 'geometry(Point, %d)' % SRID)
+)
+
+# (name, column, method) of the indexes built after loading
+INDEXES = (
+    ('crash_id', 'crash_id', 'btree'),
+    ('crash_date', 'crash_date', 'btree'),
+    ('geom', 'geom', 'gist')
+)
+
+# Escapes of COPY's text format
+ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+
+
+def copy_value(value):
+    '''Returns `value` as a field of COPY's text format'''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return ''.join(ESCAPES.get(c, c) for c in value) if any(c in value for c in ESCAPES) else value
+
+def array_value(codes):
+    '''Returns a list of single-character codes as a text[] literal'''
+    return '{%s}' % ','.join(code for code in codes if code.strip())
+
+def json_value(value):
+    '''Returns `value` as JSON, or None (SQL null) if it is None'''
+    return None if value is None else json.dumps(value, separators=(',',':'))
+
+def crash_row(crash):
+    '''Returns the values of the COLUMNS of an nztacrash'''
+    if isinstance(crash.spd_lim, int):
+        speed_limit, speed_zone = crash.spd_lim, None
+    else:
+        speed_limit, speed_zone = None, crash.spd_lim
+    if crash.hasLocation:
+        geom = 'SRID=%d;POINT(%d %d)' % (SRID, crash.easting, crash.northing)
+    else:
+        geom = None
+    return [
+        crash.crash_id,
+        crash.get_crash_datetime(as_utc=True),
+        crash.get_unix_time(),
+        crash.tla_name,
+        nzta2geojson.ROAD_CACHE.nice(crash.get_crashroad()),
+        crash.holiday_name,
+        crash.crash_fatal_cnt,
+        crash.crash_sev_cnt,
+        crash.crash_min_cnt,
+        crash.get_worst_injury_text(),
+        bool(crash.get_injured_child()),
+        crash.get_injured_child_age(),
+        None if crash.daytime is None else bool(crash.daytime),
+        speed_limit,
+        speed_zone,
+        crash.junc_type,
+        crash.traf_ctrl if crash.traf_ctrl != 'N' else None,
+        crash.road_curve,
+        array_value(crash.light),
+        array_value(crash.wthr_a),
+        crash.moonphase,
+        crash.moontext,
+        bool(crash.chathams)
+    ] + [bool(getattr(crash, flag)) for flag in MODE_FLAGS + FACTOR_FLAGS] + [
+        json_value(crash.causesdict),
+        json_value(crash.get_number_of_vehicles()),
+        json_value(crash.mapVehicles()),
+        json_value(crash.get_injury_counts()),
+        geom
+    ]
+
+def copy_lines(crashes):
+    '''Generates the lines of COPY's text format for an iterable of crashes'''
+    for crash in crashes:
+        yield '\t'.join(copy_value(value) for value in crash_row(crash)) + '\n'
+
+
+class LineReader(object):
+    '''I give the lines of an iterator to psycopg2's copy_expert(), as a
+    file that it reads `size` bytes at a time'''
+    def __init__(self, lines):
+        self.lines = lines
+        self.pending = ''
+
+    def read(self, size=-1):
+        chunks, length = [self.pending], len(self.pending)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            self.pending = ''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+
+def load(connection, crashes, table='cas_crashes', replace=True):
+    '''
+    Loads an iterable of nztacrashes into `table` (replacing it, if
+    `replace`) over the psycopg2 `connection` with COPY, builds its indexes,
+    and commits. Returns the number of crashes loaded.
+    '''
+    cursor = connection.cursor()
+    if replace:
+        cursor.execute('DROP TABLE IF EXISTS %s' % table)
+    cursor.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+    cursor.execute('CREATE TABLE %s (%s)' % (table,
+        ', '.join('%s %s' % column for column in COLUMNS)))
+    columns = ', '.join(name for name, kind in COLUMNS)
+    cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, columns),
+        LineReader(copy_lines(crashes)))
+    for name, column, method in INDEXES:
+        cursor.execute('CREATE INDEX %s_%s_idx ON %s USING %s (%s)' % (
+            table, name, table, method, column))
+    cursor.execute('ANALYZE %s' % table)
+    cursor.execute('SELECT count(*) FROM %s' % table)
+    count = cursor.fetchone()[0]
+    connection.commit()
+    return count
+
+def check(connection, crashes):
+    '''
+    Loads a list of nztacrashes (see load()) into a temporary schema over
+    the psycopg2 `connection`, and asserts that every crash was loaded, that
+    the first one reads back as it was written, and that a query of a box
+    around it uses the spatial index. The schema is dropped afterwards.
+    '''
+    schema = 'cas_check_%d' % os.getpid()
+    table = 'cas_crashes'
+    cursor = connection.cursor()
+    cursor.execute('CREATE SCHEMA %s' % schema)
+    connection.commit()
+    try:
+        # PostGIS (if it is not installed yet) and the table go in the
+        # schema. Not replacing, which could drop a table of the same name
+        # in public.
+        cursor.execute('SET search_path TO %s, public' % schema)
+        count = load(connection, crashes, table=table, replace=False)
+        assert count == len(crashes), 'loaded %d of %d crashes' % (count, len(crashes))
+
+        crash = crashes[0]
+        expected = dict(zip([name for name, kind in COLUMNS], crash_row(crash)))
+        # psycopg2 reads json columns back as Python values
+        expected['causes'] = json.loads(expected['causes']) if expected['causes'] else None
+        names = ('unixt', 'tla_name', 'road', 'fatal_count', 'severe_count', 'minor_count',
+                 'speed_limit', 'speed_zone', 'moonphase', 'chathams', 'causes')
+        cursor.execute('SELECT %s, (extract(epoch FROM crash_date) * 1000)::bigint,'
+            ' ST_X(geom), ST_Y(geom) FROM %s WHERE crash_id = %%s' % (', '.join(names), table),
+            (crash.crash_id,))
+        rows = cursor.fetchall()
+        assert len(rows) == 1, '%d rows of crash %s' % (len(rows), crash.crash_id)
+        values, (epoch, x, y) = list(rows[0][:len(names)]), rows[0][len(names):]
+        assert values == [expected[name] for name in names], values
+        assert epoch == expected['unixt'], (epoch, expected['unixt'])
+        if crash.hasLocation:
+            assert (x, y) == (crash.easting, crash.northing), (x, y)
+
+            # A scan may be cheaper than the index for a small table
+            cursor.execute('SET enable_seqscan = off')
+            cursor.execute('EXPLAIN SELECT crash_id FROM %s WHERE geom && ST_MakeEnvelope(%%s, %%s, %%s, %%s, %d)'
+                % (table, SRID), (x - 500, y - 500, x + 500, y + 500))
+            plan = '\n'.join(line for line, in cursor.fetchall())
+            assert '%s_geom_idx' % table in plan, plan
+            cursor.execute('RESET enable_seqscan')
+    finally:
+        connection.rollback()
+        cursor.execute('DROP SCHEMA %s CASCADE' % schema)
+        connection.commit()
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Loads NZTA crash CSVs into PostGIS')
+    parser.add_argument('dsn', help='libpq connection string of the database')
+    parser.add_argument('--table', default='cas_crashes',
+        help='name of the table to (re)create (default: cas_crashes)')
+    parser.add_argument('--check', action='store_true',
+        help='load into a temporary schema and check the load, instead of loading the table')
+    args = parser.parse_args()
+
+    import psycopg2
+
+    # As nzta2geojson.py
+    global_start = datetime.date(2015,1,1)
+    global_end = datetime.date(2015,3,31)
+    data = ['../data/crash-data-{i}.csv'.format(i=i) if i < 2015 else '../data/crash-data-{i}-partial.csv'.format(i=i) for i in xrange(global_start.year, global_end.year + 1)]
+    causes = '../data/decoders/cause-decoder.csv'
+    streets = '../data/decoders/NZ-post-street-types.csv'
+    holidays = nzta2geojson.get_official_holiday_periods()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    crashes = (crash for file in data for crash in nzta2geojson.get_crashes(file,
+        causes, streets, holidays, global_start, global_end))
+    connection = psycopg2.connect(args.dsn)
+    try:
+        if args.check:
+            count = check(connection, list(crashes))
+        else:
+            count = load(connection, crashes, table=args.table)
+    finally:
+        connection.close()
+    if args.check:
+        logging.info('Checked a load of %d crashes in %.1fs' % (count, time.time() - start))
+    else:
+        logging.info('Loaded %d crashes into %s in %.1fs' % (count, args.table, time.time() - start))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`spatialindex.py`
+=================
+An in-memory spatial index of crashes, for "which crashes are in this box",
+"within 500 m of this point" and "the 10 nearest to this point", without
+scanning every crash.
+
+The index is a packed grid over the NZTM eastings and northings that
+nztacrash already has (in metres, so distances are simply Euclidean): the
+points are sorted by the `cell` metre square they fall in, and an offset per
+cell gives where its points start, so the points of a row of cells are one
+contiguous slice. A query only looks at the rows of cells it overlaps.
+
+Queries return the positions of the crashes in the sequence the index was
+built from. save() writes the index as a directory of .npy files, which
+load() maps back into memory without reading them.
+
+Import it: from spatialindex import GridIndex
+Run it to benchmark queries over ten million synthetic crashes.
+
+Depends
+=======
+numpy
+'''
+
+import os
+
+import numpy as np
+
+# Files of a saved index, and their arrays
+ARRAYS = ('eastings', 'northings', 'ids', 'offsets')
+
+
+class GridIndex(object):
+    '''
+    I index points by the `cell` metre square of a grid they fall in (see
+    from_points()). My arrays are the points' `eastings`, `northings` and
+    `ids` (positions in the sequence I was built from), sorted by cell, and
+    the `offsets` at which each cell's points start.
+    '''
+    def __init__(self, eastings, northings, ids, offsets, origin, shape, cell):
+        self.eastings, self.northings, self.ids = eastings, northings, ids
+        self.offsets = offsets
+        self.origin = origin # (easting, northing) of the grid's corner
+        self.shape = shape # (rows, columns)
+        self.cell = cell
+
+    @classmethod
+    def from_points(cls, eastings, northings, cell=1000):
+        '''Returns an index of the points (`eastings`, `northings`), in
+        metres. Points where either is NaN are left out.'''
+        eastings = np.asarray(eastings, dtype=np.float64)
+        northings = np.asarray(northings, dtype=np.float64)
+        ids = np.flatnonzero(~(np.isnan(eastings) | np.isnan(northings)))
+        eastings, northings = eastings[ids], northings[ids]
+        if len(ids):
+            origin = (np.floor(eastings.min() / cell) * cell,
+                      np.floor(northings.min() / cell) * cell)
+            columns = int((eastings.max() - origin[0]) // cell) + 1
+            rows = int((northings.max() - origin[1]) // cell) + 1
+        else:
+            origin, rows, columns = (0.0, 0.0), 1, 1
+        cells = (((northings - origin[1]) // cell).astype(np.int64) * columns +
+                 ((eastings - origin[0]) // cell).astype(np.int64))
+        order = np.argsort(cells, kind='mergesort')
+        counts = np.bincount(cells, minlength=rows * columns)
+        offsets = np.zeros(rows * columns + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(eastings[order], northings[order], ids[order].astype(np.int64),
+                   offsets, origin, (rows, columns), cell)
+
+    @classmethod
+    def from_crashes(cls, crashes, cell=1000):
+        '''Returns an index of the NZTM locations of a sequence of nztacrashes
+        (those without one are left out)'''
+        eastings = [c.easting if c.hasLocation else np.nan for c in crashes]
+        northings = [c.northing if c.hasLocation else np.nan for c in crashes]
+        return cls.from_points(eastings, northings, cell=cell)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def candidates(self, west, south, east, north):
+        '''Returns the positions (in my sorted arrays) of the points in the
+        cells that overlap a box'''
+        rows, columns = self.shape
+        x0 = max(int((west - self.origin[0]) // self.cell), 0)
+        x1 = min(int((east - self.origin[0]) // self.cell), columns - 1)
+        y0 = max(int((south - self.origin[1]) // self.cell), 0)
+        y1 = min(int((north - self.origin[1]) // self.cell), rows - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+        offsets = self.offsets
+        starts = offsets[np.arange(y0, y1 + 1) * columns + x0]
+        ends = offsets[np.arange(y0, y1 + 1) * columns + x1 + 1]
+        if len(starts) == 1:
+            return np.arange(starts[0], ends[0])
+        return np.concatenate([np.arange(start, end) for start, end in
+                               zip(starts.tolist(), ends.tolist())])
+
+    def bbox(self, west, south, east, north):
+        '''Returns the ids of the points in a box (edges included)'''
+        found = self.candidates(west, south, east, north)
+        x, y = self.eastings[found], self.northings[found]
+        inside = (x >= west) & (x <= east) & (y >= south) & (y <= north)
+        return self.ids[found[inside]]
+
+    def within(self, easting, northing, radius, distances=False):
+        '''Returns the ids of the points within `radius` metres of a point,
+        nearest first (and their distances, if `distances`)'''
+        found = self.candidates(easting - radius, northing - radius,
+                                easting + radius, northing + radius)
+        squared = (self.eastings[found] - easting) ** 2 + (self.northings[found] - northing) ** 2
+        inside = np.flatnonzero(squared <= radius * radius)
+        inside = inside[np.argsort(squared[inside], kind='mergesort')]
+        ids = self.ids[found[inside]]
+        if distances:
+            return ids, np.sqrt(squared[inside])
+        return ids
+
+    def nearest(self, easting, northing, k=1, distances=False):
+        '''Returns the ids of the `k` points nearest to a point, nearest first
+        (and their distances, if `distances`)'''
+        k = min(k, len(self))
+        radius = float(self.cell)
+        rows, columns = self.shape
+        # No point is further away than the far corner of the grid
+        furthest = np.hypot(max(abs(easting - self.origin[0]),
+                                abs(easting - self.origin[0] - columns * self.cell)),
+                            max(abs(northing - self.origin[1]),
+                                abs(northing - self.origin[1] - rows * self.cell)))
+        while True:
+            # Every point within `radius` is among the candidates of its
+            # box, so once there are k of them, they include the k nearest
+            ids, found = self.within(easting, northing, radius, distances=True)
+            if len(ids) >= k or radius >= furthest:
+                break
+            radius *= 2
+        if distances:
+            return ids[:k], found[:k]
+        return ids[:k]
+
+    def save(self, directory):
+        '''Writes me to `directory` (made if it does not exist)'''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(directory, 'grid.npy'),
+                np.array([self.origin[0], self.origin[1], self.shape[0], self.shape[1], self.cell],
+                         dtype=np.float64))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        '''Returns the index saved in `directory`, with its arrays mapped
+        from disk (see numpy.load())'''
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in ARRAYS]
+        east, north, rows, columns, cell = np.load(os.path.join(directory, 'grid.npy')).tolist()
+        return cls(*arrays, origin=(east, north), shape=(int(rows), int(columns)), cell=cell)
+
+
+if __name__ == '__main__':
+    # Benchmark queries over ten million synthetic crashes, clustered like
+    # real ones around towns, and check them against a scan of the points
+    import time
+    import shutil
+    import tempfile
+
+    def best(query, queries, repeat=3):
+        '''Returns the best mean seconds per call of `query` over `queries`'''
+        times = []
+        for i in xrange(repeat):
+            start = time.time()
+            for q in queries:
+                query(*q)
+            times.append((time.time() - start) / len(queries))
+        return min(times)
+
+    rng = np.random.RandomState(2015)
+    count = 10 ** 7
+    # NZTM extent of the mainland, and towns within it
+    towns = np.column_stack([rng.uniform(1.1e6, 2.1e6, 500), rng.uniform(4.75e6, 6.2e6, 500)])
+    town = rng.randint(0, len(towns), count)
+    eastings = np.round(towns[town, 0] + rng.normal(0, 5000, count))
+    northings = np.round(towns[town, 1] + rng.normal(0, 5000, count))
+
+    start = time.time()
+    index = GridIndex.from_points(eastings, northings, cell=500)
+    print '%d points indexed in %.1fs' % (len(index), time.time() - start)
+
+    directory = tempfile.mkdtemp()
+    try:
+        index.save(directory)
+        start = time.time()
+        index = GridIndex.load(directory)
+        print 'Reloaded in %.1fms' % ((time.time() - start) * 1000)
+
+        points = towns[rng.randint(0, len(towns), 1000)] + rng.normal(0, 5000, (1000, 2))
+        boxes = [(e - 250, n - 250, e + 250, n + 250) for e, n in points]
+        circles = [(e, n, 500) for e, n in points]
+        nearests = [(e, n, 10) for e, n in points]
+
+        for (e, n), box in zip(points[:5], boxes[:5]):
+            # Against a scan of every point
+            scan = np.flatnonzero((eastings >= box[0]) & (eastings <= box[2]) &
+                                  (northings >= box[1]) & (northings <= box[3]))
+            assert sorted(index.bbox(*box).tolist()) == scan.tolist()
+            squared = (eastings - e) ** 2 + (northings - n) ** 2
+            scan = np.flatnonzero(squared <= 500 ** 2)
+            assert sorted(index.within(e, n, 500).tolist()) == sorted(scan.tolist())
+            ids, distances = index.nearest(e, n, 10, distances=True)
+            assert np.allclose(distances ** 2, np.sort(squared)[:10])
+
+        for name, query, queries in (('bbox 500 m', index.bbox, boxes),
+                                     ('within 500 m', index.within, circles),
+                                     ('10 nearest', index.nearest, nearests)):
+            found = np.mean([len(query(*q)) for q in queries])
+            print '%-12s %.3fms per query (%.0f crashes found on average)' % (
+                name, best(query, queries) * 1000, found)
+    finally:
+        del index
+        shutil.rmtree(directory)
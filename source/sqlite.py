@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`sqlite.py`
+===========
+Exports crashes to a SQLite file for offline analysis: one row per crash of
+its typed fields and derived flags, with an R*Tree index of the crash
+locations, and B-tree indexes of the time, the Territorial Local Authority
+and the severity, so that box and time queries over every year take
+milliseconds, without parsing any GeoJSON.
+
+Rows are inserted with executemany(), `batch` at a time, in one transaction,
+and the indexes are built once they are all in.
+
+    SELECT c.* FROM crashes c JOIN crashes_rtree r ON c.id = r.id
+    WHERE r.min_lon <= 174.8 AND r.max_lon >= 174.7
+      AND r.min_lat <= -41.2 AND r.max_lat >= -41.3
+      AND c.unixt BETWEEN 1420023600000 AND 1422702000000
+
+(see query()). The R*Tree holds 32-bit floats, rounded outwards, so a box
+also matches crashes within a metre or so of its edges.
+
+Run it to export the crashes that nzta2geojson.py converts, and time a query.
+
+Import it: from sqlite import export
+
+Depends
+=======
+sqlite3 (with the R*Tree module, as in the usual builds), pytz
+'''
+
+import os
+import time
+import sqlite3
+import logging
+import datetime
+import argparse
+from calendar import timegm
+
+import pytz
+
+import nzta2geojson
+from crashrecord import FLAGS
+
+# Severity of the worst injury, for the severity index
+SEVERITY = {'f': 3, 's': 2, 'm': 1, 'n': 0}
+
+# (column, type) of the crashes table, in the order of the values of
+# crash_row(). id is the rowid, and the key of the R*Tree.
+COLUMNS = (
+    ('id', 'INTEGER PRIMARY KEY'),
+    ('crash_id', 'TEXT'),
+    ('crash_date', 'TEXT'), # ISO 8601, local
+    ('crash_time', 'TEXT'), # HH:MM, local
+    ('unixt', 'INTEGER'), # POSIX milliseconds
+    ('tla_name', 'TEXT'),
+    ('crash_road', 'TEXT'),
+    ('crash_dist', 'INTEGER'),
+    ('crash_dirn', 'TEXT'),
+    ('crash_intsn', 'TEXT'),
+    ('side_road', 'TEXT'),
+    ('road', 'TEXT'), # Nicely formatted
+    ('mvmt', 'TEXT'),
+    ('vehicles', 'TEXT'),
+    ('causes', 'TEXT'), # Space separated
+    ('objects_struck', 'TEXT'),
+    ('road_curve', 'TEXT'),
+    ('road_wet', 'TEXT'),
+    ('light', 'TEXT'),
+    ('wthr_a', 'TEXT'),
+    ('junc_type', 'TEXT'),
+    ('traf_ctrl', 'TEXT'),
+    ('road_mark', 'TEXT'),
+    ('spd_lim', 'TEXT'), # A number, or 'U' or 'LSZ'
+    ('crash_fatal_cnt', 'INTEGER'),
+    ('crash_sev_cnt', 'INTEGER'),
+    ('crash_min_cnt', 'INTEGER'),
+    ('pers_age1', 'INTEGER'),
+    ('pers_age2', 'INTEGER'),
+    ('easting', 'INTEGER'),
+    ('northing', 'INTEGER'),
+    ('lon', 'REAL'),
+    ('lat', 'REAL'),
+    ('daytime', 'INTEGER'),
+    ('moonphase', 'INTEGER'),
+    ('moontext', 'TEXT'),
+    ('holiday_name', 'TEXT'),
+    ('worst_injury', 'TEXT'),
+    ('severity', 'INTEGER')
+) + tuple((flag, 'INTEGER') for flag in FLAGS)
+
+# (name, columns) of the B-tree indexes built after loading
+INDEXES = (
+    ('unixt', 'unixt'),
+    ('tla_name', 'tla_name, unixt'),
+    ('severity', 'severity, unixt')
+)
+
+
+def text(value):
+    '''Returns a list of codes as a string, and a str as unicode'''
+    if isinstance(value, list):
+        value = ' '.join(v for v in value if v.strip())
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def crash_row(id, crash):
+    '''Returns the values of the COLUMNS of an nztacrash, with rowid `id`'''
+    worst = crash.get_worst_injury_text()
+    return [
+        id,
+        text(crash.crash_id),
+        crash.crash_date.isoformat() if crash.crash_date is not None else None,
+        crash.crash_time.strftime('%H:%M') if crash.crash_time is not None else None,
+        crash.get_unix_time(),
+        text(crash.tla_name),
+        text(crash.crash_road),
+        crash.crash_dist,
+        text(crash.crash_dirn),
+        text(crash.crash_intsn),
+        text(crash.side_road),
+        text(nzta2geojson.ROAD_CACHE.nice(crash.get_crashroad())),
+        text(crash.mvmt),
+        text(crash.vehicles),
+        text(crash.causes),
+        text(crash.objects_struck),
+        text(crash.road_curve),
+        text(crash.road_wet),
+        text(crash.light),
+        text(crash.wthr_a),
+        text(crash.junc_type),
+        text(crash.traf_ctrl),
+        text(crash.road_mark),
+        text(str(crash.spd_lim)) if crash.spd_lim is not None else None,
+        crash.crash_fatal_cnt,
+        crash.crash_sev_cnt,
+        crash.crash_min_cnt,
+        crash.pers_age1,
+        crash.pers_age2,
+        crash.easting,
+        crash.northing,
+        crash.lon,
+        crash.lat,
+        crash.daytime,
+        crash.moonphase,
+        text(crash.moontext),
+        text(crash.holiday_name),
+        worst or None,
+        SEVERITY.get(worst)
+    ] + [1 if getattr(crash, flag) else 0 for flag in FLAGS]
+
+def export(path, crashes, table='crashes', batch=10000):
+    '''
+    Writes an iterable of nztacrashes to `table` (and its R*Tree,
+    `table`_rtree) of a new SQLite file at `path`, replacing any that is
+    there. Returns the number of crashes written.
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    # A new file that is not in use: no need to survive a crash half way
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('CREATE TABLE %s (%s)' % (table,
+        ', '.join('%s %s' % column for column in COLUMNS)))
+    connection.execute('CREATE VIRTUAL TABLE %s_rtree USING rtree(id, min_lon, max_lon, min_lat, max_lat)' % table)
+    insert = 'INSERT INTO %s VALUES (%s)' % (table, ', '.join('?' * len(COLUMNS)))
+    insert_rtree = 'INSERT INTO %s_rtree VALUES (?, ?, ?, ?, ?)' % table
+    count = 0
+    with connection:
+        # One transaction
+        rows, boxes = [], []
+        for count, crash in enumerate(crashes, 1):
+            rows.append(crash_row(count, crash))
+            if crash.lon is not None and crash.lat is not None:
+                boxes.append((count, crash.lon, crash.lon, crash.lat, crash.lat))
+            if len(rows) >= batch:
+                connection.executemany(insert, rows)
+                connection.executemany(insert_rtree, boxes)
+                rows, boxes = [], []
+        connection.executemany(insert, rows)
+        connection.executemany(insert_rtree, boxes)
+        for name, columns in INDEXES:
+            connection.execute('CREATE INDEX %s_%s_idx ON %s (%s)' % (table, name, table, columns))
+        connection.execute('ANALYZE')
+    connection.close()
+    return count
+
+def query(connection, bbox=None, start=None, end=None, table='crashes', columns='*'):
+    '''
+    Returns the rows of the crashes in `bbox` (west, south, east, north) and
+    between the datetimes `start` and `end` (timezone-aware, or UTC), each of
+    which may be None for no limit.
+    '''
+    sql = ['SELECT %s FROM %s c' % (columns, table)]
+    where, parameters = [], []
+    if bbox is not None:
+        sql.append('JOIN %s_rtree r ON c.id = r.id' % table)
+        where.append('r.min_lon <= ? AND r.max_lon >= ? AND r.min_lat <= ? AND r.max_lat >= ?')
+        west, south, east, north = bbox
+        parameters.extend([east, west, north, south])
+    for limit, operator in ((start, '>='), (end, '<=')):
+        if limit is not None:
+            where.append('c.unixt %s ?' % operator)
+            parameters.append(timegm(limit.utctimetuple()) * 1000)
+    if where:
+        sql.append('WHERE ' + ' AND '.join(where))
+    return connection.execute(' '.join(sql), parameters).fetchall()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports NZTA crash CSVs to SQLite')
+    parser.add_argument('path', nargs='?', default='../data/crashes.sqlite',
+        help='SQLite file to (re)write (default: ../data/crashes.sqlite)')
+    args = parser.parse_args()
+
+    # As nzta2geojson.py
+    global_start = datetime.date(2015,1,1)
+    global_end = datetime.date(2015,3,31)
+    data = ['../data/crash-data-{i}.csv'.format(i=i) if i < 2015 else '../data/crash-data-{i}-partial.csv'.format(i=i) for i in xrange(global_start.year, global_end.year + 1)]
+    causes = '../data/decoders/cause-decoder.csv'
+    streets = '../data/decoders/NZ-post-street-types.csv'
+    holidays = nzta2geojson.get_official_holiday_periods()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.time()
+    crashes = (crash for file in data for crash in nzta2geojson.get_crashes(file,
+        causes, streets, holidays, global_start, global_end))
+    count = export(args.path, crashes)
+    logging.info('Exported %d crashes to %s in %.1fs' % (count, args.path, time.time() - start))
+
+    # Wellington's CBD, in January
+    connection = sqlite3.connect(args.path)
+    start = time.time()
+    rows = query(connection, bbox=(174.76, -41.30, 174.79, -41.27),
+        start=datetime.datetime(2015,1,1, tzinfo=pytz.utc),
+        end=datetime.datetime(2015,2,1, tzinfo=pytz.utc), columns='c.crash_id')
+    logging.info('%d crashes in the box and month, in %.1fms' % (len(rows), (time.time() - start) * 1000))
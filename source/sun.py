@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`sun.py`
+========
+Vectorised position of the Sun, for deciding whether crashes happened in
+daylight without solving for sunrise and sunset one crash at a time.
+
+Uses the low precision solar coordinates of Jean Meeus, "Astronomical
+Algorithms" (as popularised by the NOAA solar calculator), which are good to
+about 0.01 degrees between 1800 and 2100: a few seconds of time at a
+twilight boundary, which is well within the precision of the crash times.
+
+The functions of primary interest are altitude(), which gives the altitude of
+the centre of the Sun for arrays of times and places, and daylight(), which
+classifies them as day (1) or night (0) for a given definition of twilight.
+Where the same places and days come up again and again, SolarEventCache
+remembers the times of sunrise and sunset instead, so that classifying a
+crash is a lookup and a comparison.
+
+Depends
+=======
+numpy
+'''
+
+import os
+import datetime
+import cPickle as pickle
+from collections import OrderedDict
+
+import numpy as np
+
+# Altitude of the centre of the Sun (degrees) at which each kind of twilight
+# begins and ends
+TWILIGHTS = {
+    'civil': -6,
+    'nautical': -12,
+    'astronomical': -18
+}
+
+# Julian Day Number of the POSIX epoch, 1970-01-01 00:00 UTC
+UNIX_EPOCH_JDN = 2440587.5
+
+# Julian Day Number of J2000.0
+J2000 = 2451545.0
+
+# (south, west, north, east) extents of New Zealand in WGS84 degrees, for
+# prebuilding a SolarEventCache. The Chatham Islands lie across the
+# antimeridian; longitudes are normalised to -180..180 (see normalise_lon())
+NZ_EXTENTS = {
+    'mainland': (-47.5, 166.0, -34.0, 178.9),
+    'chathams': (-44.6, -177.0, -43.6, -176.0)
+}
+
+
+def julian_day(timestamps):
+    '''Returns an array of Julian Day Numbers given an array of UTC
+    `timestamps`, either as numpy.datetime64 values or anything that
+    numpy can convert to them (e.g. naive UTC datetime.datetime objects).'''
+    seconds = np.asarray(timestamps, dtype='datetime64[s]').astype(np.float64)
+    return seconds / 86400.0 + UNIX_EPOCH_JDN
+
+
+def solar_coordinates(jd):
+    '''Returns the declination of the Sun and the equation of time (both in
+    radians) for an array of Julian Day Numbers `jd`.'''
+    # Julian centuries since J2000.0
+    t = (jd - J2000) / 36525.0
+
+    # Geometric mean longitude and mean anomaly of the Sun
+    l0 = np.radians(np.mod(280.46646 + t * (36000.76983 + t * 0.0003032), 360.0))
+    m = np.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+    # Eccentricity of Earth's orbit
+    e = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+
+    # Equation of the centre, and the Sun's apparent longitude
+    c = np.radians(
+        np.sin(m) * (1.914602 - t * (0.004817 + 0.000014 * t))
+        + np.sin(2 * m) * (0.019993 - 0.000101 * t)
+        + np.sin(3 * m) * 0.000289)
+    omega = np.radians(125.04 - 1934.136 * t)
+    apparent_longitude = l0 + c - np.radians(0.00569 + 0.00478 * np.sin(omega))
+
+    # Obliquity of the ecliptic, corrected for nutation
+    obliquity = np.radians(
+        23.0 + (26.0 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60.0) / 60.0
+        + 0.00256 * np.cos(omega))
+
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_longitude))
+
+    # Equation of time (radians of hour angle)
+    y = np.tan(obliquity / 2) ** 2
+    equation_of_time = (
+        y * np.sin(2 * l0)
+        - 2 * e * np.sin(m)
+        + 4 * e * y * np.sin(m) * np.cos(2 * l0)
+        - 0.5 * y * y * np.sin(4 * l0)
+        - 1.25 * e * e * np.sin(2 * m))
+    return declination, equation_of_time
+
+
+def altitude(timestamps, lats, lons):
+    '''Returns an array of the geometric altitude (degrees) of the centre of the
+    Sun above the horizon for each of the UTC `timestamps` (see julian_day()),
+    as seen from the corresponding `lats` and `lons` (WGS84 degrees, East
+    positive). All arguments are broadcast against each other.'''
+    jd = julian_day(timestamps)
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.asarray(lons, dtype=np.float64)
+    declination, equation_of_time = solar_coordinates(jd)
+
+    # Hour angle, from the fraction of the UTC day and the longitude
+    day_fraction = np.mod(jd - 0.5, 1.0)
+    hour_angle = 2 * np.pi * day_fraction - np.pi + equation_of_time + np.radians(lons)
+
+    sin_altitude = (np.sin(lats) * np.sin(declination)
+        + np.cos(lats) * np.cos(declination) * np.cos(hour_angle))
+    return np.degrees(np.arcsin(np.clip(sin_altitude, -1.0, 1.0)))
+
+
+def daylight(timestamps, lats, lons, twilight='civil'):
+    '''Returns an array of integers: 1 where the Sun was above the `twilight`
+    horizon ('civil', 'nautical' or 'astronomical') at each of the UTC
+    `timestamps` and places (see altitude()), otherwise 0.
+
+    This is the vectorised equivalent of asking ephem whether the next
+    setting of the Sun (by its centre) comes before its next rising.'''
+    assert twilight in TWILIGHTS
+    return (altitude(timestamps, lats, lons) > TWILIGHTS[twilight]).astype(np.int8)
+
+
+def normalise_lon(lons):
+    '''Returns an array of longitudes wrapped into the range -180..180, so
+    that places across the antimeridian (the Chatham Islands, whose corrected
+    NZTM coordinates can project beyond 180 degrees East) share grid cells.'''
+    return np.mod(np.asarray(lons, dtype=np.float64) + 180.0, 360.0) - 180.0
+
+
+def solar_day(jd, lons):
+    '''Returns the local mean solar day (an integer count of days) and the
+    fraction of that day elapsed, for arrays of Julian Day Numbers `jd` at
+    longitudes `lons`. The Sun rises and sets within a single such day.'''
+    solar = np.asarray(jd, dtype=np.float64) - 0.5 + normalise_lon(lons) / 360.0
+    day = np.floor(solar)
+    return day.astype(np.int64), solar - day
+
+
+def solar_events(days, lats, lons, twilight='civil', iterations=2):
+    '''Returns the times at which the centre of the Sun crosses the `twilight`
+    horizon upwards and downwards (i.e. sunrise and sunset), as fractions of
+    the local mean solar `days` (see solar_day()) at `lats` and `lons`.
+
+    Where the Sun never rises above the horizon on that day, both events are
+    1.0, and where it never sets they are 0.0 and 1.0, so that
+    rise <= fraction < set is always the test for daylight.'''
+    assert twilight in TWILIGHTS
+    days = np.asarray(days, dtype=np.float64)
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = normalise_lon(lons)
+    horizon = np.radians(TWILIGHTS[twilight])
+    # Julian Day Number of the start of each local mean solar day
+    midnight = days + 0.5 - lons / 360.0
+
+    def crossing(fraction, direction):
+        # Refine the time of the event, recomputing the Sun's position at
+        # the previous estimate each time
+        for i in range(iterations):
+            declination, equation_of_time = solar_coordinates(midnight + fraction)
+            noon = 0.5 - equation_of_time / (2 * np.pi)
+            cos_hour_angle = ((np.sin(horizon) - np.sin(lats) * np.sin(declination))
+                / (np.cos(lats) * np.cos(declination)))
+            hour_angle = np.arccos(np.clip(cos_hour_angle, -1.0, 1.0))
+            fraction = noon + direction * hour_angle / (2 * np.pi)
+        return fraction, cos_hour_angle
+
+    rise, cos_rise = crossing(np.full(np.broadcast(days, lats).shape, 0.25), -1)
+    set_, cos_set = crossing(np.full(rise.shape, 0.75), 1)
+    # The Sun is always above (cos < -1) or below (cos > 1) the horizon
+    always = (cos_rise < -1) & (cos_set < -1)
+    never = (cos_rise > 1) & (cos_set > 1)
+    rise = np.where(always, 0.0, np.where(never, 1.0, rise))
+    set_ = np.where(always, 1.0, np.where(never, 1.0, set_))
+    return rise, set_
+
+
+class SolarEventCache:
+    '''
+    A memo of sunrise and sunset times (see solar_events()), keyed on the local
+    mean solar day and a grid cell of `grid` degrees of latitude and
+    longitude. Events are computed for the centre of each cell; at NZ
+    latitudes, 0.05 degrees moves sunrise and sunset by at most about 20
+    seconds.
+
+    At most `maxsize` (day, cell) entries are kept, evicting the least
+    recently used. If `path` is given, entries are loaded from it if it
+    exists, and save() writes them back for the next run. hits, misses and
+    evictions count lookups since the cache was created (see stats()).
+    '''
+    def __init__(self, grid=0.05, twilight='civil', maxsize=1000000, path=None):
+        assert twilight in TWILIGHTS
+        self.grid = grid
+        self.twilight = twilight
+        self.maxsize = maxsize
+        self.path = path
+        self.events = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def keys(self, days, lats, lons):
+        '''Returns the cache keys (day, row, column) for arrays of solar
+        `days` and places'''
+        rows = np.round(np.asarray(lats, dtype=np.float64) / self.grid).astype(np.int64)
+        cols = np.round(normalise_lon(lons) / self.grid).astype(np.int64)
+        days, rows, cols = np.broadcast_arrays(days, rows, cols)
+        return zip(days.tolist(), rows.tolist(), cols.tolist())
+
+    def lookup(self, keys):
+        '''Returns arrays of the (rise, set) events for a list of `keys`,
+        computing all of the missing ones in a single vectorised call.'''
+        rise = np.empty(len(keys))
+        set_ = np.empty(len(keys))
+        missing = {}
+        for i, key in enumerate(keys):
+            events = self.events.pop(key, None)
+            if events is None:
+                missing.setdefault(key, []).append(i)
+                continue
+            # Re-insert, marking this entry as the most recently used
+            self.events[key] = events
+            rise[i], set_[i] = events
+            self.hits += 1
+        if missing:
+            # Repeats of a missing key within the batch are computed only once
+            self.misses += len(missing)
+            self.hits += sum(len(v) - 1 for v in missing.values())
+            new = missing.keys()
+            days, rows, cols = np.array(new, dtype=np.int64).T
+            new_rise, new_set = solar_events(days, rows * self.grid,
+                cols * self.grid, twilight=self.twilight)
+            for key, r, s in zip(new, new_rise.tolist(), new_set.tolist()):
+                self.insert(key, (r, s))
+                for i in missing[key]:
+                    rise[i], set_[i] = r, s
+        return rise, set_
+
+    def insert(self, key, events):
+        '''Adds an entry, evicting the least recently used if the cache is full'''
+        self.events[key] = events
+        while len(self.events) > self.maxsize:
+            self.events.popitem(last=False)
+            self.evictions += 1
+
+    def daylight(self, timestamps, lats, lons):
+        '''Cached equivalent of daylight() for this cache's twilight'''
+        days, fractions = solar_day(julian_day(timestamps), lons)
+        rise, set_ = self.lookup(self.keys(days, lats, lons))
+        return ((rise <= fractions) & (fractions < set_)).astype(np.int8)
+
+    def prebuild(self, start, end, extents=NZ_EXTENTS):
+        '''Fills the cache with the events of every grid cell within the
+        (south, west, north, east) `extents` (by default, all of New Zealand
+        including the Chatham Islands) for each date from `start` to `end`
+        (datetime.date, inclusive). Beware that at the default grid this is
+        about 70 000 entries per day.'''
+        first = (start - datetime.date(1970, 1, 1)).days + int(UNIX_EPOCH_JDN + 0.5)
+        last = (end - datetime.date(1970, 1, 1)).days + int(UNIX_EPOCH_JDN + 0.5)
+        days = np.arange(first, last + 1)
+        for south, west, north, east in extents.values():
+            rows = np.arange(int(np.round(south / self.grid)), int(np.round(north / self.grid)) + 1)
+            cols = np.arange(int(np.round(west / self.grid)), int(np.round(east / self.grid)) + 1)
+            d, r, c = [a.ravel() for a in np.meshgrid(days, rows, cols, indexing='ij')]
+            rise, set_ = solar_events(d, r * self.grid, c * self.grid, twilight=self.twilight)
+            for key, events in zip(zip(d.tolist(), r.tolist(), c.tolist()),
+                                   zip(rise.tolist(), set_.tolist())):
+                self.insert(key, events)
+
+    def stats(self):
+        '''Returns a dictionary of the cache's size, hits, misses, evictions
+        and hit rate'''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.events),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else None
+        }
+
+    def load(self, path):
+        '''Loads entries saved by save(), if they were made with the same
+        grid and twilight'''
+        with open(path, 'rb') as cachefile:
+            saved = pickle.load(cachefile)
+        if (saved['grid'], saved['twilight']) != (self.grid, self.twilight):
+            raise ValueError('%s was saved with a different grid or twilight' % path)
+        for key, events in saved['events']:
+            self.insert(key, events)
+
+    def save(self, path=None):
+        '''Writes the entries to `path` (default: the path the cache was made
+        with), least recently used first'''
+        path = path or self.path
+        with open(path, 'wb') as cachefile:
+            pickle.dump({
+                'grid': self.grid,
+                'twilight': self.twilight,
+                'events': self.events.items()
+            }, cachefile, pickle.HIGHEST_PROTOCOL)
+
+
+def ephem_daylight(timestamp, lat, lon, twilight='civil', elev=0, temp=15.0, pressure=1010):
+    '''The original, one-at-a-time daylight test using ephem, kept as the
+    reference that daylight() is checked against (see __main__).'''
+    import ephem
+    observer = ephem.Observer()
+    observer.date = timestamp
+    observer.lon = str(lon)
+    observer.lat = str(lat)
+    observer.elev = elev
+    observer.pressure = pressure
+    observer.temp = temp
+    observer.horizon = str(TWILIGHTS[twilight])
+    next_sunrise = observer.next_rising(ephem.Sun(), use_center=True)
+    next_sunset = observer.next_setting(ephem.Sun(), use_center=True)
+    return int(next_sunset < next_sunrise)
+
+
+if __name__ == '__main__':
+    # Check daylight() against ephem on the crashes of the shipped CSV
+    import time
+    import logging
+    logging.disable(logging.CRITICAL)
+    import nzta2geojson
+
+    crashes = [crash for crash in nzta2geojson.get_crashes(
+        '../data/crash-data-2015-partial.csv',
+        '../data/decoders/cause-decoder.csv',
+        '../data/decoders/NZ-post-street-types.csv',
+        nzta2geojson.get_official_holiday_periods(),
+        datetime.date(2015,1,1), datetime.date(2015,12,31))
+        if crash.crash_datetime is not None]
+    timestamps = [c.get_crash_datetime(as_utc=True).replace(tzinfo=None) for c in crashes]
+    lats = [c.lat for c in crashes]
+    lons = [c.lon for c in crashes]
+
+    for twilight in sorted(TWILIGHTS):
+        start = time.time()
+        vectorised = daylight(timestamps, lats, lons, twilight=twilight)
+        vectorised_time = time.time() - start
+        start = time.time()
+        reference = [ephem_daylight(t, lat, lon, twilight=twilight)
+            for t, lat, lon in zip(timestamps, lats, lons)]
+        reference_time = time.time() - start
+        disagree = np.flatnonzero(vectorised != np.array(reference))
+        print ('%s: %d crashes, %d disagree with ephem; numpy %.4fs, ephem %.4fs' %
+            (twilight, len(crashes), len(disagree), vectorised_time, reference_time))
+        for i in disagree:
+            print ('    %s (%.4f, %.4f): altitude %.4f' % (timestamps[i], lats[i],
+                lons[i], altitude(timestamps[i], lats[i], lons[i])))
+
+        # Accuracy and hit rate of the solar event cache at various grid sizes
+        for grid in [0.01, 0.05, 0.1, 0.5]:
+            cache = SolarEventCache(grid=grid, twilight=twilight)
+            start = time.time()
+            cached = cache.daylight(timestamps, lats, lons)
+            cached_time = time.time() - start
+            stats = cache.stats()
+            print ('    cache grid %.2f: %d disagree with numpy, hit rate %.3f (%d entries), %.4fs' %
+                (grid, np.count_nonzero(cached != vectorised), stats['hit_rate'],
+                 stats['size'], cached_time))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+`tiles.py`
+==========
+Writes crash features as a pyramid of z/x/y GeoJSON tiles (in the usual Web
+Mercator "slippy map" scheme), instead of a single data.geojson, so that a
+map only fetches the tiles in its view.
+
+Every crash is in its tile at the deepest zoom. At each shallower zoom, the
+points are thinned to at most one per `cell` x `cell` pixel cell of a 256
+pixel tile (the first to arrive), since more could not be told apart on the
+map anyway. A manifest.json lists the zooms, the bounds, and the tiles that
+exist with their number of features, so that a client need not ask for empty
+tiles. The bounds are split at the antimeridian: `bounds` are those of the
+crashes in the eastern hemisphere (all of New Zealand but the Chatham
+Islands), and `bounds_west` those of the others, so that neither spans the
+globe.
+
+Tiling is done in a single pass over the features, which are buffered and
+appended to their tiles `flush` at a time, so memory use does not grow with
+the number of crashes (other than the set of occupied thinning cells). The
+tiles are written to a new directory, which then replaces the old one, so
+no tiles of an earlier run are left beside the new manifest.
+
+Import it: from tiles import TileWriter
+
+Depends
+=======
+json
+'''
+
+import os
+import re
+import json
+import math
+import shutil
+
+import generalFunctions as genFunc
+
+# The point of an encoded GeoJSON feature (see nzta2geojson.convert())
+COORDINATES = re.compile(r'"coordinates":\[([^,\]]+),([^,\]]+)\]')
+
+# Web Mercator cannot show the poles
+MAX_LAT = 85.0511287798
+
+
+def lonlat2pixel(lon, lat, zoom):
+    '''Returns the (x, y) pixel of (`lon`, `lat`) on the Web Mercator map of
+    256 pixel tiles at `zoom`, counting from the north-west corner'''
+    size = 256 << zoom
+    lat = max(min(lat, MAX_LAT), -MAX_LAT)
+    sin = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0 * size
+    y = (0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * size
+    return min(max(int(x), 0), size - 1), min(max(int(y), 0), size - 1)
+
+def extend_bounds(bounds, lon, lat):
+    '''Returns [west, south, east, north] `bounds` (or None, for none yet)
+    extended to include (`lon`, `lat`)'''
+    if bounds is None:
+        return [lon, lat, lon, lat]
+    bounds[0], bounds[1] = min(bounds[0], lon), min(bounds[1], lat)
+    bounds[2], bounds[3] = max(bounds[2], lon), max(bounds[3], lat)
+    return bounds
+
+def feature_lonlat(feature):
+    '''Returns the (lon, lat) of an encoded GeoJSON point feature, or None if
+    it has no coordinates'''
+    match = COORDINATES.search(feature)
+    if match is None:
+        return None
+    try:
+        return float(match.group(1)), float(match.group(2))
+    except ValueError:
+        # e.g. null
+        return None
+
+
+class TileWriter(object):
+    '''
+    I write encoded GeoJSON features (see add()) to the tiles of zooms
+    `min_zoom` to `max_zoom` under `directory`, as
+    `directory`/z/x/y.geojson. Call close() when they are all added, to
+    finish the tiles and write the manifest, and only then replace
+    `directory` with them; it must be empty or hold an earlier run's tiles
+    (see generalFunctions.check_replaceable()). Call discard() instead, if
+    the features cannot all be added.
+
+    `cell` (a power of 2) is the size in pixels of the cells that the points
+    of zooms below `max_zoom` are thinned to. Features are buffered, and
+    written `flush` at a time.
+    '''
+    def __init__(self, directory, min_zoom=5, max_zoom=12, cell=16, flush=50000):
+        assert 0 <= min_zoom <= max_zoom
+        assert cell > 0 and cell & (cell - 1) == 0 and cell <= 256
+        genFunc.check_replaceable(directory)
+        self.directory = directory
+        self.building = None # Made when the first tiles are written
+        self.min_zoom, self.max_zoom = min_zoom, max_zoom
+        self.cell = cell
+        self.cell_bits = int(math.log(cell, 2))
+        self.flush_size = flush
+        self.encoder = json.JSONEncoder(separators=(',',':'))
+        # Let the encoder decide the key order of a tile's collection
+        self.header, self.footer = self.encoder.encode(
+            {"type": "FeatureCollection","features": []}).split('[]')
+        self.buffer = {}
+        self.buffered = 0
+        self.counts = {} # (z, x, y): number of features
+        self.seen = dict((zoom, set()) for zoom in xrange(min_zoom, max_zoom))
+        self.bounds = None # Of the features east of the prime meridian
+        self.bounds_west = None # And of the others
+        self.added, self.skipped = 0, 0
+
+    def tile_path(self, zoom, x, y):
+        return os.path.join(self.building, str(zoom), str(x), '%d.geojson' % y)
+
+    def add(self, feature):
+        '''Adds an encoded GeoJSON point feature to its tiles. Features
+        without a location are skipped.'''
+        lonlat = feature_lonlat(feature)
+        if lonlat is None:
+            self.skipped += 1
+            return
+        lon, lat = lonlat
+        if lon >= 0:
+            self.bounds = extend_bounds(self.bounds, lon, lat)
+        else:
+            self.bounds_west = extend_bounds(self.bounds_west, lon, lat)
+        # Pixels at the deepest zoom; those of the others are shifts of them
+        px, py = lonlat2pixel(lon, lat, self.max_zoom)
+        for zoom in xrange(self.min_zoom, self.max_zoom + 1):
+            shift = self.max_zoom - zoom
+            if zoom < self.max_zoom:
+                shift_cell = shift + self.cell_bits
+                cell = (px >> shift_cell, py >> shift_cell)
+                seen = self.seen[zoom]
+                if cell in seen:
+                    # Thinned out, and so from every shallower zoom too
+                    continue
+                seen.add(cell)
+            tile = (zoom, px >> (shift + 8), py >> (shift + 8))
+            self.buffer.setdefault(tile, []).append(feature)
+            self.buffered += 1
+        self.added += 1
+        if self.buffered >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        '''Appends the buffered features to their tiles'''
+        if self.building is None:
+            self.building = genFunc.building_directory(self.directory)
+        for tile, features in self.buffer.iteritems():
+            path = self.tile_path(*tile)
+            count = self.counts.get(tile, 0)
+            if count == 0:
+                directory = os.path.dirname(path)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+            with open(path, 'ab' if count else 'wb') as f:
+                f.write(',' if count else self.header + '[')
+                f.write(','.join(features))
+            self.counts[tile] = count + len(features)
+        self.buffer = {}
+        self.buffered = 0
+
+    def manifest(self):
+        '''Returns the manifest of the tiles written'''
+        zooms = {}
+        for (zoom, x, y), count in sorted(self.counts.iteritems()):
+            level = zooms.setdefault(str(zoom), {'features': 0, 'tiles': []})
+            level['features'] += count
+            level['tiles'].append([x, y, count])
+        return {
+            'format': 'geojson',
+            'tiles': '{z}/{x}/{y}.geojson',
+            'minzoom': self.min_zoom,
+            'maxzoom': self.max_zoom,
+            'cell': self.cell,
+            'bounds': self.bounds,
+            'bounds_west': self.bounds_west,
+            'features': self.added,
+            'zooms': zooms
+        }
+
+    def close(self):
+        '''Writes the remaining features, ends every tile's collection,
+        writes manifest.json, and replaces my directory with them'''
+        self.flush()
+        for tile in self.counts:
+            with open(self.tile_path(*tile), 'ab') as f:
+                f.write(']' + self.footer)
+        with open(os.path.join(self.building, 'manifest.json'), 'wb') as f:
+            f.write(self.encoder.encode(self.manifest()))
+        genFunc.replace_directory(self.directory, self.building)
+        self.building = None
+
+    def discard(self):
+        '''Removes the tiles I have written so far, leaving my directory as
+        it was'''
+        if self.building is not None:
+            shutil.rmtree(self.building, True)
+            self.building = None
+
+    def stats(self):
+        '''Returns a dictionary of the number of features tiled (added) and
+        without a location (skipped), and of tiles written'''
+        return {'added': self.added, 'skipped': self.skipped, 'tiles': len(self.counts)}